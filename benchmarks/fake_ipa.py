@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - fake FreeIPA API
+
+In-memory fake of the subset of the FreeIPA API used by the tool
+(entity find/add/mod/del, membership, rule member & sudo option commands
+and the batch command), for benchmarking & testing push and pull
+without a FreeIPA server. The fake can simulate the latency of API calls
+and inject errors. `FakeIpaApi` is used in place of `ipalib.api`
+directly; `FakeIpaServer` exposes it over JSON-RPC on localhost
+and `FakeIpaClient` is an `ipalib.api` replacement talking to it.
+
+Usage:
+    api = FakeIpaApi(latency=0.005)
+    IpaUploader(settings, entities, 10, force=True, ipa_api=api).push()
+"""
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import httplib
+import json
+import random
+import threading
+import time
+
+try:
+    import ipalib  # noqa: F401
+except ImportError:
+    # the tool imports the FreeIPA API object on import, but it is not used
+    # when the fake is passed to the connectors; provide a placeholder
+    import imp
+    import sys
+    sys.modules['ipalib'] = imp.new_module('ipalib')
+    sys.modules['ipalib'].api = None
+
+from ipamanager.utils import ENTITY_CLASSES
+
+ID_TYPES = dict((cls.entity_name, cls.entity_id_type)
+                for cls in ENTITY_CLASSES)
+# rule member commands (e.g., hbacrule_add_user) -> attribute prefix
+RULE_MEMBERS = {'user': 'memberuser', 'host': 'memberhost',
+                'service': 'memberservice'}
+# options only influencing the output of commands
+OUTPUT_OPTIONS = ('all', 'raw', 'sizelimit', 'pkey_only', 'version')
+# attributes generated by the server
+GENERATED = ('gidnumber',)
+
+
+class FakeIpaError(Exception):
+    """Error raised by a fake API command (like `ipalib.errors` ones)."""
+    def __init__(self, message, name='ExecutionError', code=4000):
+        super(FakeIpaError, self).__init__(message)
+        self.name = name
+        self.code = code
+
+
+class _Namespace(object):
+    """Namespace of API commands (`api.Command`)."""
+    def __init__(self, call):
+        self._call = call
+
+    def __getitem__(self, command):
+        def run(*args, **kwargs):
+            return self._call(command, *args, **kwargs)
+        return run
+
+    def __getattr__(self, command):
+        if command.startswith('_'):
+            raise AttributeError(command)
+        return self[command]
+
+
+class _RpcClient(object):
+    """Fake of `api.Backend.rpcclient` counting connections."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    def connect(self):
+        with self.lock:
+            self.connections += 1
+
+    def disconnect(self):
+        pass
+
+
+class _Backend(object):
+    def __init__(self):
+        self.rpcclient = _RpcClient()
+
+
+class FakeIpaApi(object):
+    """
+    In-memory fake of `ipalib.api`. Entities are stored as dictionaries
+    of lowercase attribute names & lists of values (like LDAP entries).
+    Membership is stored at the group (`member_<type>` attributes),
+    `memberof_<type>` attributes are computed when entities are found.
+    """
+    def __init__(self, latency=0.0, work=0.0, error_rate=0.0,
+                 fail_commands=(), seed=0):
+        """
+        :param float latency: time each API call takes (seconds)
+        :param float work: time each executed command takes (seconds)
+        :param float error_rate: probability of an injected command error
+        :param fail_commands: names of commands that always fail
+        :param int seed: seed of the error injection
+        """
+        self.latency = latency
+        self.work = work
+        self.error_rate = error_rate
+        self.fail_commands = set(fail_commands)
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.entries = dict((entity_type, dict()) for entity_type in ID_TYPES)
+        self.calls = collections.Counter()
+        self.Command = _Namespace(self._call)
+        self.Object = dict()  # default attributes unknown, all are loaded
+        self.Backend = _Backend()
+
+    def add(self, entity_type, name, **attrs):
+        """
+        Add an entity directly (without simulated latency).
+        :param str entity_type: type of the entity (e.g., 'group')
+        :param str name: name of the entity
+        :param attrs: attributes of the entity; `member_<type>` attributes
+                      define members of the entity
+        """
+        entry = dict((key.lower(), _values(value))
+                     for key, value in attrs.iteritems())
+        entry[ID_TYPES[entity_type]] = [unicode(name)]
+        with self.lock:
+            self.entries[entity_type][unicode(name)] = entry
+
+    def snapshot(self):
+        """
+        Get a copy of the stored entities for comparison; attributes
+        generated by the server (e.g., `gidnumber`) are left out.
+        :returns: entity type -> entity name -> attributes (sorted values)
+        :rtype: dict
+        """
+        with self.lock:
+            return dict(
+                (entity_type, dict(
+                    (name, dict((k, sorted(v)) for k, v in entry.iteritems()
+                                if v and k not in GENERATED))
+                    for name, entry in entries.iteritems()))
+                for entity_type, entries in self.entries.iteritems())
+
+    def _call(self, command, *args, **kwargs):
+        """
+        Execute a single API call (a command or a batch of commands).
+        """
+        with self.lock:
+            self.calls['calls'] += 1
+        if command == 'batch':
+            time.sleep(self.latency + self.work * len(args))
+            return self._batch(args)
+        time.sleep(self.latency + self.work)
+        return self.execute(command, *args, **kwargs)
+
+    def _batch(self, methods):
+        results = []
+        for method in methods:
+            args, options = method['params']
+            try:
+                results.append(self.execute(
+                    method['method'], *args, **_str_keys(options)))
+            except FakeIpaError as e:
+                results.append({'error': unicode(e), 'error_name': e.name,
+                                'error_code': e.code})
+        return {'count': len(results), 'results': results}
+
+    def execute(self, command, *args, **kwargs):
+        """
+        Execute an API command (without simulated latency).
+        :param str command: name of the command (e.g., group_add_member)
+        :raises FakeIpaError: if the command fails
+        """
+        entity_type, _, operation = command.partition('_')
+        handler = getattr(self, '_%s' % operation, None)
+        if entity_type not in ID_TYPES or not handler:
+            raise FakeIpaError(
+                'unknown command %s' % command, 'CommandError', 905)
+        with self.lock:
+            self.calls[command] += 1
+            if command in self.fail_commands or (
+                    self.error_rate and
+                    self.random.random() < self.error_rate):
+                raise FakeIpaError('injected error in %s' % command,
+                                   'NetworkError', 907)
+            options = dict((k, v) for k, v in kwargs.iteritems()
+                           if k not in OUTPUT_OPTIONS)
+            name = options.pop(
+                ID_TYPES[entity_type], args[0] if args else None)
+            if operation == 'find':
+                return handler(entity_type, **kwargs)
+            if name is None:
+                raise FakeIpaError(
+                    "'%s' is required" % ID_TYPES[entity_type],
+                    'RequirementError', 3007)
+            return handler(entity_type, unicode(name), **options)
+
+    def _entry(self, entity_type, name):
+        try:
+            return self.entries[entity_type][name]
+        except KeyError:
+            raise FakeIpaError('%s: %s not found' % (name, entity_type),
+                               'NotFound', 4001)
+
+    def _result(self, entity_type, entry, member_of=None):
+        result = dict((k, tuple(v)) for k, v in entry.iteritems() if v)
+        if member_of:
+            for target_type, targets in member_of.iteritems():
+                result['memberof_%s' % target_type] = tuple(sorted(targets))
+        return result
+
+    def _find(self, entity_type, pkey_only=False, **kwargs):
+        id_type = ID_TYPES[entity_type]
+        entries = self.entries[entity_type]
+        if pkey_only:
+            result = [{id_type: (name,)} for name in sorted(entries)]
+        else:
+            member_of = self._member_of(entity_type)
+            result = [self._result(entity_type, entries[name],
+                                   member_of.get(name))
+                      for name in sorted(entries)]
+        return {'count': len(result), 'result': tuple(result),
+                'summary': u'%d %ss matched' % (len(result), entity_type),
+                'truncated': False}
+
+    def _member_of(self, entity_type):
+        """
+        Compute direct membership of entities of the given type.
+        :returns: entity name -> target type -> target names
+        """
+        result = collections.defaultdict(lambda: collections.defaultdict(set))
+        key = 'member_%s' % entity_type
+        for target_type, entries in self.entries.iteritems():
+            for target, entry in entries.iteritems():
+                for member in entry.get(key, ()):
+                    result[member][target_type].add(target)
+        return result
+
+    def _show(self, entity_type, name, **kwargs):
+        entry = self._entry(entity_type, name)
+        return {'result': self._result(
+            entity_type, entry, self._member_of(entity_type).get(name)),
+            'value': name, 'summary': None}
+
+    def _add(self, entity_type, name, **options):
+        if name in self.entries[entity_type]:
+            raise FakeIpaError(
+                '%s with name "%s" already exists' % (entity_type, name),
+                'DuplicateEntry', 4002)
+        entry = {ID_TYPES[entity_type]: [name]}
+        if entity_type == 'group':
+            entry['objectclass'] = [u'ipausergroup', u'groupofnames']
+            if not options.pop('nonposix', False):
+                entry['objectclass'].append(u'posixgroup')
+                entry['gidnumber'] = [unicode(self._gidnumber())]
+        self._modify(entry, options)
+        self.entries[entity_type][name] = entry
+        return {'result': self._result(entity_type, entry), 'value': name,
+                'summary': u'Added %s "%s"' % (entity_type, name)}
+
+    def _gidnumber(self):
+        self.calls['gidnumber'] += 1
+        return 10000 + self.calls['gidnumber']
+
+    def _mod(self, entity_type, name, **options):
+        entry = self._entry(entity_type, name)
+        before = dict((k, list(v)) for k, v in entry.iteritems())
+        if options.pop('posix', False):
+            if u'posixgroup' not in entry.get('objectclass', []):
+                entry.setdefault('objectclass', []).append(u'posixgroup')
+                entry['gidnumber'] = [unicode(self._gidnumber())]
+        self._modify(entry, options)
+        if entry == before:
+            raise FakeIpaError('no modifications to be performed',
+                               'EmptyModlist', 4202)
+        return {'result': self._result(entity_type, entry), 'value': name,
+                'summary': u'Modified %s "%s"' % (entity_type, name)}
+
+    def _modify(self, entry, options):
+        """
+        Apply attribute changes to an entry. Empty values delete
+        the attribute, `setattr`, `addattr` & `delattr` options contain
+        `attr=value` items (as with the `ipa` command line tool).
+        """
+        for key, value in options.iteritems():
+            if key in ('setattr', 'addattr', 'delattr'):
+                for item in _values(value):
+                    attr, _, attr_value = item.partition('=')
+                    attr = attr.lower()
+                    values = entry.setdefault(attr, [])
+                    if key == 'setattr':
+                        values[:] = [attr_value] if attr_value else []
+                    elif key == 'addattr':
+                        values.append(attr_value)
+                    elif attr_value in values:
+                        values.remove(attr_value)
+                    if not values:
+                        del entry[attr]
+            elif isinstance(value, bool):
+                entry[key.lower()] = [u'TRUE' if value else u'FALSE']
+            elif _values(value):
+                entry[key.lower()] = _values(value)
+            else:
+                entry.pop(key.lower(), None)
+
+    def _del(self, entity_type, name, **options):
+        self._entry(entity_type, name)
+        del self.entries[entity_type][name]
+        # referential integrity: remove the entity from its groups & rules
+        keys = ('member_%s' % entity_type,) + tuple(
+            '%s_%s' % (prefix, entity_type)
+            for prefix in RULE_MEMBERS.itervalues())
+        for entries in self.entries.itervalues():
+            for entry in entries.itervalues():
+                for key in keys:
+                    if name in entry.get(key, ()):
+                        entry[key].remove(name)
+        return {'result': {'failed': ()}, 'value': (name,),
+                'summary': u'Deleted %s "%s"' % (entity_type, name)}
+
+    def _members(self, entity_type, name, prefix, add, options):
+        """
+        Add/remove members of an entity. Members that do not exist
+        (or are already/not members) are reported in the result's
+        `failed` attribute, like FreeIPA does.
+        """
+        entry = self._entry(entity_type, name)
+        failed = dict()
+        completed = 0
+        for member_type, members in options.iteritems():
+            failed[member_type] = []
+            values = entry.setdefault('%s_%s' % (prefix, member_type), [])
+            for member in _values(members):
+                if member_type not in ID_TYPES or (
+                        member not in self.entries[member_type]):
+                    failed[member_type].append((member, u'no such entry'))
+                elif add and member in values:
+                    failed[member_type].append(
+                        (member, u'This entry is already a member'))
+                elif not add and member not in values:
+                    failed[member_type].append(
+                        (member, u'This entry is not a member'))
+                else:
+                    completed += 1
+                    if add:
+                        values.append(member)
+                    else:
+                        values.remove(member)
+        return {'completed': completed,
+                'failed': {prefix: dict((k, tuple(v))
+                                        for k, v in failed.iteritems())},
+                'result': self._result(entity_type, entry)}
+
+    def _add_member(self, entity_type, name, **options):
+        return self._members(entity_type, name, 'member', True, options)
+
+    def _remove_member(self, entity_type, name, **options):
+        return self._members(entity_type, name, 'member', False, options)
+
+    def _rule_members(self, entity_type, name, kind, add, options):
+        if entity_type not in ('hbacrule', 'sudorule'):
+            raise FakeIpaError('unknown command %s_%s_%s' % (
+                entity_type, 'add' if add else 'remove', kind))
+        return self._members(
+            entity_type, name, RULE_MEMBERS[kind], add, options)
+
+    def _add_user(self, entity_type, name, **options):
+        return self._rule_members(entity_type, name, 'user', True, options)
+
+    def _remove_user(self, entity_type, name, **options):
+        return self._rule_members(entity_type, name, 'user', False, options)
+
+    def _add_host(self, entity_type, name, **options):
+        return self._rule_members(entity_type, name, 'host', True, options)
+
+    def _remove_host(self, entity_type, name, **options):
+        return self._rule_members(entity_type, name, 'host', False, options)
+
+    def _add_service(self, entity_type, name, **options):
+        return self._rule_members(
+            entity_type, name, 'service', True, options)
+
+    def _remove_service(self, entity_type, name, **options):
+        return self._rule_members(
+            entity_type, name, 'service', False, options)
+
+    def _add_option(self, entity_type, name, ipasudoopt=(), **options):
+        entry = self._entry(entity_type, name)
+        values = entry.setdefault('ipasudoopt', [])
+        for option in _values(ipasudoopt):
+            if option in values:
+                raise FakeIpaError('ipasudoopt: %s already exists' % option,
+                                   'DuplicateEntry', 4002)
+            values.append(option)
+        return {'result': self._result(entity_type, entry), 'value': name}
+
+    def _remove_option(self, entity_type, name, ipasudoopt=(), **options):
+        entry = self._entry(entity_type, name)
+        values = entry.get('ipasudoopt', [])
+        for option in _values(ipasudoopt):
+            if option not in values:
+                raise FakeIpaError('ipasudoopt does not contain %s' % option,
+                                   'AttrValueNotFound', 4026)
+            values.remove(option)
+        return {'result': self._result(entity_type, entry), 'value': name}
+
+
+def _values(value):
+    """
+    Convert an API command parameter to a list of attribute values.
+    """
+    if value is None or value == '':
+        return []
+    if isinstance(value, (tuple, list)):
+        return [unicode(i) for i in value]
+    return [unicode(value)]
+
+
+def _str_keys(options):
+    # keyword arguments must be str (JSON decodes them as unicode)
+    return dict((str(k), v) for k, v in options.iteritems())
+
+
+def _tuples(data):
+    """
+    Convert lists in decoded JSON data to tuples, like `ipalib` does.
+    """
+    if isinstance(data, list):
+        return tuple(_tuples(i) for i in data)
+    if isinstance(data, dict):
+        return dict((k, _tuples(v)) for k, v in data.iteritems())
+    return data
+
+
+class _ThreadingServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive
+
+    def do_POST(self):
+        request = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))
+        args, options = request['params']
+        try:
+            result = self.server.api._call(
+                request['method'], *args, **_str_keys(options))
+            response = {'result': result, 'error': None}
+        except FakeIpaError as e:
+            response = {'result': None, 'error': {
+                'message': unicode(e), 'name': e.name, 'code': e.code}}
+        body = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeIpaServer(object):
+    """
+    JSON-RPC server on localhost exposing a `FakeIpaApi` (the requests
+    have the same format as FreeIPA's `/ipa/json` endpoint).
+    """
+    def __init__(self, api, port=0):
+        """
+        :param FakeIpaApi api: fake API to expose
+        :param int port: port to listen on (0 for any free port)
+        """
+        self.server = _ThreadingServer(('127.0.0.1', port), _Handler)
+        self.server.api = api
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _JsonRpcClient(object):
+    """Fake of `api.Backend.rpcclient` holding a connection per thread."""
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def connect(self):
+        self.local.connection = httplib.HTTPConnection('127.0.0.1', self.port)
+
+    def disconnect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection:
+            connection.close()
+            self.local.connection = None
+
+    def call(self, method, *args, **options):
+        if not getattr(self.local, 'connection', None):
+            self.connect()
+        body = json.dumps({'method': method, 'params': [args, options]})
+        self.local.connection.request(
+            'POST', '/ipa/json', body, {'Content-Type': 'application/json'})
+        response = json.loads(self.local.connection.getresponse().read())
+        if response['error']:
+            error = response['error']
+            raise FakeIpaError(error['message'], error['name'], error['code'])
+        return _tuples(response['result'])
+
+
+class FakeIpaClient(object):
+    """
+    Replacement of `ipalib.api` executing commands via JSON-RPC
+    on a `FakeIpaServer` (each thread uses its own connection).
+    """
+    def __init__(self, port):
+        """
+        :param int port: port the server listens on
+        """
+        self.Backend = _Backend()
+        self.Backend.rpcclient = _JsonRpcClient(port)
+        self.Command = _Namespace(self.Backend.rpcclient.call)
+        self.Object = dict()
+
+
+def populate(api, users, groups, hostgroups=0, rules=0, seed=0):
+    """
+    Fill a fake API with synthetic entities: `users` users, each member
+    of a few of the `groups` user groups, hostgroups nested in each
+    other and HBAC & sudo rules referencing the groups.
+    :param FakeIpaApi api: fake API to fill
+    :param int users: number of users
+    :param int groups: number of user groups
+    :param int hostgroups: number of hostgroups
+    :param int rules: number of HBAC rules & of sudo rules
+    :param int seed: seed of the random membership
+    """
+    rand = random.Random(seed)
+    group_names = [u'group-%05d' % i for i in range(groups)]
+    members = collections.defaultdict(list)
+    for i in range(users):
+        name = u'user-%05d' % i
+        api.add('user', name, givenname=u'User', sn=u'%05d' % i,
+                mail=u'%s@example.com' % name)
+        for group in rand.sample(group_names, min(3, groups)):
+            members[group].append(name)
+    for i, group in enumerate(group_names):
+        # every tenth group nests the following one
+        nested = group_names[i + 1:i + 2] if i % 10 == 0 else []
+        api.add('group', group, description=u'Group %d' % i,
+                objectclass=[u'ipausergroup', u'groupofnames',
+                             u'posixgroup'],
+                gidnumber=10000 + i,
+                member_user=members[group], member_group=nested)
+    for i in range(hostgroups):
+        api.add('hostgroup', u'hostgroup-%05d' % i,
+                description=u'Hostgroup %d' % i,
+                member_hostgroup=[u'hostgroup-%05d' % (i + 1)]
+                if i % 10 == 0 and i + 1 < hostgroups else [])
+    for i in range(rules):
+        group = [group_names[i % groups]] if groups else []
+        hostgroup = [u'hostgroup-%05d' % (i % hostgroups)] if (
+            hostgroups) else []
+        api.add('hbacrule', u'hbacrule-%05d' % i,
+                description=u'HBAC rule %d' % i, servicecategory=u'all',
+                memberuser_group=group, memberhost_hostgroup=hostgroup)
+        api.add('sudorule', u'sudorule-%05d' % i,
+                description=u'Sudo rule %d' % i, cmdcategory=u'all',
+                ipasudorunasusercategory=u'all',
+                ipasudorunasgroupcategory=u'all',
+                memberuser_group=group, memberhost_hostgroup=hostgroup,
+                ipasudoopt=[u'!authenticate', u'!requiretty'])
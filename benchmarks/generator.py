@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - synthetic config repository generator
+
+Generates a config repository in the layout loaded by `ConfigLoader`
+(one YAML file per entity in a directory per entity type), resembling
+a real deployment: users are members of team groups, team groups
+are nested in a hierarchy of organization groups, HBAC & sudo rules
+grant organization groups access to hostgroups, and some groups require
+security labels that users may or may not have.
+
+Run from the repository root:
+    python -m benchmarks.generator TARGET [-u USERS] [-g GROUPS] [-d DEPTH]
+"""
+
+import argparse
+import os
+import random
+
+import yaml
+
+from ipamanager.entities import EntityDumper
+
+# groups matching this pattern may contain users (see `IntegrityChecker`)
+USER_GROUP_PATTERN = '.+-users$'
+
+
+def _write(target, entity_type, name, data):
+    path = os.path.join(target, '%ss' % entity_type,
+                        '%s.yaml' % name.replace('-', '_'))
+    with open(path, 'w') as dest:
+        yaml.dump({name: data}, dest, Dumper=EntityDumper,
+                  default_flow_style=False, explicit_start=True)
+
+
+def generate_repo(target, users=1000, groups=100, depth=3, hostgroups=None,
+                  hbac_rules=None, sudo_rules=None, labels=5, seed=0):
+    """
+    Generate a synthetic config repository.
+    :param str target: directory to create the repository in
+    :param int users: number of users
+    :param int groups: number of user groups (at least 2)
+    :param int depth: number of levels of the user group hierarchy
+                      (at least 2; users are members of the lowest one)
+    :param int hostgroups: number of hostgroups (`groups` / 2 if None)
+    :param int hbac_rules: number of HBAC rules (`groups` / 5 if None)
+    :param int sudo_rules: number of sudo rules (`groups` / 5 if None)
+    :param int labels: number of distinct security labels
+    :param int seed: seed of the random membership
+    :returns: number of generated entities of each type
+    :rtype: dict
+    """
+    rand = random.Random(seed)
+    if hostgroups is None:
+        hostgroups = max(1, groups // 2)
+    if hbac_rules is None:
+        hbac_rules = max(1, groups // 5)
+    if sudo_rules is None:
+        sudo_rules = max(1, groups // 5)
+    # split groups into levels, level 0 (teams) containing users directly
+    # and higher levels (organizations) being referenced by rules
+    groups = max(2, groups)
+    depth = max(2, min(depth, groups))
+    for entity_type in ('user', 'group', 'hostgroup', 'hbacrule', 'sudorule'):
+        os.makedirs(os.path.join(target, '%ss' % entity_type))
+    with open(os.path.join(target, 'settings_common.yaml'), 'w') as dest:
+        yaml.safe_dump({'user-group-pattern': USER_GROUP_PATTERN,
+                        'nesting-limit': depth + 1}, dest,
+                       explicit_start=True)
+    label_names = ['label-%d' % i for i in range(labels)]
+    levels = [[] for _ in range(depth)]
+    for i in range(groups):
+        level = 0 if i < groups // 2 else 1 + i % (depth - 1)
+        name = ('team-%05d-users' % i) if level == 0 else (
+            'org-%d-%05d' % (level, i))
+        levels[level].append(name)
+    levels = [names for names in levels if names]
+    for number, level in enumerate(levels):
+        parents = levels[number + 1] if number + 1 < len(levels) else []
+        for name in level:
+            data = {'description': 'Group %s' % name}
+            if parents:
+                data['memberOf'] = {'group': sorted(set(
+                    rand.sample(parents, min(2, len(parents)))))}
+            if label_names and number and rand.random() < 0.2:
+                data['metaparams'] = {'labels': [rand.choice(label_names)]}
+            _write(target, 'group', name, data)
+
+    for i in range(users):
+        name = 'user.%05d' % i
+        data = {'firstName': 'User', 'lastName': '%05d' % i,
+                'emailAddress': '%s@example.com' % name,
+                'memberOf': {'group': sorted(set(
+                    rand.sample(levels[0], min(3, len(levels[0])))))}}
+        if label_names:
+            data['metaparams'] = {'labels': sorted(set(
+                rand.choice(label_names) for _ in range(2)))}
+        _write(target, 'user', name, data)
+
+    hostgroup_names = ['hosts-%05d' % i for i in range(hostgroups)]
+    for i, name in enumerate(hostgroup_names):
+        data = {'description': 'Hostgroup %d' % i}
+        if i % 10:
+            # hostgroups are nested in the first one of each ten
+            data['memberOf'] = {'hostgroup': [hostgroup_names[i // 10 * 10]]}
+        _write(target, 'hostgroup', name, data)
+
+    rule_groups = [name for level in levels[1:] for name in level]
+    for entity_type, count in (('hbacrule', hbac_rules),
+                               ('sudorule', sudo_rules)):
+        for i in range(count):
+            _write(target, entity_type, '%s-%05d' % (entity_type, i), {
+                'description': '%s %d' % (entity_type, i),
+                'memberHost': [rand.choice(hostgroup_names)],
+                'memberUser': [rand.choice(rule_groups)]})
+    return {'user': users, 'group': groups,
+            'hostgroup': hostgroups, 'hbacrule': hbac_rules,
+            'sudorule': sudo_rules}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic config repository')
+    parser.add_argument('target', help='Directory to create')
+    parser.add_argument('-u', '--users', type=int, default=1000,
+                        help='Number of users')
+    parser.add_argument('-g', '--groups', type=int, default=100,
+                        help='Number of user groups')
+    parser.add_argument('-d', '--depth', type=int, default=3,
+                        help='Number of levels of the group hierarchy')
+    parser.add_argument('--hbac-rules', type=int, help='Number of HBAC rules')
+    parser.add_argument('--sudo-rules', type=int, help='Number of sudo rules')
+    parser.add_argument('-l', '--labels', type=int, default=5,
+                        help='Number of security labels')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Random seed')
+    args = parser.parse_args()
+    counts = generate_repo(
+        args.target, args.users, args.groups, args.depth,
+        hbac_rules=args.hbac_rules, sudo_rules=args.sudo_rules,
+        labels=args.labels, seed=args.seed)
+    print(', '.join('%d %ss' % (count, entity_type)
+                    for entity_type, count in sorted(counts.iteritems())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - integrity check benchmark
+
+Compares the original cycle check (a depth-first search started from each
+group separately) with the strongly connected components pass run once
+for all entities, on a synthetic group hierarchy.
+
+Run from the repository root:
+    python -m benchmarks.integrity [-g GROUPS] [-p PARENTS] [-c CYCLES]
+"""
+
+import argparse
+import logging
+import random
+import time
+
+from ipamanager.entities import FreeIPAUserGroup
+from ipamanager.integrity_checker import IntegrityChecker
+
+
+def group_hierarchy(count, parents, cycles, seed=0):
+    """
+    Create a synthetic group hierarchy. Each group is a member of up to
+    `parents` groups with a lower index, `cycles` groups additionally
+    become members of one of their (transitive) member groups.
+    """
+    rand = random.Random(seed)
+    member_of = [[] for _ in range(count)]
+    for i in range(1, count):
+        member_of[i] = sorted(set(
+            'group-%d' % rand.randrange(max(0, i - 1000), i)
+            for _ in range(rand.randint(1, parents))))
+    for i in rand.sample(range(count // 2), cycles):
+        member_of[i].append('group-%d' % rand.randrange(i + 1, count))
+    groups = dict()
+    for i in range(count):
+        name = 'group-%d' % i
+        groups[name] = FreeIPAUserGroup(
+            name, {'memberOf': {'group': member_of[i]}}, 'path')
+    return {'group': groups}
+
+
+def legacy_check_cycles(checker, entity):
+    """
+    Cycle check as originally run by `IntegrityChecker` for each group.
+    """
+    stack = [(entity, [])]
+    visited = set()
+    while stack:
+        current, path = stack.pop()
+        visited.add(current)
+        path.append(current)
+        member_of = current.data_repo.get('memberOf', dict())
+        for item in member_of.get(current.entity_name, []):
+            target = checker._find_entity(current.entity_name, item)
+            if not target:
+                continue
+            if target == entity:
+                return path
+            if target not in visited:
+                stack.append((target, path))
+
+
+def legacy(checker):
+    cycles = dict()
+    for entity in checker.entity_dict['group'].itervalues():
+        path = legacy_check_cycles(checker, entity)
+        if path:
+            cycles[(entity.entity_name, entity.name)] = path
+    return cycles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Integrity check benchmark')
+    parser.add_argument('-g', '--groups', type=int, default=50000,
+                        help='Number of groups in the hierarchy')
+    parser.add_argument('-p', '--parents', type=int, default=2,
+                        help='Maximum number of parents of each group')
+    parser.add_argument('-c', '--cycles', type=int, default=5,
+                        help='Number of membership cycles to create')
+    parser.add_argument('-s', '--sample', type=int, default=500,
+                        help='Number of groups the original check is run on '
+                             '(the total time is extrapolated)')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    checker = IntegrityChecker(
+        group_hierarchy(args.groups, args.parents, args.cycles), {})
+    groups = sorted(checker.entity_dict['group'].itervalues(),
+                    key=lambda entity: entity.name)
+    sample = random.Random(0).sample(groups, min(args.sample, args.groups))
+
+    start = time.time()
+    cycles = checker._find_cycles()
+    current = time.time() - start
+
+    start = time.time()
+    for entity in sample:
+        assert bool(legacy_check_cycles(checker, entity)) == (
+            (entity.entity_name, entity.name) in cycles)
+    original = (time.time() - start) * args.groups / len(sample)
+
+    print('%d groups, %d of them in cycles'
+          % (args.groups, len(cycles)))
+    print('%-10s %8.2f s (extrapolated from %d groups)'
+          % ('original', original, len(sample)))
+    print('%-10s %8.2f s' % ('current', current))
+    print('speedup    %8.1fx' % (original / current))
+
+
+if __name__ == '__main__':
+    main()
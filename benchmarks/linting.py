@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - linting benchmark
+
+Compares the per-file cost of the yamllint style check (as run by
+`load_yaml` after parsing) with the built-in linter on the correct
+test configuration files.
+
+Run from the repository root:
+    python -m benchmarks.linting [-n NUMBER] [-r REPEAT]
+"""
+
+import argparse
+import glob
+import timeit
+
+from ipamanager.linter import is_canonical
+from ipamanager.utils import run_yamllint_check
+
+from benchmarks.yaml_parsing import CONFIG_CORRECT
+
+
+def yamllint(data):
+    run_yamllint_check(data, syntax_checked=True)
+
+
+def builtin(data):
+    if not is_canonical(data):
+        run_yamllint_check(data, syntax_checked=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Linting benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20,
+                        help='Number of times each file is linted')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of measurements (best one is used)')
+    args = parser.parse_args()
+    contents = []
+    for path in sorted(glob.glob('%s/*/*.yaml' % CONFIG_CORRECT)):
+        with open(path) as src:
+            contents.append(src.read())
+    canonical = sum(1 for data in contents if is_canonical(data))
+    print('%d files (%d canonical), each linted %d times'
+          % (len(contents), canonical, args.number))
+    count = len(contents) * args.number
+    results = []
+    for label, func in [('yamllint', yamllint), ('builtin', builtin)]:
+        best = min(timeit.repeat(
+            lambda: [func(data) for data in contents],
+            number=args.number, repeat=args.repeat))
+        results.append(best)
+        print('%-10s %8.3f s total %8.1f us/file'
+              % (label, best, 1e6 * best / count))
+    print('speedup    %8.1fx' % (results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - push command batching benchmark
+
+Compares executing push commands one API call per command with executing
+them using `batch` API calls, against the fake API (see `fake_ipa`)
+simulating the network round trip latency of each API call.
+
+Run from the repository root:
+    python -m benchmarks.push_batching [-n COMMANDS] [-l LATENCY] [-b SIZE]
+"""
+
+import argparse
+import logging
+import time
+
+from benchmarks.fake_ipa import FakeIpaApi, populate
+from ipamanager import ipa_connector
+from ipamanager.command import Command
+
+
+def membership_commands(count):
+    """
+    Create `count` commands adding users to groups.
+    """
+    return sorted(
+        Command('group_add_member', {'user': ('user-%05d' % i,)},
+                'group-%05d' % (i % 50), 'cn')
+        for i in range(count))
+
+
+def run(commands, batch_size, latency, work):
+    api = FakeIpaApi(latency, work)
+    populate(api, len(commands), 50)
+    for group in api.entries['group'].itervalues():
+        group.pop('member_user')
+    uploader = ipa_connector.IpaUploader(
+        {'api-batch-size': batch_size}, {}, 100, force=True, ipa_api=api)
+    uploader.errs = []
+    start = time.time()
+    uploader._execute(commands)
+    assert not uploader.errs
+    return time.time() - start, api.calls['calls']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push batching benchmark')
+    parser.add_argument('-n', '--commands', type=int, default=500,
+                        help='Number of commands to execute')
+    parser.add_argument('-l', '--latency', type=float, default=5,
+                        help='Round trip latency of an API call (ms)')
+    parser.add_argument('-w', '--work', type=float, default=0.2,
+                        help='Server time spent on each command (ms)')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Number of commands in a batch')
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+    commands = membership_commands(args.commands)
+    latency, work = args.latency / 1000.0, args.work / 1000.0
+
+    original, original_calls = run(commands, 1, latency, work)
+    current, current_calls = run(commands, args.batch_size, latency, work)
+
+    print('%d commands, %.1f ms API call latency'
+          % (args.commands, args.latency))
+    print('%-10s %8.2f s (%d API calls)'
+          % ('original', original, original_calls))
+    print('%-10s %8.2f s (%d API calls)'
+          % ('batched', current, current_calls))
+    print('speedup    %8.1fx' % (original / current))
+
+
+if __name__ == '__main__':
+    main()
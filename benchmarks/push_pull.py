@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - push & pull benchmark
+
+Runs the whole pull & push cycle against the fake FreeIPA API
+(see `fake_ipa`): entities of a populated fake API are pulled
+into a temporary configuration repository, the repository is loaded
+& checked, and the configuration is pushed to an empty fake API.
+Both APIs are compared in the end to verify the round trip.
+
+Run from the repository root:
+    python -m benchmarks.push_pull [-u USERS] [-g GROUPS] [-l LATENCY]
+                                   [--json-rpc] [-b SIZE] [-p WORKERS]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.fake_ipa import (FakeIpaApi, FakeIpaClient, FakeIpaServer,
+                                 populate)
+from ipamanager.config_loader import ConfigLoader
+from ipamanager.integrity_checker import IntegrityChecker
+from ipamanager.ipa_connector import IpaDownloader, IpaUploader
+from ipamanager.utils import ENTITY_CLASSES
+
+PULL_TYPES = ['user', 'group', 'hostgroup', 'hbacrule', 'sudorule']
+
+
+def timed(label, timings, function, *args):
+    start = time.time()
+    result = function(*args)
+    timings.append((label, time.time() - start))
+    return result
+
+
+def round_trip(source, target, settings, repo):
+    """
+    Pull the entities of the source API into the repo
+    and push the loaded configuration to the target API.
+    :returns: list of (phase, time) tuples
+    """
+    timings = []
+    for entity_type in PULL_TYPES:
+        os.mkdir(os.path.join(repo, '%ss' % entity_type))
+    empty = dict((cls.entity_name, dict()) for cls in ENTITY_CLASSES)
+    downloader = IpaDownloader(settings, empty, repo,
+                               pull_types=PULL_TYPES, ipa_api=source)
+    timed('pull', timings, downloader.pull)
+    loader = ConfigLoader(repo, settings)
+    timed('load', timings, loader.load)
+    checker = IntegrityChecker(loader.entities, settings)
+    timed('check', timings, checker.check)
+    uploader = IpaUploader(settings, loader.entities, 100, force=True,
+                           ipa_api=target)
+    timed('push', timings, uploader.push)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push & pull benchmark')
+    parser.add_argument('-u', '--users', type=int, default=2000,
+                        help='Number of users')
+    parser.add_argument('-g', '--groups', type=int, default=200,
+                        help='Number of user groups')
+    parser.add_argument('-r', '--rules', type=int, default=50,
+                        help='Number of HBAC rules and of sudo rules')
+    parser.add_argument('-l', '--latency', type=float, default=1,
+                        help='Round trip latency of an API call (ms)')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+                        help='Number of commands in a batch')
+    parser.add_argument('-p', '--push-workers', type=int, default=1,
+                        help='Number of concurrent push workers')
+    parser.add_argument('--json-rpc', action='store_true',
+                        help='Call the fake API via JSON-RPC on localhost')
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+    latency = args.latency / 1000.0
+    source, target = FakeIpaApi(latency), FakeIpaApi(latency)
+    populate(source, args.users, args.groups, args.groups, args.rules)
+    settings = {'api-batch-size': args.batch_size,
+                'push-workers': args.push_workers}
+    servers = []
+    source_api, target_api = source, target
+    if args.json_rpc:
+        servers = [FakeIpaServer(api).start() for api in (source, target)]
+        source_api, target_api = [
+            FakeIpaClient(server.port) for server in servers]
+    repo = tempfile.mkdtemp(prefix='ipamanager-benchmark-')
+    try:
+        timings = round_trip(source_api, target_api, settings, repo)
+    finally:
+        shutil.rmtree(repo)
+        for server in servers:
+            server.stop()
+    identical = source.snapshot() == target.snapshot()
+
+    print('%d users, %d groups, %d hostgroups, %d rules, %.1f ms latency%s'
+          % (args.users, args.groups, args.groups, 2 * args.rules,
+             args.latency, ' (JSON-RPC)' if args.json_rpc else ''))
+    for label, duration in timings:
+        print('%-10s %8.2f s' % (label, duration))
+    print('API calls  %8d pull, %d push' % (
+        source.calls['calls'], target.calls['calls']))
+    print('round trip %s' % ('identical' if identical else 'DIFFERENT'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - scaling benchmark
+
+Measures how the phases of the tool scale with the size of the config
+repository. For each size, a synthetic repository is generated (see
+`generator`) and these phases are timed:
+- load: `ConfigLoader.load`
+- check: `IntegrityChecker.check`
+- push-plan: `IpaUploader._prepare_push` against an empty fake API
+- pull-plan: `IpaDownloader._prepare_pull` against a fake API
+             containing the pushed configuration
+- query: `QueryTool.build_graph` for all users
+
+Each size is measured in a new process, so the peak RSS reported
+after each phase (the maximum resident set size of the process up to
+the end of the phase) is not influenced by the other sizes. The scaling
+exponent of a phase is the slope of the log-log fit of its time against
+the number of entities (1 for linear scaling, 2 for quadratic).
+
+Results are printed (or saved) as JSON; when a baseline (results saved
+earlier) is given, the phase times are compared with it and the exit
+status is 1 if any phase is slower than the tolerance allows.
+
+Run from the repository root:
+    python -m benchmarks.scaling [-s USERS [USERS ...]] [-o RESULTS]
+                                 [-b BASELINE] [-t TOLERANCE]
+"""
+
+import argparse
+import collections
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_ipa import FakeIpaApi
+from benchmarks.generator import generate_repo
+from ipamanager.config_loader import ConfigLoader
+from ipamanager.integrity_checker import IntegrityChecker
+from ipamanager.ipa_connector import IpaDownloader, IpaUploader
+from ipamanager.tools.query_tool import QueryTool
+from ipamanager.utils import load_settings
+
+# bump when the format of the results changes
+RESULTS_FORMAT = 1
+PHASES = ['load', 'check', 'push-plan', 'pull-plan', 'query']
+PULL_TYPES = ['user', 'group', 'hostgroup', 'hbacrule', 'sudorule']
+# slowdowns smaller than this (in seconds) are considered noise
+MIN_DIFFERENCE = 0.05
+
+
+def _peak_rss():
+    """
+    Get the peak resident set size of the process (in MiB).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(users, groups, depth, labels, seed=0):
+    """
+    Generate a repository of the given size & measure the phases on it.
+    :returns: entity counts & time and peak RSS of each phase
+    :rtype: dict
+    """
+    logging.disable(logging.CRITICAL)
+    repo = tempfile.mkdtemp(prefix='ipamanager-scaling-')
+    phases = collections.OrderedDict()
+
+    def timed(name, function, *args):
+        start = time.time()
+        result = function(*args)
+        phases[name] = {'time': time.time() - start,
+                        'peak_rss_mib': _peak_rss()}
+        return result
+
+    try:
+        counts = generate_repo(repo, users, groups, depth,
+                               labels=labels, seed=seed)
+        settings = load_settings(os.path.join(repo, 'settings_common.yaml'))
+        entities = timed('load', ConfigLoader(repo, settings).load)
+        timed('check', IntegrityChecker(entities, settings).check)
+
+        remote = FakeIpaApi()
+        uploader = IpaUploader(settings, entities, 100, force=True,
+                               ipa_api=remote)
+        uploader.load_ipa_entities()
+        timed('push-plan', uploader._prepare_push)
+        uploader._push_commands()  # make the remote match the config
+
+        downloader = IpaDownloader(settings, entities, repo, dry_run=True,
+                                   pull_types=PULL_TYPES, ipa_api=remote)
+        downloader.load_ipa_entities()
+        timed('pull-plan', downloader._prepare_pull)
+
+        query = QueryTool(repo, loglevel=logging.CRITICAL)
+        query.entities = entities
+        timed('query', lambda: [query.build_graph(user)
+                                for user in entities['user'].itervalues()])
+    finally:
+        shutil.rmtree(repo)
+    return {'counts': counts, 'entities': sum(counts.itervalues()),
+            'phases': phases}
+
+
+def _measure(args):
+    return measure(*args)
+
+
+def exponent(sizes, times):
+    """
+    Compute the scaling exponent by a least squares fit of log(time)
+    against log(size).
+    :param [int] sizes: problem sizes
+    :param [float] times: times measured for the sizes
+    :returns: slope of the fit (None if there are less than 2 sizes)
+    :rtype: float
+    """
+    if len(set(sizes)) < 2:
+        return None
+    xs = [math.log(i) for i in sizes]
+    ys = [math.log(max(i, 1e-6)) for i in times]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum(
+        (x - mean_x) ** 2 for x in xs)
+
+
+def run(sizes, depth, labels, seed=0):
+    """
+    Measure all sizes (each one in a new process) & summarize results.
+    :param [int] sizes: numbers of users (groups are a tenth of users)
+    :returns: results in the format saved as JSON
+    :rtype: dict
+    """
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        measured = [
+            pool.apply(_measure, [(users, max(2, users // 10), depth,
+                                   labels, seed)])
+            for users in sizes]
+    finally:
+        pool.close()
+        pool.join()
+    entities = [i['entities'] for i in measured]
+    phases = dict()
+    for phase in PHASES:
+        times = [i['phases'][phase]['time'] for i in measured]
+        phases[phase] = {
+            'time': times,
+            'peak_rss_mib': [i['phases'][phase]['peak_rss_mib']
+                             for i in measured],
+            'exponent': exponent(entities, times)}
+    return {'format': RESULTS_FORMAT, 'python': platform.python_version(),
+            'depth': depth, 'labels': labels,
+            'sizes': [{'users': users, 'entities': i['entities'],
+                       'counts': i['counts']}
+                      for users, i in zip(sizes, measured)],
+            'phases': phases}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare phase times with a baseline for the sizes measured in both.
+    :param dict results: current results
+    :param dict baseline: baseline results
+    :param float tolerance: allowed relative slowdown (0.25 = 25 %)
+    :returns: (phase, users, current time, baseline time, ratio) tuples
+              and the list of those that exceed the tolerance
+              (by more than `MIN_DIFFERENCE` seconds)
+    :rtype: tuple(list, list)
+    """
+    if baseline.get('format') != RESULTS_FORMAT:
+        raise ValueError('Unsupported baseline format %s'
+                         % baseline.get('format'))
+    base_index = dict((size['users'], i)
+                      for i, size in enumerate(baseline['sizes']))
+    rows = []
+    for i, size in enumerate(results['sizes']):
+        j = base_index.get(size['users'])
+        if j is None:
+            continue
+        for phase in PHASES:
+            if phase not in baseline['phases']:
+                continue
+            current = results['phases'][phase]['time'][i]
+            base = baseline['phases'][phase]['time'][j]
+            rows.append((phase, size['users'], current, base,
+                         current / max(base, 1e-6)))
+    return rows, [row for row in rows if row[4] > 1 + tolerance and
+                  row[2] - row[3] > MIN_DIFFERENCE]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaling benchmark')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 4000, 16000],
+                        help='Numbers of users (groups are a tenth)')
+    parser.add_argument('-d', '--depth', type=int, default=3,
+                        help='Number of levels of the group hierarchy')
+    parser.add_argument('-l', '--labels', type=int, default=5,
+                        help='Number of security labels')
+    parser.add_argument('-o', '--output', help='File to save results to')
+    parser.add_argument('-b', '--baseline', help='Results to compare with')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown against baseline')
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as src:
+            baseline = json.load(src)
+    results = run(args.sizes, args.depth, args.labels)
+    if args.output:
+        with open(args.output, 'w') as dest:
+            json.dump(results, dest, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True,
+                         separators=(',', ': ')))
+
+    sys.stderr.write('%-10s %s %9s %9s\n' % ('entities', ' '.join(
+        '%9d' % i['entities'] for i in results['sizes']),
+        'exponent', 'peak RSS'))
+    for phase in PHASES:
+        data = results['phases'][phase]
+        exp = data['exponent']
+        sys.stderr.write('%-10s %s %9s %6.0fMiB\n' % (phase, ' '.join(
+            '%8.2fs' % i for i in data['time']),
+            '-' if exp is None else '%.2f' % exp, data['peak_rss_mib'][-1]))
+    if baseline is None:
+        return
+    rows, regressions = compare(results, baseline, args.tolerance)
+    sys.stderr.write('\nagainst %s:\n' % args.baseline)
+    for row in rows:
+        sys.stderr.write('%-10s %7d users %8.2fs %8.2fs %6.2fx%s\n' % (
+            row + (' REGRESSION' if row in regressions else '',)))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - YAML parsing benchmark
+
+Compares the per-file cost of linting & parsing configuration files
+the original way (yamllint config created for every file, full yamllint
+run including its own parsing, pure-Python loader) with `load_yaml`.
+The files used are the correct test configuration files, replicated
+to get a config repository of the given size.
+
+Run from the repository root:
+    python -m benchmarks.yaml_parsing [-n COPIES] [-r REPEAT]
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import timeit
+
+import yaml
+from yamllint.config import YamlLintConfig
+from yamllint.linter import run as yamllint_check
+
+from ipamanager.utils import YAML_LOADER, load_yaml
+
+CONFIG_CORRECT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    '..', 'tests', 'freeipa-manager-config', 'correct')
+
+
+def create_repo(target, copies):
+    """
+    Create a config repository by replicating the correct test config.
+    :param str target: directory to create the repository in
+    :param int copies: number of copies of each config file to create
+    :returns: list of created file paths
+    """
+    paths = []
+    for path in glob.glob('%s/*/*.yaml' % CONFIG_CORRECT):
+        subdir = os.path.join(target, os.path.basename(os.path.dirname(path)))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        name = os.path.basename(path)
+        for i in range(copies):
+            copy_path = os.path.join(subdir, '%d_%s' % (i, name))
+            shutil.copy(path, copy_path)
+            paths.append(copy_path)
+    return paths
+
+
+def load_original(data):
+    rules = {'extends': 'default', 'rules': {'line-length': 'disable'}}
+    errs = list(yamllint_check(data, YamlLintConfig(yaml.dump(rules))))
+    if errs:
+        raise ValueError(errs)
+    return yaml.safe_load(data)
+
+
+def load_all(paths, func):
+    for path in paths:
+        with open(path) as src:
+            func(src.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='YAML parsing benchmark')
+    parser.add_argument('-n', '--copies', type=int, default=20,
+                        help='Copies of each test config file')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of measurements (best one is used)')
+    args = parser.parse_args()
+    target = tempfile.mkdtemp(prefix='ipamanager-bench-')
+    try:
+        paths = create_repo(target, args.copies)
+        print('%d files, YAML loader: %s' % (len(paths), YAML_LOADER.__name__))
+        results = []
+        for label, func in [('original', load_original),
+                            ('load_yaml', load_yaml)]:
+            best = min(timeit.repeat(
+                lambda: load_all(paths, func), number=1, repeat=args.repeat))
+            results.append(best)
+            print('%-10s %8.3f s total %8.3f ms/file'
+                  % (label, best, 1000 * best / len(paths)))
+        print('speedup    %8.1fx' % (results[0] / results[1]))
+    finally:
+        shutil.rmtree(target)
+
+
+if __name__ == '__main__':
+    main()
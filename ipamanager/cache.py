@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - config cache module
+
+Persistent cache of entities parsed from configuration files,
+so that files unchanged since the previous run need not be parsed again,
+and saved state of the whole configuration loaded at a git revision.
+"""
+
+import cPickle as pickle
+import hashlib
+import inspect
+import os
+
+import entities
+import schemas
+from core import FreeIPAManagerCore
+
+# bump when the format of cached data changes
+CACHE_FORMAT = 2
+DEFAULT_CACHE_DIR = '~/.ipamanager-cache'
+
+
+def file_digest(contents):
+    """
+    Compute a digest of configuration file contents.
+    :param str contents: file contents
+    :returns: hex digest of the contents
+    :rtype: str
+    """
+    return hashlib.sha1(contents).hexdigest()
+
+
+def _module_digest(module):
+    try:
+        source = inspect.getsource(module)
+    except (IOError, TypeError):  # source not available, use compiled file
+        with open(module.__file__, 'rb') as src:
+            source = src.read()
+    return file_digest(source)
+
+
+def set_results_path(results, path):
+    """
+    Set the config file path of cached entities, as the path could
+    have changed since they were cached (e.g., a different checkout).
+    :param list results: entity creation results (see `ConfigLoader`)
+    :param str path: config file path to set
+    :returns: the updated results
+    """
+    for kind, value in results:
+        if kind == 'entity':
+            value.path = path
+    return results
+
+
+def cache_stamp(*params):
+    """
+    Compute a version stamp of the cache. The stamp is tied to the cache
+    format, to the entity schemas & entity implementation (whose change
+    could make entities parsed earlier invalid) and to any parameters
+    that influence parsing.
+    :param params: additional parameters influencing parsed results
+    :returns: cache version stamp
+    :rtype: str
+    """
+    parts = [str(CACHE_FORMAT), _module_digest(schemas),
+             _module_digest(entities), repr(params)]
+    return file_digest('\n'.join(parts))
+
+
+class ConfigCache(FreeIPAManagerCore):
+    """
+    Cache of entity creation results, keyed by configuration file path.
+    Entries are validated by file size & modification time; in case
+    the modification time differs, the file contents digest is compared.
+    Entries not used during the run are evicted when the cache is saved.
+    """
+    def __init__(self, cache_dir, basepath, stamp):
+        """
+        :param str cache_dir: directory to store cache files in
+        :param str basepath: path to the config repository
+        :param str stamp: cache version stamp (see `cache_stamp`)
+        """
+        super(ConfigCache, self).__init__()
+        self.basepath = basepath
+        self.stamp = stamp
+        self.cache_dir = os.path.expanduser(cache_dir)
+        repo_id = file_digest(os.path.realpath(basepath))
+        self.path = os.path.join(self.cache_dir, '%s.pickle' % repo_id)
+        self.entries = dict()
+        self.used = dict()
+
+    def load(self):
+        """
+        Load cache entries from the cache file. Entries are only loaded
+        if the cache version stamp matches; a missing or unreadable
+        cache file is not an error, the cache is just empty in that case.
+        """
+        try:
+            with open(self.path, 'rb') as src:
+                data = pickle.load(src)
+        except IOError:
+            self.lg.debug('No config cache found at %s', self.path)
+            return
+        except Exception as e:
+            self.lg.warning('Cannot read config cache %s: %s', self.path, e)
+            return
+        if not isinstance(data, dict) or data.get('stamp') != self.stamp:
+            self.lg.info('Config cache outdated, not using it')
+            return
+        self.entries = data['entries']
+        self.lg.debug('Loaded %d config cache entries', len(self.entries))
+
+    def lookup(self, path):
+        """
+        Find cached results for a configuration file.
+        :param str path: configuration file path
+        :returns: entity creation results (see `ConfigLoader`) or None
+                  if the file is not cached or has changed since
+        """
+        key = os.path.relpath(path, self.basepath)
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        size, mtime, digest, results = entry
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size != size:
+            return None
+        if stat.st_mtime != mtime:
+            try:
+                with open(path, 'r') as src:
+                    if file_digest(src.read()) != digest:
+                        return None
+            except IOError:
+                return None
+            entry = (size, stat.st_mtime, digest, results)
+        self.used[key] = entry
+        return set_results_path(pickle.loads(results), path)
+
+    def store(self, path, fingerprint, results):
+        """
+        Store entity creation results for a configuration file.
+        :param str path: configuration file path
+        :param tuple fingerprint: (size, mtime, digest) of the parsed file
+        :param list results: entity creation results
+        """
+        size, mtime, digest = fingerprint
+        key = os.path.relpath(path, self.basepath)
+        pickled = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        self.used[key] = (size, mtime, digest, pickled)
+
+    def save(self, evict=True):
+        """
+        Save entries used during this run into the cache file.
+        Entries of files that were not loaded in this run are dropped.
+        Failure to save the cache is not fatal.
+        :param bool evict: whether to drop entries not used in this run
+                           (should be False if not all files were loaded)
+        """
+        if not self.used and not self.entries:
+            self.lg.debug('Nothing to save into config cache')
+            return
+        if evict:
+            entries = self.used
+        else:
+            entries = dict(self.entries)
+            entries.update(self.used)
+        evicted = len(set(self.entries).difference(entries))
+        data = {'stamp': self.stamp, 'entries': entries}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+            with open(tmp_path, 'wb') as target:
+                pickle.dump(data, target, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self.lg.warning('Cannot save config cache %s: %s', self.path, e)
+            return
+        self.lg.debug('Saved %d config cache entries (%d evicted)',
+                      len(entries), evicted)
+
+
+class ConfigState(FreeIPAManagerCore):
+    """
+    Saved results of loading the whole configuration at a git revision,
+    used for loading only the files changed since then in the next run.
+    """
+    def __init__(self, path, stamp):
+        """
+        :param str path: path of the state file
+        :param str stamp: version stamp (see `cache_stamp`)
+        """
+        super(ConfigState, self).__init__()
+        self.path = path
+        self.stamp = stamp
+        self.revision = None
+        self.entries = dict()
+
+    def load(self):
+        """
+        Load the saved state. A missing, unreadable or outdated state
+        file is not an error, the state is just not available then.
+        :returns: True if the state was loaded, False otherwise
+        :rtype: bool
+        """
+        try:
+            with open(self.path, 'rb') as src:
+                data = pickle.load(src)
+        except IOError:
+            self.lg.info('No config state found at %s', self.path)
+            return False
+        except Exception as e:
+            self.lg.warning('Cannot read config state %s: %s', self.path, e)
+            return False
+        if not isinstance(data, dict) or data.get('stamp') != self.stamp:
+            self.lg.warning('Config state %s outdated, not using it',
+                            self.path)
+            return False
+        self.revision = data['revision']
+        self.entries = data['entries']
+        self.lg.debug('Loaded config state of %d files at %s',
+                      len(self.entries), self.revision)
+        return True
+
+    def lookup(self, key, path):
+        """
+        Get saved entity creation results for a configuration file.
+        :param str key: config file path relative to the repository
+        :param str path: current config file path
+        :returns: entity creation results (see `ConfigLoader`)
+        """
+        return set_results_path(self.entries[key], path)
+
+    def save(self, revision, entries):
+        """
+        Save the state of the configuration at the given revision.
+        Failure to save the state is not fatal.
+        :param str revision: commit hash the configuration corresponds to
+        :param dict entries: entity creation results of all config files,
+                             keyed by path relative to the repository
+        """
+        data = {'stamp': self.stamp, 'revision': revision, 'entries': entries}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as target:
+                pickle.dump(data, target, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self.lg.warning('Cannot save config state %s: %s', self.path, e)
+            return
+        self.lg.info('Saved config state of %d files at %s',
+                     len(entries), revision)
@@ -8,6 +8,7 @@ FreeIPA Manager - IPA command module
 IPA command objects to execute during FreeIPA update.
 """
 
+import collections
 import re
 
 from core import FreeIPAManagerCore
@@ -30,6 +31,10 @@ class Command(FreeIPAManagerCore):
         self.entity_id_type = entity_id_type
         self.payload = payload
         self.payload[self.entity_id_type] = self.entity_name
+        # single-member commands merged into this one (see `coalesce`)
+        self.parts = [self]
+        # (member type, member, message) of members the command failed on
+        self.failed = []
         self._encode_payload()
         self._create_description()
         self._calculate_rank()
@@ -64,16 +69,162 @@ class Command(FreeIPAManagerCore):
         self.payload.update(data)
         self._create_description()
 
-    def execute(self, api):
+    def execute(self, api, tracer=None):
+        """
+        Execute the command using the given API object.
+        :param ipalib.api api: FreeIPA API object
+        :param Tracer tracer: tracer to record the API call by (if any)
+        :raises CommandError: if the command failed
+        """
         self.lg.info('Executing %s', self.description)
         try:
-            result = api.Command[self.command](**self.payload)
+            function = api.Command[self.command]
+            if tracer:
+                result = tracer.call(function, self.command,
+                                     self.entity_name, **self.payload)
+            else:
+                result = function(**self.payload)
             self._handle_output(result)
         except KeyError:
             raise CommandError('Non-existent command %s' % self.command)
         except Exception as e:
             raise CommandError('Error executing %s: %s' % (self.command, e))
 
+    @property
+    def mergeable(self):
+        """
+        Whether the command adds/removes a single member and can thus
+        be merged with others of the same name and target. Sudo rule
+        option commands are not merged, as the API accepts only a single
+        option per call.
+        """
+        if self.command.endswith('_option'):
+            return False
+        members = [v for k, v in self.payload.iteritems()
+                   if k != self.entity_id_type]
+        return (self.rank in (1, 3) and len(members) == 1 and
+                isinstance(members[0], unicode))
+
+    @classmethod
+    def coalesce(cls, commands, chunk_size):
+        """
+        Merge single-member commands of the same name and target entity
+        into commands carrying a list of members (e.g., one group_add_member
+        adding several users), at most `chunk_size` members per command.
+        Other commands are returned unchanged.
+        :param [Command] commands: commands to merge
+        :param int chunk_size: maximum number of members in a command
+        :returns: merged commands
+        :rtype: [Command]
+        """
+        result = []
+        mergeable = collections.OrderedDict()
+        for command in commands:
+            if chunk_size > 1 and command.mergeable:
+                key = (command.command, command.entity_name,
+                       command.entity_id_type)
+                mergeable.setdefault(key, []).append(command)
+            else:
+                result.append(command)
+        for (command, entity_name, id_type), parts in mergeable.iteritems():
+            for i in range(0, len(parts), chunk_size):
+                chunk = parts[i:i + chunk_size]
+                if len(chunk) == 1:
+                    result.extend(chunk)
+                    continue
+                payload = dict()
+                for part in chunk:
+                    for key, value in part.payload.iteritems():
+                        if key != id_type:
+                            payload.setdefault(key, []).append(value)
+                merged = cls(command, payload, entity_name, id_type)
+                merged.parts = chunk
+                result.append(merged)
+        return result
+
+    def member_errors(self, err):
+        """
+        Split an execution error of a merged command into errors
+        of the original single-member commands. If the whole command failed,
+        the error is reported for each of its members.
+        :param CommandError err: error raised by the command execution
+        :returns: pairs of (command, error) to report
+        :rtype: [(Command, CommandError)]
+        """
+        if len(self.parts) == 1:
+            return [(self, err)]
+        if not self.failed:
+            return [(part, err) for part in self.parts]
+        failed = dict(((member_type, member), (member, msg))
+                      for member_type, member, msg in self.failed)
+        errs = []
+        for part in self.parts:
+            for key, value in part.payload.iteritems():
+                if key == part.entity_id_type:
+                    continue
+                failure = failed.pop((key, value), None)
+                if failure:
+                    errs.append((part, CommandError(
+                        'Error executing %s: %s'
+                        % (self.command, ['- %s: %s' % failure]))))
+        if failed:  # failures not corresponding to any member
+            errs.append((self, CommandError(
+                'Error executing %s: %s' % (self.command, [
+                    '- %s: %s' % unknown
+                    for _, unknown in sorted(failed.iteritems())]))))
+        return errs
+
+    @staticmethod
+    def execute_batch(api, commands, tracer=None):
+        """
+        Execute several commands in a single `batch` API call.
+        FreeIPA executes the commands one by one in the given order;
+        a failure of a command does not prevent execution of the others.
+        :param ipalib.api api: FreeIPA API object
+        :param [Command] commands: commands to execute
+        :param Tracer tracer: tracer to record the API call by (if any)
+        :returns: execution error of each command (None if successful)
+        :rtype: [CommandError]
+        """
+        for command in commands:
+            command.lg.info('Executing %s', command.description)
+        methods = [{'method': command.command, 'params': [[], command.payload]}
+                   for command in commands]
+        try:
+            if tracer:
+                results = tracer.call(api.Command['batch'], 'batch', None,
+                                      *methods)['results']
+            else:
+                results = api.Command['batch'](*methods)['results']
+        except Exception as e:
+            return [CommandError('Error executing batch: %s' % e)] * len(
+                commands)
+        errs = []
+        for command, result in zip(commands, results):
+            try:
+                command._handle_batch_result(result)
+            except CommandError as e:
+                errs.append(e)
+            else:
+                errs.append(None)
+        return errs
+
+    def _handle_batch_result(self, result):
+        """
+        Parse the result of a command executed as a part of a batch.
+        Errors raised by the command are returned in the batch result
+        (instead of being raised as in case of a single command execution).
+        :param dict result: result of the command from the batch response
+        :raises CommandError: if the command failed
+        """
+        if result.get('error'):
+            raise CommandError(
+                'Error executing %s: %s' % (self.command, result['error']))
+        try:
+            self._handle_output(result)
+        except CommandError as e:
+            raise CommandError('Error executing %s: %s' % (self.command, e))
+
     def _handle_output(self, output):
         """
         Parse the result of a command execution from the API response.
@@ -87,10 +238,11 @@ class Command(FreeIPAManagerCore):
             errs = []
             if 'failed' in output:
                 for key in output['failed'].itervalues():
-                    for err in key.itervalues():
+                    for member_type, err in key.iteritems():
                         if err:
                             for item, msg in err:
                                 errs.append('- %s: %s' % (item, msg))
+                                self.failed.append((member_type, item, msg))
             if errs:
                 self.lg.error('%s failed:', self.description)
                 for i in errs:
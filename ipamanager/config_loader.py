@@ -6,16 +6,23 @@
 FreeIPA Manager - Config loading module
 
 Module for loading FreeIPA configuration
-from a locally cloned config repo.
+from a locally cloned config repo (or from its git objects).
 """
 
+import cPickle as pickle
 import glob
+import itertools
+import multiprocessing
 import os
 import yaml
 
+from cache import ConfigCache, ConfigState, cache_stamp, file_digest
+from cache import set_results_path
 from core import FreeIPAManagerCore
 from errors import ConfigError
-from utils import ENTITY_CLASSES, check_ignored, run_yamllint_check
+from git_repo import GitRepo
+from metrics import Metrics
+from utils import ENTITY_CLASSES, check_ignored, load_yaml
 
 
 class ConfigLoader(FreeIPAManagerCore):
@@ -24,24 +31,259 @@ class ConfigLoader(FreeIPAManagerCore):
     :attr dict entities: storage of loaded entities, which are organized
                          in nested dicts under entity type & entity name keys
     """
-    def __init__(self, basepath, settings, ignore=True):
+    def __init__(self, basepath, settings, ignore=True, workers=1,
+                 cache_dir=None, since=None, state_path=None,
+                 revision=None, metrics=None):
         """
         :param str basepath: path to the cloned config repository
         :param dict settings: parsed contents of the settings file
         :param bool ignore: whether ignoring settings are taken into account
+        :param int workers: number of processes used for parsing config files
+                            (1 means serial loading, 0/None the CPU count)
+        :param str cache_dir: directory of the persistent parsing cache
+                              (cache is not used if None)
+        :param str since: git revision of the saved config state; only files
+                          changed since this revision are loaded if given
+        :param str state_path: path of the saved config state file
+                               (state is not used & saved if None)
+        :param str revision: git revision to load the configuration of
+                             directly from git objects (the working tree
+                             is loaded if None); neither the cache nor
+                             the config state are used in this case
+        :param Metrics metrics: metrics to record counters of the run into
         """
         super(ConfigLoader, self).__init__()
         self.basepath = basepath
         self.ignored = settings.get('ignore', dict())
+        self.linter = settings.get('linter', 'yamllint')
         self.ignore = ignore
+        self.workers = workers or multiprocessing.cpu_count()
+        self.cache_dir = cache_dir
+        self.cache = None
+        self.since = since
+        self.state_path = state_path
+        self.revision = revision
+        self.git = None
+        self.blobs = dict()
+        self.results = dict()
         self.entities = dict()
+        self.metrics = Metrics() if metrics is None else metrics
 
     def load(self):
         """
         Parse FreeIPA entity configurations from the given paths.
+        Files are read, linted and parsed into entities either serially
+        or in worker processes (based on the `workers` attribute);
+        the results are then registered in the same order in both cases.
+        Files unchanged since the previous run are loaded from the cache
+        (if enabled) without being parsed again. If a revision of the saved
+        config state is given, only files changed since that revision
+        are considered and the rest is taken from the saved state.
+        If a revision to load is given, files are read from git objects;
+        the same loader can be used for loading several revisions,
+        in which case results of files already loaded are reused.
+        """
+        self.errs = []
+        self.results = dict()
+        self.entities = dict()
+        # parse results do not depend on the ignore settings (they are
+        # applied when registering), so pull & check share the cache
+        stamp = cache_stamp()
+        state = None
+        if self.state_path and not self.revision:
+            state = ConfigState(self.state_path, stamp)
+        paths, cached, blobs = None, dict(), dict()
+        if self.revision:
+            self.lg.info('Checking configuration at %s of %s',
+                         self.revision, self.basepath)
+            try:
+                paths, cached, blobs = self._retrieve_revision_paths()
+            finally:
+                # all blobs are read, stop the object reading process
+                self._git_repo().close()
+        else:
+            self.lg.info('Checking local configuration at %s', self.basepath)
+        if self.since and state:
+            paths, cached = self._retrieve_changed_paths(state)
+        incremental = paths is not None
+        if not incremental:
+            paths = self._retrieve_paths()
+        if self.cache_dir and not self.revision:
+            self.cache = ConfigCache(self.cache_dir, self.basepath, stamp)
+            self.cache.load()
+        tasks = []
+        hits = 0
+        for entity_class in ENTITY_CLASSES:
+            for path in paths.get(entity_class.entity_name, []):
+                if path in cached:
+                    continue
+                results = self.cache.lookup(path) if self.cache else None
+                if results is None:
+                    contents = blobs[path][1] if path in blobs else None
+                    tasks.append((entity_class, path, self.linter, contents))
+                else:
+                    cached[path] = results
+                    hits += 1
+        if self.cache:
+            self.lg.info('Loaded %d config files from cache', hits)
+        self.metrics.count('files_parsed', len(tasks))
+        self.metrics.count('files_cached', len(cached))
+        pool = None
+        if self.workers > 1 and len(tasks) > 1:
+            self.lg.debug('Parsing %d files using %d processes',
+                          len(tasks), self.workers)
+            pool = multiprocessing.Pool(self.workers)
+            chunksize = max(1, len(tasks) // (self.workers * 4))
+            results = pool.imap(_load_file, tasks, chunksize)
+        else:
+            results = itertools.imap(_load_file, tasks)
+        try:
+            self._register_results(paths, cached, results)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if self.cache:
+            # files taken from the config state were not looked up
+            self.cache.save(evict=not incremental)
+        for path, (key, _) in blobs.iteritems():
+            if not _failed(self.results[path]):
+                self.blobs[key] = pickle.dumps(
+                    self.results[path], pickle.HIGHEST_PROTOCOL)
+        if self.errs:
+            raise ConfigError(
+                'There have been errors in %d configuration files: [%s]' %
+                (len(self.errs), ', '.join(sorted(self.errs))))
+        if state:
+            self._save_state(state)
+        for entity_type, entities in self.entities.iteritems():
+            self.metrics.count('entities', len(entities), entity_type)
+        return self.entities
+
+    def _git_repo(self):
+        if not self.git:
+            self.git = GitRepo(self.basepath)
+        return self.git
+
+    def _retrieve_revision_paths(self):
+        """
+        Retrieve configuration files of the revision from git objects.
+        Trees of entity directories are listed & blobs of config files
+        are read via the repository's object reading process.
+        Results of blobs loaded before (e.g., for another revision)
+        are reused based on the blob hash.
+        :returns: config file paths (like `_retrieve_paths`; the paths
+                  do not need to exist in the working tree), results
+                  of blobs loaded before and (blob key, contents) of the
+                  other blobs (both keyed by path)
+        :rtype: (dict, dict, dict)
+        """
+        git = self._git_repo()
+        revision = git.resolve(self.revision)
+        prefix = git.prefix()
+        filepaths = dict()
+        reused = dict()
+        blobs = dict()
+        for entity_class in ENTITY_CLASSES:
+            folder = '%ss' % entity_class.entity_name
+            tree = git.list_tree('%s:%s%s' % (revision, prefix, folder))
+            entity_filepaths = []
+            for mode, fname, obj_hash in sorted(
+                    tree or [], key=lambda entry: entry[1]):
+                if not _config_file_class(os.path.join(folder, fname)):
+                    continue
+                path = os.path.join(self.basepath, folder, fname)
+                if not mode.startswith('100'):  # not a regular file
+                    self.lg.warning('Not loading %s, not a regular file '
+                                    '(mode %s)', path, mode)
+                    continue
+                entity_filepaths.append(path)
+                key = (entity_class.entity_name, obj_hash)
+                if key in self.blobs:
+                    reused[path] = set_results_path(
+                        pickle.loads(self.blobs[key]), path)
+                else:
+                    blobs[path] = (key, git.read_object(obj_hash)[2])
+            if not entity_filepaths:
+                self.lg.info('No %s files found', entity_class.entity_name)
+                continue
+            filepaths[entity_class.entity_name] = entity_filepaths
+        self.lg.info('Reused results of %d files loaded before', len(reused))
+        return filepaths, reused, blobs
+
+    def _retrieve_changed_paths(self, state):
+        """
+        Retrieve configuration file paths based on the saved config state
+        and on the files changed in the repository since its revision.
+        :param ConfigState state: saved config state
+        :returns: config file paths (like `_retrieve_paths`) and results
+                  of files not changed since the state's revision, keyed
+                  by path; (None, {}) if the state cannot be used
+        :rtype: (dict, dict)
+        """
+        if not state.load():
+            return None, dict()
+        git = GitRepo(self.basepath)
+        revision = git.resolve(self.since)
+        if state.revision != revision:
+            self.lg.warning(
+                'Config state is at %s, not at %s (%s); loading all files',
+                state.revision, self.since, revision)
+            return None, dict()
+        changed = git.changed_files(revision)
+        self.lg.info('%d files changed since %s', len(changed), self.since)
+        filepaths = dict()
+        unchanged = dict()
+        for key in sorted(set(state.entries).union(changed)):
+            entity_class = _config_file_class(key)
+            if not entity_class:
+                continue
+            path = os.path.join(self.basepath, key)
+            if key not in changed:
+                unchanged[path] = state.lookup(key, path)
+            elif not os.path.lexists(path):  # deleted or renamed file
+                continue
+            filepaths.setdefault(entity_class.entity_name, []).append(path)
+        return filepaths, unchanged
+
+    def _save_state(self, state):
+        """
+        Save the loaded configuration as the config state of the current
+        git revision. The state is only saved if the working tree
+        does not differ from the revision (otherwise it would not
+        correspond to the configuration at the revision) and, if loaded
+        incrementally, if the revision is the one given by `since`
+        (so that e.g. a run on a branch does not replace the state
+        of the main branch).
+        :param ConfigState state: config state to save
+        """
+        git = GitRepo(self.basepath)
+        try:
+            revision = git.resolve('HEAD')
+            if self.since and git.resolve(self.since) != revision:
+                self.lg.info('HEAD is not at %s, not saving state',
+                             self.since)
+                return
+            if git.changed_files(revision):
+                self.lg.info('Uncommitted changes in %s, not saving state',
+                             self.basepath)
+                return
+        except ConfigError as e:
+            self.lg.warning('Cannot save config state: %s', e)
+            return
+        state.save(revision, dict(
+            (os.path.relpath(path, self.basepath), results)
+            for path, results in self.results.iteritems()))
+
+    def _register_results(self, paths, cached, results):
+        """
+        Register entities parsed from configuration files.
+        :param dict paths: config file paths (output of `_retrieve_paths`)
+        :param dict cached: results loaded from cache, keyed by path
+        :param iterator results: results of `_load_file` for each path
+                                 not found in cache (ordered by entity
+                                 class & path)
         """
-        self.lg.info('Checking local configuration at %s', self.basepath)
-        paths = self._retrieve_paths()
         for entity_class in ENTITY_CLASSES:
             self.entities[entity_class.entity_name] = dict()
             entity_paths = paths.get(entity_class.entity_name, [])
@@ -53,12 +295,15 @@ class ConfigLoader(FreeIPAManagerCore):
                 fname = os.path.relpath(path, self.basepath)
                 self.lg.debug('Loading config from %s', fname)
                 try:
-                    with open(path, 'r') as confsource:
-                        contents = confsource.read()
-                    run_yamllint_check(contents)
-                    self.lg.debug('%s yamllint check passed', fname)
-                    data = yaml.safe_load(contents)
-                    self._parse(data, entity_class, path)
+                    if path in cached:
+                        file_results = cached[path]
+                    else:
+                        file_results, fingerprint = next(results)
+                        if (self.cache and fingerprint and
+                                not _failed(file_results)):
+                            self.cache.store(path, fingerprint, file_results)
+                    self.results[path] = file_results
+                    self._register(file_results, entity_class, path)
                 except (IOError, ConfigError, yaml.YAMLError) as e:
                     self.lg.error('%s: %s', fname, e)
                     self.errs.append(fname)
@@ -67,11 +312,6 @@ class ConfigLoader(FreeIPAManagerCore):
                 'Parsed %d %s%s', len(self.entities[entity_class.entity_name]),
                 '%ss' % entity_class.entity_name,
                 ' (%d errors encountered)' % errcount if errcount else '')
-        if self.errs:
-            raise ConfigError(
-                'There have been errors in %d configuration files: [%s]' %
-                (len(self.errs), ', '.join(sorted(self.errs))))
-        return self.entities
 
     def _parse(self, data, entity_class, path):
         """
@@ -80,20 +320,37 @@ class ConfigLoader(FreeIPAManagerCore):
         :param FreeIPAEntity entity_class: entity class to create instances of
         :param str path: configuration file path
         """
-        if not data or not isinstance(data, dict):
-            raise ConfigError('Config must be a non-empty dictionary')
+        self._register(_create_entities(data, entity_class, path),
+                       entity_class, path)
+
+    def _register(self, results, entity_class, path):
+        """
+        Register entity instances created from a configuration file.
+        Duplicit definitions are checked here (rather than during entity
+        creation) as they depend on entities parsed from other files.
+        Ignore settings are applied here as well, so that the results
+        can be cached regardless of them.
+        :param list results: entity creation results (see `_create_entities`)
+        :param FreeIPAEntity entity_class: entity class of the instances
+        :param str path: configuration file path
+        """
         parsed = []
         fname = os.path.relpath(path, self.basepath)
-        for name, attrs in data.iteritems():
-            self.lg.debug('Creating entity %s', name)
-            if self.ignore and check_ignored(entity_class, name, self.ignored):
+        ignored = self.ignored if self.ignore else dict()
+        for kind, value in results:
+            if kind == 'error':
+                raise value
+            name = value[0] if kind == 'invalid' else value.name
+            if check_ignored(entity_class, name, ignored):
                 self.lg.info('Not creating ignored %s %s from %s',
                              entity_class.entity_name, name, fname)
                 continue
-            entity = entity_class(name, attrs, path)
-            if name in self.entities[entity_class.entity_name]:
-                raise ConfigError('Duplicit definition of %s' % repr(entity))
-            parsed.append(entity)
+            if kind == 'invalid':
+                raise value[1]
+            self.lg.debug('Creating entity %s', value.name)
+            if value.name in self.entities[entity_class.entity_name]:
+                raise ConfigError('Duplicit definition of %s' % repr(value))
+            parsed.append(value)
         if len(parsed) > 1:
             raise ConfigError(
                 'More than one entity parsed from %s (%d)'
@@ -109,7 +366,7 @@ class ConfigLoader(FreeIPAManagerCore):
         for entity_class in ENTITY_CLASSES:
             folder = os.path.join(
                 self.basepath, '%ss' % entity_class.entity_name)
-            entity_filepaths = glob.glob('%s/*.yaml' % folder)
+            entity_filepaths = sorted(glob.glob('%s/*.yaml' % folder))
             self.lg.debug(
                 'Retrieved %s config paths: [%s]',
                 entity_class.entity_name, ', '.join(entity_filepaths))
@@ -118,3 +375,83 @@ class ConfigLoader(FreeIPAManagerCore):
                 continue
             filepaths[entity_class.entity_name] = entity_filepaths
         return filepaths
+
+
+def _config_file_class(key):
+    """
+    Get the entity class of a configuration file. The file must match
+    the same pattern as the files retrieved by `ConfigLoader`.
+    :param str key: file path relative to the config repository
+    :returns: entity class or None if the file is not a configuration file
+    """
+    folder, fname = os.path.split(key)
+    if fname.startswith('.') or not fname.endswith('.yaml'):
+        return None
+    for entity_class in ENTITY_CLASSES:
+        if folder == '%ss' % entity_class.entity_name:
+            return entity_class
+    return None
+
+
+def _load_file(args):
+    """
+    Read, lint & parse a single configuration file and create its entities.
+    Defined on module level so that it can be run in worker processes;
+    errors are returned rather than raised so that they can be reported
+    by the parent process the same way as during serial loading.
+    :param tuple args: (entity class, file path, linter,
+                       file contents or None if it should be read)
+    :returns: entity creation results (see `_create_entities`) and
+              the (size, mtime, digest) fingerprint of the file (None
+              if the file could not be read or its contents were given)
+    :rtype: ([(str, object)], tuple)
+    """
+    entity_class, path, linter, contents = args
+    fingerprint = None
+    try:
+        if contents is None:
+            with open(path, 'r') as confsource:
+                stat = os.fstat(confsource.fileno())
+                contents = confsource.read()
+            fingerprint = (
+                stat.st_size, stat.st_mtime, file_digest(contents))
+        data = load_yaml(contents, linter)
+        return _create_entities(data, entity_class, path), fingerprint
+    except (IOError, ConfigError, yaml.YAMLError) as e:
+        return [('error', e)], fingerprint
+
+
+def _create_entities(data, entity_class, path):
+    """
+    Create entity instances from loaded YAML dictionary. Ignore settings
+    are not applied (see `ConfigLoader._register`), so invalid entities
+    do not stop the creation (they may be ignored).
+    :param dict data: contents of loaded YAML configuration file
+    :param FreeIPAEntity entity_class: entity class to create instances of
+    :param str path: configuration file path
+    :returns: list of (kind, value) results where kind is 'entity' (value is
+              the created instance), 'invalid' (value is a tuple of
+              the entity name & the exception raised during its creation)
+              or 'error' (value is the exception raised for the file)
+    :rtype: [(str, object)]
+    :raises ConfigError: if the data is not a non-empty dictionary
+    """
+    if not data or not isinstance(data, dict):
+        raise ConfigError('Config must be a non-empty dictionary')
+    results = []
+    for name, attrs in data.iteritems():
+        try:
+            results.append(('entity', entity_class(name, attrs, path)))
+        except ConfigError as e:
+            results.append(('invalid', (name, e)))
+    return results
+
+
+def _failed(results):
+    """
+    Check whether entity creation results of a file contain errors
+    (results of such files are not cached).
+    :param list results: entity creation results (see `_create_entities`)
+    :rtype: bool
+    """
+    return any(kind in ('error', 'invalid') for kind, _ in results)
@@ -22,3 +22,17 @@ class FreeIPAManagerCore(object):
 
     def configure_logger(self):
         self.lg = logging.getLogger(self.__class__.__name__)
+
+    def __getstate__(self):
+        """
+        Loggers cannot be pickled (they hold handler locks), so they are
+        left out of the pickled state & re-configured after unpickling.
+        This enables passing instances between processes.
+        """
+        state = self.__dict__.copy()
+        state.pop('lg', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.configure_logger()
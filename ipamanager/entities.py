@@ -8,6 +8,7 @@ FreeIPA Manager - entity module
 Object representations of the entities configured in FreeIPA.
 """
 
+import itertools
 import os
 import re
 import voluptuous
@@ -30,6 +31,11 @@ class FreeIPAEntity(FreeIPAManagerCore):
     key_mapping = {}  # attribute name mapping between local config and FreeIPA
     ignored = []  # list of ignored entities for each entity type
     allowed_members = []
+    # prefixes of membership attributes used when loaded from FreeIPA
+    ipa_member_prefixes = ('member_', 'memberof_')
+    ipa_extra_attributes = []  # other used attributes loaded from FreeIPA
+    # attributes referencing other entities (attribute -> entity type)
+    ipa_references = {}
 
     def __init__(self, name, data, path=None):
         """
@@ -163,6 +169,12 @@ class FreeIPAEntity(FreeIPAManagerCore):
             self.data_repo['memberOf'] = memberof
 
     def write_to_file(self):
+        """
+        Write the entity into its config file.
+        :returns: number of bytes written
+        :rtype: int
+        :raises ConfigError: if the file cannot be written
+        """
         if not self.path:
             raise ManagerError(
                 '%s has no file path, nowhere to write.' % repr(self))
@@ -177,6 +189,7 @@ class FreeIPAEntity(FreeIPAManagerCore):
                 yaml.dump(data, stream=target, Dumper=EntityDumper,
                           default_flow_style=False, explicit_start=True)
                 self.lg.debug('%s written to file', repr(self))
+                return target.tell()
         except (IOError, OSError, yaml.YAMLError) as e:
             raise ConfigError(
                 'Cannot write %s to %s: %s' % (repr(self), self.path, e))
@@ -192,6 +205,36 @@ class FreeIPAEntity(FreeIPAManagerCore):
             raise ConfigError(
                 'Cannot delete %s at %s: %s' % (repr(self), self.path, e))
 
+    @classmethod
+    def ipa_attributes(cls):
+        """
+        Return attributes of entities loaded from FreeIPA that are used
+        by the tool (not including membership attributes, which are
+        recognized by the `ipa_member_prefixes` instead).
+        :returns: set of lowercase attribute names
+        :rtype: set(str)
+        """
+        pull = cls.managed_attributes_pull
+        if isinstance(pull, property):  # not overridden, same as push
+            pull = cls.managed_attributes_push
+        return set(attr.lower() for attr in itertools.chain(
+            [cls.entity_id_type], pull, cls.managed_attributes_push,
+            cls.ipa_extra_attributes))
+
+    @classmethod
+    def prune_ipa_data(cls, data):
+        """
+        Remove attributes not used by the tool from data loaded
+        from FreeIPA, so that they are not kept in memory.
+        :param dict data: entity data as returned by FreeIPA API
+        :returns: data with used attributes only
+        :rtype: dict
+        """
+        attributes = cls.ipa_attributes()
+        return dict((key, value) for key, value in data.iteritems()
+                    if key in attributes or
+                    key.startswith(cls.ipa_member_prefixes))
+
     @staticmethod
     def get_entity_class(name):
         for entity_class in [
@@ -283,6 +326,7 @@ class FreeIPAUserGroup(FreeIPAGroup):
     """Representation of a FreeIPA user group entity."""
     entity_name = 'group'
     managed_attributes_pull = ['description', 'posix']
+    ipa_extra_attributes = ['objectclass']
     allowed_members = ['user', 'group']
     validation_schema = voluptuous.Schema(schemas.schema_usergroups)
 
@@ -357,6 +401,7 @@ class FreeIPAUser(FreeIPAEntity):
     entity_id_type = 'uid'
     managed_attributes_push = ['givenName', 'sn', 'initials', 'mail',
                                'ou', 'manager', 'carLicense', 'title']
+    ipa_references = {'manager': 'user'}
     key_mapping = {
         'emailAddress': 'mail',
         'firstName': 'givenName',
@@ -369,6 +414,7 @@ class FreeIPAUser(FreeIPAEntity):
 
 class FreeIPARule(FreeIPAEntity):
     """Abstract class covering HBAC and sudo rules."""
+    ipa_member_prefixes = ('memberhost_', 'memberuser_', 'memberservice_')
 
     def create_commands(self, remote_entity=None):
         """
@@ -590,7 +636,7 @@ class FreeIPAService(FreeIPAEntity):
         path, file_name = os.path.split(self.path)
         service_name, _ = file_name.split('@')
         self.path = ('%s-%s.yaml' % (path, service_name.replace('.', '_')))
-        super(FreeIPAService, self).write_to_file()
+        return super(FreeIPAService, self).write_to_file()
 
 
 class EntityDumper(yaml.SafeDumper):
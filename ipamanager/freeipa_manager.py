@@ -14,12 +14,15 @@ import logging
 import sys
 
 import utils
+from cache import DEFAULT_CACHE_DIR
 from core import FreeIPAManagerCore
 from config_loader import ConfigLoader
 from difference import FreeIPADifference
 from errors import ManagerError
 from integrity_checker import IntegrityChecker
+from metrics import Metrics
 from template import FreeIPATemplate, ConfigTemplateLoader
+from tracing import DEFAULT_SLOW_CALL_THRESHOLD, Tracer
 
 
 class FreeIPAManager(FreeIPAManagerCore):
@@ -31,12 +34,20 @@ class FreeIPAManager(FreeIPAManagerCore):
         self.args = utils.parse_args()
         super(FreeIPAManager, self).__init__()
         utils.init_logging(self.args.loglevel)
-        self._load_settings()
+        self.metrics = Metrics(self.args.action)
+        if self.args.profile:
+            from profiling import PhaseProfiler
+            self.metrics.profiler = PhaseProfiler(self.args.profile)
+        with self.metrics.phase('settings'):
+            self._load_settings()
+        self.metrics.tracer = Tracer(self.args.trace, self.settings.get(
+            'slow-call-threshold', DEFAULT_SLOW_CALL_THRESHOLD))
 
     def run(self):
         """
         Execute the task selected by arguments (check config, upload etc).
         """
+        success = False
         try:
             self._register_alerting()
             {
@@ -47,10 +58,13 @@ class FreeIPAManager(FreeIPAManagerCore):
                 'template': self.template,
                 'roundtrip': self.roundtrip
             }[self.args.action]()
+            success = True
         except ManagerError as e:
             self.lg.error(e)
             sys.exit(1)
         finally:
+            self.metrics.tracer.close()
+            self._write_metrics(success)
             for plugin in self.alerting_plugins:
                 plugin.dispatch()
 
@@ -84,15 +98,38 @@ class FreeIPAManager(FreeIPAManagerCore):
         self.lg.debug('Registered %d alerting plugins',
                       len(self.alerting_plugins))
 
+    def _write_metrics(self, success):
+        """
+        Write metrics of the run into the stats file and/or
+        the Prometheus textfile and phase profiles into the profile
+        directory (if set by arguments). Failure to write
+        the metrics is logged, but does not change the result of the run.
+        :param bool success: whether the run finished successfully
+        """
+        self.metrics.finish(success)
+        try:
+            if self.args.stats:
+                self.metrics.write_json(self.args.stats)
+            if self.args.prometheus:
+                self.metrics.write_prometheus(self.args.prometheus)
+            if self.metrics.profiler:
+                self.metrics.profiler.write()
+        except ManagerError as e:
+            self.lg.error(e)
+
     def load(self, apply_ignored=True):
         """
         Load configurations from configuration repository at the given path.
         :param bool apply_ignored: whether 'ignored' seetings
                                    should be taken into account
         """
+        cache_dir = None if self.args.no_cache else DEFAULT_CACHE_DIR
         self.config_loader = ConfigLoader(
-            self.args.config, self.settings, apply_ignored)
-        self.entities = self.config_loader.load()
+            self.args.config, self.settings, apply_ignored,
+            self.args.workers, cache_dir, self.args.since, self.args.state,
+            self.args.revision, metrics=self.metrics)
+        with self.metrics.phase('load'):
+            self.entities = self.config_loader.load()
 
     def check(self):
         """
@@ -102,7 +139,8 @@ class FreeIPAManager(FreeIPAManagerCore):
         """
         self.load()
         self.integrity_checker = IntegrityChecker(self.entities, self.settings)
-        self.integrity_checker.check()
+        with self.metrics.phase('check'):
+            self.integrity_checker.check()
 
     def push(self):
         """
@@ -110,17 +148,27 @@ class FreeIPAManager(FreeIPAManagerCore):
         This can only be run locally on FreeIPA nodes.
         Arguments to the IpaConnector instance
         are passed from `self.args` in the `_api_connect` method.
+        With `--apply-plan`, commands are taken from the saved plan file
+        and the configuration is not loaded; with `--resume`, commands
+        executed according to the journal are skipped.
         :raises ConfigError: in case of configuration syntax errors
         :raises IntegrityError: in case of config entity integrity violations
         :raises ManagerError: in case of API connection error or update error
         """
-        self.check()
+        if self.args.apply_plan:  # commands are taken from the plan file
+            self.entities = dict()
+        else:
+            self.check()
         from ipa_connector import IpaUploader
         utils.init_api_connection(self.args.loglevel)
         self.uploader = IpaUploader(
             self.settings, self.entities, self.args.threshold,
-            self.args.force, self.args.deletion)
-        self.uploader.push()
+            self.args.force, self.args.deletion, metrics=self.metrics)
+        if self.args.apply_plan:
+            self.uploader.apply_plan(
+                self.args.apply_plan, self.args.journal, self.args.resume)
+        else:
+            self.uploader.push(self.args.save_plan, self.args.journal)
 
     def pull(self):
         """
@@ -137,7 +185,8 @@ class FreeIPAManager(FreeIPAManagerCore):
         utils.init_api_connection(self.args.loglevel)
         self.downloader = IpaDownloader(
             self.settings, self.entities, self.args.config,
-            self.args.dry_run, self.args.add_only, self.args.pull_types)
+            self.args.dry_run, self.args.add_only, self.args.pull_types,
+            metrics=self.metrics)
         self.downloader.pull()
 
     def diff(self):
@@ -173,11 +222,13 @@ class FreeIPAManager(FreeIPAManagerCore):
         if self.args.no_ignored:
             self.lg.info('Loading ALL entities because of --no-ignored flag')
         self.load(apply_ignored=not self.args.no_ignored)
-        for entity_type, entity_list in self.entities.iteritems():
-            self.lg.info('Re-writing %s entities to file', entity_type)
-            for e in entity_list.itervalues():
-                e.normalize()
-                e.write_to_file()
+        with self.metrics.phase('write'):
+            for entity_type, entity_list in self.entities.iteritems():
+                self.lg.info('Re-writing %s entities to file', entity_type)
+                for e in entity_list.itervalues():
+                    e.normalize()
+                    self.metrics.count('bytes_written', e.write_to_file())
+                self.metrics.count('files_written', len(entity_list))
         self.lg.info('Entity round-trip complete')
 
     def _load_settings(self):
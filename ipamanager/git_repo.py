@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - git repository module
+
+Access to git metadata & objects of the config repository,
+used for incremental loading of configuration and for loading
+configuration of a given revision directly from git objects.
+"""
+
+from subprocess import Popen, PIPE
+
+from core import FreeIPAManagerCore
+from errors import ConfigError
+
+
+class GitRepo(FreeIPAManagerCore):
+    """
+    Git repository containing the configuration. All paths are relative
+    to the given path, which can also be a subdirectory of the repository.
+    """
+    def __init__(self, path):
+        """
+        :param str path: path to the config repository
+        """
+        super(GitRepo, self).__init__()
+        self.path = path
+        self.batch = None
+
+    def _run(self, *args):
+        """
+        Run a git command in the repository.
+        :param str args: git command arguments
+        :returns: command output
+        :rtype: str
+        :raises ConfigError: if the command fails
+        """
+        self.lg.debug('Running git %s', ' '.join(args))
+        try:
+            sp = Popen(('git',) + args, cwd=self.path,
+                       stdout=PIPE, stderr=PIPE)
+            out, err = sp.communicate()
+        except OSError as e:
+            raise ConfigError('Cannot run git: %s' % e)
+        if sp.returncode:
+            raise ConfigError('git %s failed: %s' % (args[0], err.strip()))
+        return out
+
+    def resolve(self, revision):
+        """
+        Resolve a revision (branch, tag, commit...) to a commit hash.
+        :param str revision: revision to resolve
+        :returns: commit hash
+        :rtype: str
+        """
+        return self._run(
+            'rev-parse', '--verify', '%s^{commit}' % revision).strip()
+
+    def changed_files(self, revision):
+        """
+        List files in which the working tree differs from the revision,
+        including untracked files, but not files ignored by git (e.g.,
+        editor swap files or the saved state file). Renames are reported
+        as a deletion of the old path & an addition of the new path.
+        :param str revision: revision to compare the working tree with
+        :returns: paths of added, modified, deleted & untracked files
+        :rtype: set(str)
+        """
+        changed = self._run('diff', '--name-only', '--no-renames',
+                            '--relative', '-z', revision, '--')
+        untracked = self._run(
+            'ls-files', '--others', '--exclude-standard', '-z')
+        return set(i for i in (changed + untracked).split('\0') if i)
+
+    def prefix(self):
+        """
+        Get the path of the config repository within the git repository.
+        :returns: path prefix ('' or a path ending with a slash)
+        :rtype: str
+        """
+        return self._run('rev-parse', '--show-prefix').strip()
+
+    def read_object(self, name):
+        """
+        Read an object from the git object store. Objects are read using
+        a single long-lived `git cat-file --batch` process.
+        :param str name: object name (hash, or `revision:path` for objects
+                         contained in a tree of a revision)
+        :returns: (object hash, object type, contents) or None if the object
+                  does not exist
+        :rtype: (str, str, str)
+        :raises ConfigError: if the object cannot be read
+        """
+        if not self.batch:
+            try:
+                self.batch = Popen(('git', 'cat-file', '--batch'),
+                                   cwd=self.path, stdin=PIPE, stdout=PIPE,
+                                   stderr=PIPE)
+            except OSError as e:
+                raise ConfigError('Cannot run git: %s' % e)
+        try:
+            self.batch.stdin.write('%s\n' % name)
+            self.batch.stdin.flush()
+        except IOError:  # the process has failed, error read below
+            pass
+        header = self.batch.stdout.readline()
+        if not header:
+            err = self.batch.stderr.read().strip()
+            self.close()
+            raise ConfigError('git cat-file failed: %s' % err)
+        if header.endswith((' missing\n', ' ambiguous\n')):
+            return None
+        obj_hash, obj_type, size = header.split()
+        contents = self.batch.stdout.read(int(size))
+        self.batch.stdout.read(1)  # newline following the contents
+        return obj_hash, obj_type, contents
+
+    def list_tree(self, name):
+        """
+        List entries of a git tree object.
+        :param str name: tree object name (e.g., `revision:path/to/dir`)
+        :returns: (mode, file name, object hash) list of entries or None
+                  if the tree does not exist
+        :rtype: [(str, str, str)]
+        """
+        obj = self.read_object(name)
+        if not obj or obj[1] != 'tree':
+            return None
+        contents = obj[2]
+        entries = []
+        pos = 0
+        while pos < len(contents):
+            space = contents.index(' ', pos)
+            end = contents.index('\0', space)
+            obj_hash = contents[end + 1:end + 21].encode('hex')
+            entries.append(
+                (contents[pos:space], contents[space + 1:end], obj_hash))
+            pos = end + 21
+        return entries
+
+    def close(self):
+        """
+        Stop the object reading process (if running).
+        """
+        if self.batch:
+            self.batch.stdin.close()
+            self.batch.wait()
+            self.batch = None
@@ -8,6 +8,8 @@ FreeIPA Manager - integrity checking module
 Tools for checking integrity of entity configurations.
 """
 
+import collections
+
 import entities
 from core import FreeIPAManagerCore
 from errors import IntegrityError
@@ -26,6 +28,11 @@ class IntegrityChecker(FreeIPAManagerCore):
         self.user_group_regex = settings.get('user-group-pattern')
         self.nesting_limit = settings.get('nesting-limit')
         self.nesting = {'group': dict(), 'hostgroup': dict()}
+        self.cycles = dict()
+        self.errs = dict()
+        # dependency index, built by a full check; key: (entity type, name)
+        self.references = None  # value: set of (referenced key, transitive)
+        self.dependents = None  # value: set of (dependent key, transitive)
 
     def check(self):
         """
@@ -38,11 +45,66 @@ class IntegrityChecker(FreeIPAManagerCore):
             return
         self.lg.info('Running integrity check')
         self.errs = dict()  # key: (entity type, name), value: error list
+        self._index_dependencies()
+        self.cycles = self._find_cycles()
+        if self.nesting_limit:
+            self.nesting = self._compute_nesting()
 
         for entity_type in sorted(self.entity_dict):
             self.lg.debug('Checking %s entities', entity_type)
             for entity in self.entity_dict[entity_type].itervalues():
                 self._check_single(entity)
+        self._report()
+
+    def check_changed(self, changed_keys):
+        """
+        Re-run the integrity check after some entities have changed,
+        checking only the entities whose validity can be affected by
+        the change. The `entity_dict` attribute must already contain
+        the new entities (added & modified entities with their new data,
+        without the removed entities). The errors reported are the same
+        as a full check of the new configuration would report.
+        Runs the full check if no full check has been run before.
+        :param changed_keys: (entity type, name) keys of added, modified
+                             & removed entities
+        :raises IntegrityError: if there is a problem with config integrity
+        :returns: None (everything correct if no error is raised)
+        """
+        if self.references is None:
+            return self.check()
+        changed_keys = set(changed_keys)
+        self.lg.info('Running integrity check of %d changed entities',
+                     len(changed_keys))
+        for key in changed_keys:
+            self._unindex_entity(key)
+            entity = self._find_entity(*key)
+            if entity:
+                self._index_entity(entity)
+        affected = self._affected_closure(changed_keys)
+        self.lg.debug('%d entities affected by the change', len(affected))
+        roots = dict()
+        for key in affected:
+            self.errs.pop(key, None)
+            self.cycles.pop(key, None)
+            if key[0] in self.nesting:
+                self.nesting[key[0]].pop(key[1], None)
+            roots.setdefault(key[0], set()).add(key[1])
+        self.cycles.update(self._find_cycles(roots))
+        if self.nesting_limit:
+            for entity_type, levels in self._compute_nesting(
+                    roots).iteritems():
+                self.nesting[entity_type].update(levels)
+        for key in sorted(affected):
+            entity = self._find_entity(*key)
+            if entity:
+                self._check_single(entity)
+        self._report()
+
+    def _report(self):
+        """
+        Report the result of an integrity check.
+        :raises IntegrityError: if there were any integrity errors
+        """
         if self.errs:
             raise IntegrityError(
                 'There were %d integrity errors in %d entities' %
@@ -141,9 +203,8 @@ class IntegrityChecker(FreeIPAManagerCore):
 
         # check for nesting limit exceedance
         if isinstance(entity, entities.FreeIPAGroup) and self.nesting_limit:
-            nesting = self._check_nesting_level(
-                entity.entity_name, entity.name)
-            if nesting > self.nesting_limit:
+            nesting = self.nesting[entity.entity_name].get(entity.name)
+            if nesting is not None and nesting > self.nesting_limit:
                 errs.append('Nesting level exceeded: %d > %d'
                             % (nesting, self.nesting_limit))
         return errs
@@ -166,62 +227,323 @@ class IntegrityChecker(FreeIPAManagerCore):
             raise IntegrityError('%s can only have members of type %s'
                                  % (target, target.allowed_members))
 
+    def _index_dependencies(self):
+        """
+        Build the index of dependencies among entities used for finding
+        entities affected by a change in `check_changed`.
+        """
+        self.references = dict()
+        self.dependents = collections.defaultdict(set)
+        for type_entities in self.entity_dict.itervalues():
+            for entity in type_entities.itervalues():
+                self._index_entity(entity)
+
+    def _index_entity(self, entity):
+        """
+        Add references of an entity to the dependency index. An entity
+        references entities whose existence or properties its check uses
+        (membership targets, manager, rule members). A membership among
+        entities of the same type is transitive (the cycle & nesting level
+        checks of an entity depend on all entities it is a member of).
+        :param FreeIPAEntity entity: entity to index
+        """
+        key = (entity.entity_name, entity.name)
+        refs = set()
+        if isinstance(entity, entities.FreeIPARule):
+            for attr, member_type in [('memberHost', 'hostgroup'),
+                                      ('memberService', 'hbacsvc'),
+                                      ('memberUser', 'group')]:
+                for name in entity.data_repo.get(attr, []):
+                    refs.add(((member_type, name), False))
+        else:
+            member_of = entity.data_repo.get('memberOf', dict())
+            for target_type, targets in member_of.iteritems():
+                for name in targets:
+                    refs.add(((target_type, name),
+                              target_type == entity.entity_name))
+            manager = entity.data_repo.get('manager')
+            if isinstance(entity, entities.FreeIPAUser) and manager:
+                refs.add((('user', manager), False))
+        self.references[key] = refs
+        for target, transitive in refs:
+            self.dependents[target].add((key, transitive))
+
+    def _unindex_entity(self, key):
+        """
+        Remove references of an entity from the dependency index.
+        :param tuple key: (entity type, name) key of the entity
+        """
+        for target, transitive in self.references.pop(key, ()):
+            self.dependents[target].discard((key, transitive))
+
+    def _affected_closure(self, changed_keys):
+        """
+        Find entities whose check result can be affected by a change
+        of the given entities: the entities themselves, entities directly
+        referencing them and entities transitively members of them.
+        As the index is already updated, a reference that has changed
+        is a reference of a changed entity, which is checked anyway.
+        :param set changed_keys: keys of changed entities
+        :returns: keys of affected entities
+        :rtype: set
+        """
+        affected = set(changed_keys)
+        queue = collections.deque(changed_keys)
+        transitive_keys = set()
+        while queue:
+            key = queue.popleft()
+            for dependent, transitive in self.dependents.get(key, ()):
+                if key in changed_keys or transitive:
+                    affected.add(dependent)
+                if transitive and dependent not in transitive_keys:
+                    transitive_keys.add(dependent)
+                    queue.append(dependent)
+        return affected
+
     def _check_cycles(self, entity):
         """
-        Check if there is a membership cycle in the config starting at entity.
-        Only called on groups as no other entities can have cyclic membership.
-        :param FreeIPAGroup entity: entity (group) to begin checking at
+        Check if the entity is a part of a membership cycle.
+        Cycles are found for all entities at once by `_find_cycles`.
+        :param FreeIPAEntity entity: entity to check
         :returns: cyclic membership entity list if found, else None
         """
-        self.lg.debug(
-            'Running cycles check for %s %s', entity.entity_name, entity.name)
-        stack = [(entity, [])]
-        visited = set()
-        while stack:
-            current, path = stack.pop()
-            visited.add(current)
-            path.append(current)
-            member_of = current.data_repo.get('memberOf', dict())
-            for item in member_of.get(current.entity_name, []):
-                target = self._find_entity(current.entity_name, item)
-                if not target:  # non-existent entity
-                    continue
-                if target == entity:  # cycle found
-                    return path
-                if target not in visited:
-                    stack.append((target, path))
-
-    def _check_nesting_level(self, entity_type, name):
-        """
-        Check the level of entity's membership nesting.
-        Only checked if the nesting-level value is defined in the settings.
-        The `nesting` attribute is used for storing intermediate results
-        during recursive evaluation of depth of groups so that no single group
-        needs to be calculated more than once. This method does not take care
-        of membership cycles since it's only called after the cycles check.
-        :param str entity_type: entity type name (group/hostgroup)
-        :param str name: entity name
-        :returns: maximum depth of nesting
-        """
-        self.lg.debug('Checking nesting level for %s %s', entity_type, name)
-        result = self.nesting.get(entity_type, {}).get(name)
-        if result:  # calculated as part of other entity's evaluation
-            self.lg.debug('Returning cached nesting level for %s %s (%d)',
-                          entity_type, name, result)
-            return result
-        entity = self._find_entity(entity_type, name)
-        # memberOf format is a dict of lists; find the right values safely
-        memberof = entity.data_repo.get('memberOf', dict())
-        targets = memberof.get(entity_type, [])
-        if not targets:
-            result = 0
+        return self.cycles.get((entity.entity_name, entity.name))
+
+    def _find_cycles(self, roots=None):
+        """
+        Find membership cycles among entities of each type (only membership
+        of entities of the same type, like group in group, can be cyclic).
+        Strongly connected components of the membership graph are found
+        in a single linear pass; each entity in a component of more than
+        one entity (or a member of itself) is a part of a cycle. Cycle
+        paths are then searched for within the component only.
+        :param dict roots: if given, only cycles of these entities (names
+                           keyed by entity type) and of entities that they
+                           are (transitively) members of are found
+        :returns: dictionary of cycle paths (lists of entities starting
+                  at the entity) keyed by (entity type, name)
+        :rtype: dict
+        """
+        cycles = dict()
+        for entity_type, type_entities in self.entity_dict.iteritems():
+            if roots is None:
+                graph = self._membership_graph(entity_type)
+            else:
+                graph = self._membership_graph(
+                    entity_type, roots.get(entity_type, ()))
+            for component in strongly_connected_components(graph):
+                if len(component) > 1:
+                    paths = _cycle_paths(graph, component)
+                else:
+                    name = next(iter(component))
+                    if name not in graph[name]:  # not a member of itself
+                        continue
+                    paths = {name: [name]}
+                self.lg.debug('Found %s membership cycle of %d entities',
+                              entity_type, len(component))
+                for name, path in paths.iteritems():
+                    cycles[(entity_type, name)] = [
+                        type_entities[i] for i in path]
+        return cycles
+
+    def _compute_nesting(self, roots=None):
+        """
+        Compute the level of membership nesting of all groups & hostgroups
+        in a single iterative pass over the membership graph in topological
+        order (starting from entities that are not members of any entity
+        of the same type), so that no entity is evaluated more than once.
+        Entities that are a part of a membership cycle or are members
+        of such entities have no nesting level (they are reported
+        by the cycles check instead).
+        :param dict roots: if given, only levels of these entities (names
+                           keyed by entity type) and of entities that they
+                           are (transitively) members of are computed
+        :returns: nesting levels keyed by entity type & name
+        :rtype: dict
+        """
+        nesting = dict()
+        for entity_type in ('group', 'hostgroup'):
+            if roots is None:
+                graph = self._membership_graph(entity_type)
+            else:
+                graph = self._membership_graph(
+                    entity_type, roots.get(entity_type, ()))
+            members = dict((name, []) for name in graph)
+            for name, targets in graph.iteritems():
+                for target in targets:
+                    members[target].append(name)
+            remaining = dict(
+                (name, len(targets)) for name, targets in graph.iteritems())
+            levels = dict(
+                (name, 0) for name, count in remaining.iteritems()
+                if not count)
+            # levels of entities not all of whose targets were evaluated yet
+            partial = dict()
+            queue = collections.deque(levels)
+            while queue:
+                target = queue.popleft()
+                for name in members[target]:
+                    partial[name] = max(
+                        partial.get(name, 0), levels[target] + 1)
+                    remaining[name] -= 1
+                    if not remaining[name]:
+                        levels[name] = partial.pop(name)
+                        queue.append(name)
+            self.lg.debug('Computed nesting levels of %d %s entities',
+                          len(levels), entity_type)
+            nesting[entity_type] = levels
+        return nesting
+
+    def _membership_graph(self, entity_type, roots=None):
+        """
+        Build the graph of membership among entities of the given type.
+        :param str entity_type: entity type name
+        :param roots: if given, the graph only contains these entities
+                      and entities reachable from them
+        :returns: adjacency lists (names of existing entities of the same
+                  type that the entity is a member of) keyed by entity name
+        :rtype: dict
+        """
+        type_entities = self.entity_dict.get(entity_type, dict())
+        if roots is None:
+            queue = list(type_entities)
         else:
-            result = max(self._check_nesting_level(entity_type, target)
-                         for target in targets) + 1
-        self.nesting[entity_type][name] = result
-        self.lg.debug('Nesting level of %s %s is %d',
-                      entity_type, name, result)
-        return result
+            queue = [name for name in roots if name in type_entities]
+        graph = dict()
+        while queue:
+            name = queue.pop()
+            if name in graph:
+                continue
+            member_of = type_entities[name].data_repo.get('memberOf', dict())
+            graph[name] = [target for target in member_of.get(
+                entity_type, []) if target in type_entities]
+            if roots is not None:
+                queue.extend(graph[name])
+        return graph
 
     def _find_entity(self, entity_type, name):
         return find_entity(self.entity_dict, entity_type, name)
+
+
+def strongly_connected_components(graph):
+    """
+    Find strongly connected components of a directed graph using
+    an iterative version of Tarjan's algorithm (in linear time,
+    without recursion, so that large graphs can be processed).
+    :param dict graph: adjacency lists of the graph (node -> successors)
+    :returns: list of components (sets of nodes)
+    :rtype: [set]
+    """
+    index = dict()
+    lowlink = dict()
+    stack = []
+    on_stack = set()
+    components = []
+    for root in sorted(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph[succ])))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:  # all successors processed
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def _cycle_paths(graph, component):
+    """
+    Find a cycle path for each node of a strongly connected component.
+    Shortest paths from all nodes to a root node of the component and
+    from the root node to all nodes are found (by a breadth-first search
+    in both directions); the cycle of each node is then a path to the root
+    followed by a path back, with any repeated sections removed.
+    :param dict graph: adjacency lists of the graph
+    :param set component: strongly connected component (of 2+ nodes)
+    :returns: dictionary of cycle paths (lists of nodes beginning
+              with the node) keyed by node
+    :rtype: dict
+    """
+    root = min(component)
+    reverse = dict((node, []) for node in component)
+    for node in sorted(component):
+        for succ in graph[node]:
+            if succ in component:
+                reverse[succ].append(node)
+    parents = _bfs_tree(graph, root, component)  # paths from root
+    successors = _bfs_tree(reverse, root, component)  # paths to root
+    paths = dict()
+    for start in component:
+        if start == root:  # cycle closed by the nearest predecessor
+            last = next(node for node in parents if root in graph[node])
+        else:
+            last = parents[start]
+        walk = (_tree_path(successors, start)[:-1] +
+                _tree_path(parents, last)[::-1])
+        path = []
+        positions = dict()
+        for node in walk:
+            if node in positions:  # remove the section repeating the node
+                for removed in path[positions[node] + 1:]:
+                    del positions[removed]
+                del path[positions[node] + 1:]
+            else:
+                positions[node] = len(path)
+                path.append(node)
+        paths[start] = path
+    return paths
+
+
+def _bfs_tree(graph, root, component):
+    """
+    Find shortest paths from the root to all nodes of the component.
+    :returns: parent of each node on its path from the root
+              (in the order in which the nodes were found)
+    :rtype: collections.OrderedDict
+    """
+    parents = collections.OrderedDict([(root, None)])
+    queue = collections.deque([root])
+    while queue:
+        node = queue.popleft()
+        for succ in graph[node]:
+            if succ in component and succ not in parents:
+                parents[succ] = node
+                queue.append(succ)
+    return parents
+
+
+def _tree_path(parents, node):
+    """
+    Get the path from the node to the root of a tree.
+    :param dict parents: parent of each node of the tree
+    :param str node: node to start at
+    :returns: path (list of nodes beginning with the node)
+    """
+    path = [node]
+    while parents[node] is not None:
+        node = parents[node]
+        path.append(node)
+    return path
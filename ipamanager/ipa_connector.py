@@ -9,27 +9,48 @@ Tool for updating a FreeIPA server via API
 from local entity configuration.
 """
 
+import collections
+import hashlib
+import json
 import re
 import os
+import threading
 from ipalib import api
+from Queue import Empty, Queue
 
 import entities
 from command import Command
 from core import FreeIPAManagerCore
 from entities import FreeIPAEntity
 from errors import CommandError, ConfigError, ManagerError
+from journal import PushJournal, plan_hash
+from metrics import Metrics
 from utils import ENTITY_CLASSES, check_ignored
 
 
+# bump when the format of saved push plans changes
+PLAN_FORMAT = 1
+
+
 class IpaConnector(FreeIPAManagerCore):
     """
     Responsible for updating FreeIPA server with changed configuration.
     """
-    def __init__(self, parsed, settings):
+    def __init__(self, parsed, settings, ipa_api=None, metrics=None):
+        """
+        :param dict parsed: dictionary of entities from `IntegrityChecker`
+        :param dict settings: parsed contents of the settings file
+        :param ipa_api: FreeIPA API object to use (`ipalib.api` if None)
+        :param Metrics metrics: metrics to record phases & counters into
+        """
         super(IpaConnector, self).__init__()
+        self.api = api if ipa_api is None else ipa_api
+        self.metrics = Metrics() if metrics is None else metrics
         self.ignored = settings.get('ignore', dict())
+        self.api_workers = settings.get('api-workers', 1)
         self.repo_entities = parsed
         self.ipa_entities = dict()
+        self.ipa_memberships = None
 
     def load_ipa_entities(self):
         """
@@ -37,42 +58,241 @@ class IpaConnector(FreeIPAManagerCore):
         Entity data is saved in `self.ipa_entities` nested dictionary
         with top-level keys being entity types (e.g., 'hostgroup')
         and bottom-level keys being entity names (e.g., 'group-one').
+        Entities of different types are fetched concurrently by up to
+        `api_workers` threads (each using its own API connection), while
+        the already fetched entities are being parsed.
         :raises ManagerError: if there is an error communicating with the API
         :returns: None (entities saved in the `self.ipa_entities` dict)
         """
         self.lg.info('Loading entities from FreeIPA API')
-        for entity_class in ENTITY_CLASSES:
-            entity_type = entity_class.entity_name
-            self.ipa_entities[entity_type] = dict()
-            command = '%s_find' % entity_type
-            self.lg.debug('Running API command %s', command)
-            try:
-                parsed = api.Command[command](all=True, sizelimit=0)
-            except KeyError:
-                raise ManagerError('Undefined API command %s' % command)
-            except Exception as e:
-                raise ManagerError('Error loading %s entities from API: %s'
-                                   % (entity_type, e))
-            for data in parsed['result']:
-                name = data[entity_class.entity_id_type][0]
-                if check_ignored(entity_class, name, self.ignored):
-                    self.lg.debug(
-                        'Not parsing ignored %s %s', entity_type, name)
-                    continue
-                self.ipa_entities[entity_type][name] = entity_class(name, data)
-            self.lg.info('Parsed %d %ss', len(self.ipa_entities[entity_type]),
-                         entity_type)
-            self.lg.debug('%ss parsed: %s', entity_type,
-                          sorted(self.ipa_entities[entity_type].keys()))
+        self.ipa_entities = dict()
+        self.ipa_memberships = None
+        workers = min(self.api_workers, len(ENTITY_CLASSES))
+        if workers > 1:
+            results = self._find_concurrently(workers)
+        else:
+            results = ((cls, self._find_entities(cls))
+                       for cls in ENTITY_CLASSES)
+        for entity_class, parsed in results:
+            self._parse_entities(entity_class, parsed)
         self.ipa_entity_count = sum(
             len(i) for i in self.ipa_entities.itervalues())
+        for entity_type, loaded in self.ipa_entities.iteritems():
+            self.metrics.count('remote_entities', len(loaded), entity_type)
         self.lg.info(
             'Parsed %d entities from FreeIPA API', self.ipa_entity_count)
 
+    def _find_entities(self, entity_class, pkey_only=False):
+        """
+        Fetch all entities of the given class from the API.
+        :param type entity_class: entity class to fetch entities of
+        :param bool pkey_only: only fetch names of the entities
+        :returns: result of the API find command
+        :raises ManagerError: if there is an error communicating with the API
+                              or if the result is incomplete
+        """
+        entity_type = entity_class.entity_name
+        command = '%s_find' % entity_type
+        if pkey_only:
+            self.lg.debug('Running API command %s (pkey_only)', command)
+            options = {'pkey_only': True}
+        else:
+            load_all = self._needs_all_attributes(entity_class)
+            self.lg.debug(
+                'Running API command %s (all=%s)', command, load_all)
+            options = {'all': load_all}
+        self.metrics.count('rpc_calls')
+        try:
+            parsed = self.metrics.tracer.call(
+                self.api.Command[command], command, None,
+                sizelimit=0, **options)
+        except KeyError:
+            raise ManagerError('Undefined API command %s' % command)
+        except Exception as e:
+            raise ManagerError('Error loading %s entities from API: %s'
+                               % (entity_type, e))
+        if parsed.get('truncated'):
+            raise ManagerError('Error loading %s entities from API: '
+                               'search result truncated' % entity_type)
+        return parsed
+
+    def _needs_all_attributes(self, entity_class):
+        """
+        Check whether all attributes of entities have to be requested
+        by the find command. This is not necessary if the attributes
+        FreeIPA returns by default include all the attributes used
+        by the entity class (including membership attributes).
+        :param type entity_class: entity class to fetch entities of
+        :returns: True if all attributes should be requested
+        :rtype: bool
+        """
+        try:
+            defaults = set(attr.lower() for attr in self.api.Object[
+                entity_class.entity_name].default_attributes)
+        except Exception:  # default attributes unknown
+            return True
+        used = entity_class.ipa_attributes()
+        used.update(i.rstrip('_') for i in entity_class.ipa_member_prefixes)
+        return not used.issubset(defaults)
+
+    def _find_concurrently(self, workers):
+        """
+        Fetch entities of all types using a pool of worker threads.
+        Each worker opens its own API connection (connections are bound
+        to the thread that opened them). Results are yielded as soon as
+        they are fetched; if any fetch fails, no further fetches are
+        started and the error of the first failed type (in the order
+        of `ENTITY_CLASSES`) is raised.
+        :param int workers: number of worker threads
+        :returns: generator of (entity class, API find result) tuples
+        :raises ManagerError: if there is an error communicating with the API
+        """
+        self.lg.debug('Fetching entities using %d API workers', workers)
+        tasks = Queue()
+        for entity_class in ENTITY_CLASSES:
+            tasks.put(entity_class)
+        results = Queue()
+        failed = threading.Event()
+
+        def work():
+            try:
+                try:
+                    self.api.Backend.rpcclient.connect()
+                except Exception as e:
+                    failed.set()
+                    results.put((None, ManagerError(
+                        'Cannot connect to FreeIPA API: %s' % e)))
+                    return
+                try:
+                    while not failed.is_set():
+                        try:
+                            entity_class = tasks.get_nowait()
+                        except Empty:
+                            break
+                        try:
+                            result = self._find_entities(entity_class)
+                        except ManagerError as e:
+                            failed.set()
+                            result = e
+                        except Exception as e:  # unexpected worker error
+                            failed.set()
+                            result = ManagerError(
+                                'Error loading %s entities from API: %s'
+                                % (entity_class.entity_name, e))
+                        results.put((entity_class, result))
+                finally:
+                    self._disconnect()
+            finally:
+                results.put(None)  # worker finished
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        errs = []
+        running = workers
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item[1], ManagerError):
+                errs.append(item)
+            elif not errs:
+                yield item
+        for thread in threads:
+            thread.join()
+        if errs:
+            order = [None] + ENTITY_CLASSES
+            raise min(errs, key=lambda err: order.index(err[0]))[1]
+
+    def _disconnect(self):
+        """
+        Close the API connection of a worker thread. A failure to close
+        it is only logged, as the work of the thread is already done.
+        """
+        try:
+            self.api.Backend.rpcclient.disconnect()
+        except Exception as e:
+            self.lg.warning('Cannot disconnect from FreeIPA API: %s', e)
+
+    def _fingerprint(self, names):
+        """
+        Compute a fingerprint of the remote state from names of entities.
+        :param dict names: entity type -> names of entities of the type
+        :returns: entity type -> digest of entity names
+        :rtype: dict
+        """
+        return dict(
+            (entity_type, hashlib.sha1('\n'.join(
+                sorted(names[entity_type])).encode('utf-8')).hexdigest())
+            for entity_type in names)
+
+    def _fetch_fingerprint(self):
+        """
+        Fetch the fingerprint of the remote state (see `_fingerprint`).
+        Only names of entities are fetched, which is much cheaper
+        than loading the entities (see `load_ipa_entities`).
+        :raises ManagerError: if there is an error communicating with the API
+        """
+        names = dict()
+        for entity_class in ENTITY_CLASSES:
+            parsed = self._find_entities(entity_class, pkey_only=True)
+            names[entity_class.entity_name] = [
+                name for name in (data[entity_class.entity_id_type][0]
+                                  for data in parsed['result'])
+                if not check_ignored(entity_class, name, self.ignored)]
+        return self._fingerprint(names)
+
+    def _get_memberships(self, member_type, name):
+        """
+        Get entities loaded from FreeIPA that the given entity is a member
+        of. The membership index is built on first use after loading
+        entities, from the `member_*` attributes of the loaded entities.
+        :param str member_type: member entity type (e.g., 'user')
+        :param str name: member entity name
+        :returns: names of target entities (sets keyed by target type)
+        :rtype: dict
+        """
+        if self.ipa_memberships is None:
+            self.ipa_memberships = dict()
+            for target_type, targets in self.ipa_entities.iteritems():
+                for target in targets.itervalues():
+                    for key, members in target.data_ipa.iteritems():
+                        if not key.startswith('member_'):
+                            continue
+                        for member in members:
+                            self.ipa_memberships.setdefault(
+                                (key[len('member_'):], member), dict()
+                            ).setdefault(target_type, set()).add(target.name)
+        return self.ipa_memberships.get((member_type, name), dict())
+
+    def _parse_entities(self, entity_class, parsed):
+        """
+        Create entities of the given class from API find command result.
+        Ignored entities are skipped, attributes not used by the tool
+        are removed from entity data.
+        :param type entity_class: class of the entities
+        :param dict parsed: API find command result
+        """
+        entity_type = entity_class.entity_name
+        self.ipa_entities[entity_type] = dict()
+        for data in parsed['result']:
+            name = data[entity_class.entity_id_type][0]
+            if check_ignored(entity_class, name, self.ignored):
+                self.lg.debug(
+                    'Not parsing ignored %s %s', entity_type, name)
+                continue
+            self.ipa_entities[entity_type][name] = entity_class(
+                name, entity_class.prune_ipa_data(data))
+        self.lg.info('Parsed %d %ss', len(self.ipa_entities[entity_type]),
+                     entity_type)
+        self.lg.debug('%ss parsed: %s', entity_type,
+                      sorted(self.ipa_entities[entity_type].keys()))
+
 
 class IpaUploader(IpaConnector):
-    def __init__(self, settings, parsed, threshold,
-                 force=False, enable_deletion=False):
+    def __init__(self, settings, parsed, threshold, force=False,
+                 enable_deletion=False, ipa_api=None, metrics=None):
         """
         Initialize an IPA connector object.
         :param dict settings: parsed contents of the settings file
@@ -80,11 +300,20 @@ class IpaUploader(IpaConnector):
         :param int threshold: max percentage of entities to edit (1-100)
         :param bool force: execute changes (dry run if False)
         :param bool enable_deletion: enable deleting entities
+        :param ipa_api: FreeIPA API object to use (`ipalib.api` if None)
+        :param Metrics metrics: metrics to record phases & counters into
         """
-        super(IpaUploader, self).__init__(parsed, settings)
+        super(IpaUploader, self).__init__(parsed, settings, ipa_api, metrics)
         self.threshold = threshold
         self.force = force
         self.enable_deletion = enable_deletion
+        self.batch_size = settings.get('api-batch-size', 1)
+        self.chunk_size = settings.get('member-chunk-size', 1)
+        self.push_workers = settings.get('push-workers', 1)
+        self.journal = None
+        self.resume = False
+        # numbers of prepared commands of each type (see `_plan`)
+        self.planned = collections.Counter()
         # deletion patterns used to filter commands in add-only mode
         self.deletion_patterns = settings.get(
             'deletion-patterns',
@@ -96,9 +325,13 @@ class IpaUploader(IpaConnector):
         The commands include addition/modification/deletion of entities,
         adding/removing group/rule members and sudorule options. Deletion
         commands are only enqueued when `enable_deletion` attribute is True.
+        Commands are counted as they are prepared and the preparation
+        is aborted as soon as they exceed the threshold (see `_plan`).
+        :raises ManagerError: if the threshold is exceeded
         """
         self.lg.debug('Preparing IPA update commands')
         self.commands = []
+        self.planned = collections.Counter()
         for entity_type in self.repo_entities:
             self.lg.debug('Processing %s entities', entity_type)
             if entity_type == 'service':
@@ -118,13 +351,50 @@ class IpaUploader(IpaConnector):
         """
         if self.enable_deletion:  # all commands should be executed
             return
-        filtered_commands = []
-        for command in self.commands:
-            cmd = command.command
-            if any(re.match(regex, cmd) for regex in self.deletion_patterns):
-                continue
-            filtered_commands.append(command)
-        self.commands = filtered_commands
+        self.commands = [command for command in self.commands
+                         if not self._is_deletion(command)]
+
+    def _is_deletion(self, command):
+        """
+        Check whether the command matches any of the `deletion_patterns`.
+        :param Command command: command to check
+        :rtype: bool
+        """
+        return any(re.match(regex, command.command)
+                   for regex in self.deletion_patterns)
+
+    def _plan(self, commands):
+        """
+        Add prepared commands to the `commands` list & count those
+        that will be executed (i.e., not filtered out as deletions, see
+        `_filter_deletion_commands`) in the `planned` counter. As the count
+        can only grow during the preparation, the threshold is provably
+        exceeded once the count exceeds it (see `_check_threshold`);
+        the preparation is aborted then, with the partial counts
+        of each command type reported (and in dry-run mode, the commands
+        prepared so far listed).
+        :param [Command] commands: prepared commands
+        :raises ManagerError: if the threshold is exceeded
+        """
+        self.commands.extend(commands)
+        for command in commands:
+            if self.enable_deletion or not self._is_deletion(command):
+                self.planned[command.command] += 1
+        count = sum(self.planned.itervalues())
+        if not count or self._change_ratio(count) <= self.threshold:
+            return
+        self.lg.warning('Preparation of commands aborted after %d commands:',
+                        count)
+        for command, planned in sorted(self.planned.iteritems()):
+            self.lg.warning('- %s: %d', command, planned)
+        if not self.force:  # dry run
+            self._filter_deletion_commands()
+            self.lg.info('Would execute commands (incomplete):')
+            for command in sorted(self.commands):
+                self.lg.info('- %s', command)
+        raise ManagerError(
+            'Threshold exceeded (at least %.2f %% > %.f %%), aborting'
+            % (self._change_ratio(count), self.threshold))
 
     def _parse_entity_diff(self, entity):
         """
@@ -140,45 +410,53 @@ class IpaUploader(IpaConnector):
             self._process_membership(entity)
         commands = entity.create_commands(remote_entity)
         if commands:
-            self.commands.extend(commands)
+            self._plan(commands)
 
     def _process_membership(self, entity):
         """
         Prepare membership update commands for an entity. This has 2 phases:
         1. ensure addition to entities listed in entity's memberOf attribute
-        2. iterate over all remote entities, ensure deletion from entities that
-           have been deleted from the memberOf attribute
+        2. ensure deletion from remote entities that the entity is a member of
+           (found in the membership index) that have been deleted
+           from the memberOf attribute
         :param FreeIPAEntity entity: entity to process
         """
         self.lg.debug('Processing membership for %s', entity)
         member_of = entity.data_repo.get('memberOf', dict())
-        key = 'member_%s' % entity.entity_name
+        remote = self._get_memberships(entity.entity_name, entity.name)
         for target_type in member_of:
             for target_name in member_of[target_type]:
                 repo_group = self.repo_entities[target_type][target_name]
-                ipa_group = self.ipa_entities[target_type].get(target_name)
-                if ipa_group and entity.name in ipa_group.data_ipa.get(
-                        key, []):
+                if target_name in remote.get(target_type, ()):
                     self.lg.debug(
                         '%s already member of %s', entity, repo_group)
                     continue
                 command = '%s_add_member' % repo_group.entity_name
-                self.commands.append(
+                self._plan([
                     Command(command, {entity.entity_name: (entity.name,)},
-                            repo_group.name, repo_group.entity_id_type))
+                            repo_group.name, repo_group.entity_id_type)])
         #  here happens the deletion
         for cls in ENTITY_CLASSES:
             if entity.entity_name in cls.allowed_members:
                 target_type = cls.entity_name
-                for target in self.ipa_entities[target_type].itervalues():
-                    members = target.data_ipa.get(
-                        'member_%s' % entity.entity_name, [])
-                    if entity.name in members:
-                        if target.name not in member_of.get(target_type, []):
-                            command = '%s_remove_member' % target_type
-                            diff = {entity.entity_name: (entity.name,)}
-                            self.commands.append(
-                                Command(command, diff, target.name, 'cn'))
+                removed = remote.get(target_type, set()).difference(
+                    member_of.get(target_type, []))
+                for target_name in sorted(removed):
+                    command = '%s_remove_member' % target_type
+                    diff = {entity.entity_name: (entity.name,)}
+                    self._plan([Command(command, diff, target_name, 'cn')])
+
+    def _coalesce_commands(self):
+        """
+        Merge commands adding/removing single members (or sudorule options)
+        of the same entity into commands with lists of members,
+        split into chunks of at most `chunk_size` members.
+        """
+        count = len(self.commands)
+        self.commands = Command.coalesce(self.commands, self.chunk_size)
+        if len(self.commands) < count:
+            self.lg.info('Merged %d commands into %d commands',
+                         count, len(self.commands))
 
     def _prepare_del_commands(self):
         """
@@ -193,20 +471,155 @@ class IpaUploader(IpaConnector):
                 if name not in self.repo_entities.get(entity_type, dict()):
                     self.lg.debug('Marking %s for deletion', name)
                     command = '%s_del' % entity_type
-                    self.commands.append(
-                        Command(
-                            command, {}, name, entity_class.entity_id_type))
+                    self._plan([Command(
+                        command, {}, name, entity_class.entity_id_type)])
 
-    def push(self):
+    def push(self, plan_path=None, journal_path=None):
         """
         Execute update by running commands from the execution queue
         prepared by the `prepare_update` method.
         Commands will only be executed if their total number does not
         exceed the `threshold` attribute.
+        :param str plan_path: path to save the prepared commands to
+                              (to run them later with `apply_plan`)
+        :param str journal_path: path of the journal to record
+                                 executed commands to
         :raises ManagerError: in case of exceeded threshold/API error
         """
-        self.load_ipa_entities()
-        self._prepare_push()
+        with self.metrics.phase('remote-load'):
+            self.load_ipa_entities()
+        with self.metrics.phase('plan'):
+            self._prepare_push()
+        if plan_path:
+            self._save_plan(plan_path)
+        self._open_journal(journal_path)
+        self._push_commands()
+
+    def apply_plan(self, plan_path, journal_path=None, resume=False):
+        """
+        Execute update by running commands from a plan saved by `push`
+        instead of preparing them from local & remote entities.
+        The plan is only executed if the remote state (the names
+        of remote entities) has not changed since the plan was saved.
+        When resuming an interrupted push of the plan, the remote state
+        is not checked (it was changed by the push), commands recorded
+        as successful in the journal are skipped instead.
+        :param str plan_path: path of the saved plan
+        :param str journal_path: path of the journal to record
+                                 executed commands to
+        :param bool resume: resume the push recorded in the journal
+        :raises ManagerError: in case of invalid or outdated plan,
+                              exceeded threshold or API error
+        """
+        with self.metrics.phase('plan'):
+            self._load_plan(plan_path, check_remote=not resume)
+        self._open_journal(journal_path, resume)
+        self._push_commands()
+
+    def _save_plan(self, plan_path):
+        """
+        Save prepared commands with threshold check inputs and
+        the fingerprint of the remote state into a JSON plan file.
+        :param str plan_path: path of the plan file
+        :raises ManagerError: if the plan cannot be saved
+        """
+        names = dict((entity_type, self.ipa_entities[entity_type].keys())
+                     for entity_type in self.ipa_entities)
+        commands = self._plan_commands()
+        plan = {'format': PLAN_FORMAT, 'commands': commands,
+                'ipa-entity-count': self.ipa_entity_count,
+                'fingerprint': self._fingerprint(names)}
+        try:
+            with open(plan_path, 'w') as target:
+                json.dump(plan, target, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            raise ManagerError('Cannot save push plan: %s' % e)
+        self.lg.info('Saved plan of %d commands to %s',
+                     len(commands), plan_path)
+
+    def _plan_commands(self):
+        """
+        Serialize the prepared commands for saving them into a plan.
+        :returns: sorted serialized commands
+        :rtype: [dict]
+        """
+        return [
+            {'command': command.command, 'entity': command.entity_name,
+             'id': command.entity_id_type,
+             'payload': dict((k, v) for k, v in command.payload.iteritems()
+                             if k != command.entity_id_type)}
+            for command in sorted(self.commands)]
+
+    def _load_plan(self, plan_path, check_remote=True):
+        """
+        Load commands & threshold check inputs from a plan file
+        and check that the remote state has not changed since.
+        Deletion commands are filtered as when preparing the commands.
+        :param str plan_path: path of the plan file
+        :param bool check_remote: check the remote state fingerprint
+        :raises ManagerError: in case of invalid or outdated plan
+        """
+        self.lg.info('Loading push plan from %s', plan_path)
+        try:
+            with open(plan_path, 'r') as src:
+                plan = json.load(src)
+            if plan.get('format') != PLAN_FORMAT:
+                raise ValueError('unsupported format %s' % plan.get('format'))
+            self.commands = [
+                Command(item['command'], item['payload'], item['entity'],
+                        item['id'])
+                for item in plan['commands']]
+            self.ipa_entity_count = plan['ipa-entity-count']
+            fingerprint = plan['fingerprint']
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            raise ManagerError('Cannot load push plan: %s' % e)
+        if check_remote:
+            changed = sorted(
+                entity_type for entity_type, digest
+                in self._fetch_fingerprint().iteritems()
+                if fingerprint.get(entity_type) != digest)
+        else:
+            changed = None
+        if changed:
+            raise ManagerError(
+                'Remote entities changed since the plan was saved (%s)'
+                % ', '.join(changed))
+        self._filter_deletion_commands()
+        self.lg.info('%d commands to execute', len(self.commands))
+
+    def _open_journal(self, journal_path, resume=False):
+        """
+        Prepare the journal of executed commands for the prepared plan.
+        When resuming, commands recorded in the journal as successfully
+        executed are removed from the commands to execute.
+        :param str journal_path: path of the journal (None for no journal)
+        :param bool resume: resume the push recorded in the journal
+        :raises ManagerError: if the journal is invalid or belongs
+                              to a different plan
+        """
+        if not journal_path:
+            return
+        self.journal = PushJournal(
+            journal_path, plan_hash(self._plan_commands()))
+        self.resume = resume
+        if resume:
+            completed = self.journal.completed()
+            remaining = [command for command in self.commands
+                         if command.description not in completed]
+            self.lg.info('Resuming push, %d of %d commands already executed',
+                         len(self.commands) - len(remaining),
+                         len(self.commands))
+            self.commands = remaining
+
+    def _push_commands(self):
+        """
+        Check the threshold & execute the prepared commands
+        (or only list them in dry-run mode).
+        :raises ManagerError: in case of exceeded threshold/API error
+        """
+        for command in self.commands:
+            self.metrics.count('commands', 1, command.command)
+        self._coalesce_commands()
         if not self.commands:
             self.lg.info('FreeIPA consistent with local config, nothing to do')
             return
@@ -217,39 +630,284 @@ class IpaUploader(IpaConnector):
         self._check_threshold()
 
         if self.force:
-            # command sorting really important here for correct update!
-            for command in sorted(self.commands):
-                try:
-                    command.execute(api)
-                except CommandError as e:
-                    err = 'Error executing %s: %s' % (command.description, e)
-                    self.lg.error(err)
-                    # only added here to count the number of errors
-                    self.errs.append(err)
-
+            if self.journal:
+                self.journal.start(self.resume)
+            try:
+                # command sorting really important here for correct update!
+                with self.metrics.phase('execute'):
+                    self._execute(sorted(self.commands))
+            finally:
+                if self.journal:
+                    self.journal.close()
             if self.errs:
                 raise ManagerError(
                     'There were %d errors executing update' % len(self.errs))
 
-    def _check_threshold(self):
+    def _execute(self, commands):
+        """
+        Execute commands one by one in the given order. If `batch_size`
+        is larger than 1, commands are executed using `batch` API calls
+        instead; each batch only contains commands of the same rank,
+        so that the order of execution is the same. If `push_workers`
+        is larger than 1, commands are executed concurrently instead
+        (see `_execute_concurrently`).
+        :param [Command] commands: sorted commands to execute
+        """
+        if self.push_workers > 1 and len(commands) > 1:
+            self._execute_concurrently(commands)
+            return
+        if self.batch_size > 1:
+            batches = self._batches(commands)
+        else:
+            batches = ([command] for command in commands)
+        for batch in batches:
+            self._finished(batch, self._run(batch))
+
+    def _run(self, commands):
+        """
+        Execute commands, using a `batch` API call if there are more of them.
+        :param [Command] commands: commands to execute
+        :returns: failed commands & their errors
+        :rtype: [(Command, CommandError)]
+        """
+        self.metrics.count('rpc_calls')
+        if len(commands) > 1:
+            self.lg.debug('Executing batch of %d commands', len(commands))
+            errs = Command.execute_batch(
+                self.api, commands, self.metrics.tracer)
+            return [(command, err)
+                    for command, err in zip(commands, errs) if err]
         try:
-            abs_ratio = float(len(self.commands)) / self.ipa_entity_count
-        except ZeroDivisionError:
-            abs_ratio = 1
-        # cap change ratio to 100 % to avoid threshold issues
-        ratio = min(abs_ratio * 100, 100)
+            commands[0].execute(self.api, self.metrics.tracer)
+        except CommandError as e:
+            return [(commands[0], e)]
+        return []
+
+    def _execute_concurrently(self, commands):
+        """
+        Execute commands using a pool of `push_workers` worker threads,
+        each with its own API connection. A command is started once all
+        commands it depends on (see `_dependencies`) have finished,
+        independent commands are executed concurrently (in batches
+        of up to `batch_size` commands). As in serial execution,
+        a failed command does not prevent execution of other commands.
+        :param [Command] commands: sorted commands to execute
+        :raises ManagerError: if a worker cannot connect to the API
+                              or fails unexpectedly
+        """
+        workers = min(self.push_workers, len(commands))
+        self.lg.debug('Executing commands using %d API workers', workers)
+        dependencies = self._dependencies(commands)
+        dependents = [[] for _ in commands]
+        for i, required in enumerate(dependencies):
+            for j in required:
+                dependents[j].append(i)
+        remaining = [len(required) for required in dependencies]
+        tasks = Queue()
+        results = Queue()
+
+        def work():
+            try:
+                self.api.Backend.rpcclient.connect()
+            except Exception as e:
+                results.put(ManagerError(
+                    'Cannot connect to FreeIPA API: %s' % e))
+                return
+            try:
+                while True:
+                    batch = tasks.get()
+                    if batch is None:
+                        break
+                    try:
+                        failed = self._run([commands[i] for i in batch])
+                    except Exception as e:
+                        # unexpected error, the connection may be unusable
+                        results.put((batch, ManagerError(
+                            'Error executing commands: %s' % e)))
+                        break
+                    results.put((batch, failed))
+            finally:
+                self._disconnect()
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        pending = self._submit(tasks, [
+            i for i, required in enumerate(dependencies) if not required])
+        error = None
+        while pending:
+            item = results.get()
+            batch = None
+            if isinstance(item, tuple):
+                pending -= 1
+                batch, item = item
+            if isinstance(item, ManagerError):
+                # stop scheduling, only wait for the running commands
+                error = error or item
+                while True:
+                    try:
+                        tasks.get_nowait()
+                    except Empty:
+                        break
+                    pending -= 1
+                continue
+            failed = item
+            self._finished([commands[i] for i in batch], failed)
+            if error:
+                continue
+            ready = []
+            for i in batch:
+                for j in dependents[i]:
+                    remaining[j] -= 1
+                    if not remaining[j]:
+                        ready.append(j)
+            pending += self._submit(tasks, ready)
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+        if error:
+            raise error
+
+    def _submit(self, tasks, ready):
+        """
+        Enqueue commands ready for execution in batches of `batch_size`.
+        :param Queue tasks: queue of batches to execute
+        :param [int] ready: indices of the commands to execute
+        :returns: number of enqueued batches
+        :rtype: int
+        """
+        ready.sort()
+        size = max(self.batch_size, 1)
+        for i in range(0, len(ready), size):
+            tasks.put(ready[i:i + size])
+        return (len(ready) + size - 1) // size
+
+    @staticmethod
+    def _dependencies(commands):
+        """
+        Build the dependency graph of commands. Commands are executed
+        in the order of their ranks (creation, membership, modification,
+        removal, deletion) only with respect to commands on the same
+        entity; a membership command concerns both the target entity
+        and the members. A command setting an attribute referencing
+        another entity (see `ipa_references`, e.g., user's manager)
+        also concerns the referenced entity and, like in the serial
+        execution, waits for all commands on it that precede it
+        in the sorted order (including those of the same rank, e.g.,
+        creation of the manager).
+        :param [Command] commands: commands sorted by their rank
+        :returns: indices of commands each command depends on
+        :rtype: [set(int)]
+        """
+        dependencies = [set() for _ in commands]
+        references = dict((cls.entity_name, dict(
+            (attr.lower(), target) for attr, target
+            in cls.ipa_references.iteritems())) for cls in ENTITY_CLASSES)
+        # entity -> [rank, commands of the previous rank, of current rank]
+        layers = dict()
+        for i, command in enumerate(commands):
+            entity_type = command.command.split('_')[0]
+            keys = [(entity_type, command.entity_name)]
+            referenced = set()
+            for key, value in command.payload.iteritems():
+                if key == command.entity_id_type:
+                    continue
+                if not isinstance(value, tuple):
+                    value = (value,)
+                if command.rank in (1, 3):  # membership commands
+                    keys.extend((key, member) for member in value)
+                elif key in references.get(entity_type, ()):
+                    target_type = references[entity_type][key]
+                    referenced.update((target_type, name) for name in value)
+            keys.extend(referenced.difference(keys))
+            for key in keys:
+                layer = layers.setdefault(key, [command.rank, [], []])
+                if layer[0] != command.rank:
+                    layer[:] = [command.rank, layer[2], []]
+                dependencies[i].update(layer[1])
+                if key in referenced:
+                    dependencies[i].update(layer[2])
+                layer[2].append(i)
+        return dependencies
+
+    def _batches(self, commands):
+        """
+        Split commands into batches of at most `batch_size` commands
+        with the same rank (keeping the order of commands).
+        :param [Command] commands: sorted commands to split
+        :returns: generator of command lists
+        """
+        batch = []
+        for command in commands:
+            if batch and (len(batch) == self.batch_size or
+                          command.rank != batch[-1].rank):
+                yield batch
+                batch = []
+            batch.append(command)
+        if batch:
+            yield batch
+
+    def _finished(self, commands, failed):
+        """
+        Report errors of failed commands and record the outcome
+        of executed commands into the journal (for merged commands,
+        the outcome of each of the original commands is recorded).
+        :param [Command] commands: executed commands
+        :param [(Command, CommandError)] failed: failed commands & errors
+        """
+        errs = dict()
+        for command, err in failed:
+            for part, part_err in self._command_failed(command, err):
+                for original in part.parts:
+                    errs[original] = part_err
+        if self.journal:
+            for command in commands:
+                for part in command.parts:
+                    self.journal.record(part, errs.get(part))
+
+    def _command_failed(self, command, e):
+        # errors of merged commands are reported for each member separately
+        errs = command.member_errors(e)
+        for part, part_err in errs:
+            err = 'Error executing %s: %s' % (part.description, part_err)
+            self.lg.error(err)
+            # only added here to count the number of errors
+            self.errs.append(err)
+        return errs
+
+    def _check_threshold(self):
+        # merged commands are counted as the original single-member ones
+        count = sum(len(command.parts) for command in self.commands)
+        ratio = self._change_ratio(count)
         self.lg.debug('%d commands, %d remote entities (%.2f %%)',
-                      len(self.commands), self.ipa_entity_count, ratio)
+                      count, self.ipa_entity_count, ratio)
         if ratio > self.threshold:
             raise ManagerError(
                 'Threshold exceeded (%.2f %% > %.f %%), aborting'
                 % (ratio, self.threshold))
         self.lg.debug('Threshold check passed')
 
+    def _change_ratio(self, count):
+        """
+        Compute the ratio of the number of commands to the number
+        of remote entities, capped to 100 % to avoid threshold issues.
+        :param int count: number of commands
+        :returns: change ratio (in percent)
+        :rtype: float
+        """
+        try:
+            abs_ratio = float(count) / self.ipa_entity_count
+        except ZeroDivisionError:
+            abs_ratio = 1
+        return min(abs_ratio * 100, 100)
+
 
 class IpaDownloader(IpaConnector):
-    def __init__(self, settings, parsed, repo_path,
-                 dry_run=False, add_only=False, pull_types=['user']):
+    def __init__(self, settings, parsed, repo_path, dry_run=False,
+                 add_only=False, pull_types=['user'], ipa_api=None,
+                 metrics=None):
         """
         Initialize an IPA connector object.
         :param dict settings: parsed contents of the settings file
@@ -257,12 +915,16 @@ class IpaDownloader(IpaConnector):
         :param str repo_path: path to configuration repository
         :param bool force: execute changes (dry run if False)
         :param bool enable_deletion: enable deleting entities
+        :param ipa_api: FreeIPA API object to use (`ipalib.api` if None)
+        :param Metrics metrics: metrics to record phases & counters into
         """
-        super(IpaDownloader, self).__init__(parsed, settings)
+        super(IpaDownloader, self).__init__(
+            parsed, settings, ipa_api, metrics)
         self.basepath = repo_path
         self.dry_run = dry_run
         self.add_only = add_only
         self.pull_types = pull_types
+        self.used_filenames = dict()  # key: entity type, value: set
 
     def _prepare_pull(self):
         """
@@ -272,6 +934,7 @@ class IpaDownloader(IpaConnector):
         """
         self.to_write = []
         self.to_delete = []
+        self.used_filenames = dict()
         for type_to_pull in self.pull_types:
             self.lg.debug('Processing %s entities', type_to_pull)
             for ipa_entity in self.ipa_entities[type_to_pull].itervalues():
@@ -306,16 +969,21 @@ class IpaDownloader(IpaConnector):
         Pull configuration from FreeIPA server
         and update local configuration files to match it.
         """
-        self.load_ipa_entities()
-        self._prepare_pull()
+        with self.metrics.phase('remote-load'):
+            self.load_ipa_entities()
+        with self.metrics.phase('plan'):
+            self._prepare_pull()
         if self.dry_run:
             return
         self.lg.info('Starting entity writing')
-        for entity in self.to_write:
-            entity.write_to_file()
-        if not self.add_only:
-            for entity in self.to_delete:
-                entity.delete_file()
+        with self.metrics.phase('write'):
+            for entity in self.to_write:
+                self.metrics.count('bytes_written', entity.write_to_file())
+            self.metrics.count('files_written', len(self.to_write))
+            if not self.add_only:
+                for entity in self.to_delete:
+                    entity.delete_file()
+                self.metrics.count('files_deleted', len(self.to_delete))
         self.lg.info('Entity pulling finished.')
 
     def _update_entity_membership(self, entity):
@@ -338,14 +1006,10 @@ class IpaDownloader(IpaConnector):
             if result:
                 return result
             return None
+        remote = self._get_memberships(entity.entity_name, entity.name)
         for cls in ENTITY_CLASSES:
             if entity.entity_name in cls.allowed_members:
-                members = []
-                key = 'member_%s' % entity.entity_name
-                for ipa_entity in self.ipa_entities[
-                        cls.entity_name].itervalues():
-                    if entity.name in ipa_entity.data_ipa.get(key, []):
-                        members.append(ipa_entity.name)
+                members = remote.get(cls.entity_name)
                 if members:
                     result[cls.entity_name] = sorted(members)
         if any(result.itervalues()):
@@ -353,17 +1017,29 @@ class IpaDownloader(IpaConnector):
         return None
 
     def _generate_filename(self, entity):
+        """
+        Set the file path of an entity created from FreeIPA, derived
+        from the entity's name. The names already used by entities
+        of the same type (including the ones assigned to other new
+        entities) are kept in the `used_filenames` index.
+        :param FreeIPAEntity entity: entity to set the path of
+        :raises ConfigError: if the entity has a path or the path is used
+        """
         if entity.path:
             raise ConfigError(
                 '%s already has filepath (%s)' % (entity, entity.path))
-        used_names = [
-            os.path.relpath(i.path, self.basepath) for i
-            in self.repo_entities[entity.entity_name].itervalues()]
+        used_names = self.used_filenames.get(entity.entity_name)
+        if used_names is None:
+            used_names = set(
+                os.path.relpath(i.path, self.basepath) for i
+                in self.repo_entities[entity.entity_name].itervalues())
+            self.used_filenames[entity.entity_name] = used_names
         clean_name = entity.name
         for char in ['.', '-', ' ']:
             clean_name = clean_name.replace(char, '_')
         fname = '%ss/%s.yaml' % (entity.entity_name, clean_name)
         if fname in used_names:
             raise ConfigError('%s filename already used' % fname)
+        used_names.add(fname)
         self.lg.debug('Setting %s file path to %s', entity, fname)
         entity.path = os.path.join(self.basepath, fname)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - push journal module
+
+Journal of commands executed during push, used for resuming
+an interrupted push without preparing the commands again.
+"""
+
+import hashlib
+import json
+
+from core import FreeIPAManagerCore
+from errors import ManagerError
+
+# bump when the format of the journal changes
+JOURNAL_FORMAT = 1
+
+
+def plan_hash(commands):
+    """
+    Compute a hash identifying a list of (serialized) push commands.
+    :param list commands: serialized commands (see `IpaUploader`)
+    :returns: hex digest of the commands
+    :rtype: str
+    """
+    return hashlib.sha1(json.dumps(commands, sort_keys=True)).hexdigest()
+
+
+class PushJournal(FreeIPAManagerCore):
+    """
+    Journal file recording the outcome of each executed command.
+    The file starts with a header line identifying the executed plan,
+    followed by one JSON line per executed command.
+    """
+    def __init__(self, path, plan):
+        """
+        :param str path: path of the journal file
+        :param str plan: hash of the executed plan (see `plan_hash`)
+        """
+        super(PushJournal, self).__init__()
+        self.path = path
+        self.plan = plan
+        self.target = None
+
+    def completed(self):
+        """
+        Read descriptions of commands executed successfully according
+        to the journal. An incomplete last line (written when the push
+        was interrupted) is ignored.
+        :returns: descriptions of successfully executed commands
+        :rtype: set(str)
+        :raises ManagerError: if the journal cannot be read
+                              or belongs to a different plan
+        """
+        try:
+            with open(self.path, 'r') as src:
+                lines = src.read().splitlines()
+        except IOError as e:
+            raise ManagerError('Cannot read push journal: %s' % e)
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            header = None
+        if not isinstance(header, dict) or (
+                header.get('format') != JOURNAL_FORMAT):
+            raise ManagerError('Invalid push journal %s' % self.path)
+        if header.get('plan') != self.plan:
+            raise ManagerError(
+                'Push journal %s does not belong to the plan' % self.path)
+        result = set()
+        for i, line in enumerate(lines[1:], 2):
+            try:
+                entry = json.loads(line)
+                command = entry['command']
+            except (ValueError, KeyError, TypeError):
+                self.lg.warning('Ignoring invalid journal line %d', i)
+                continue
+            if entry.get('error') is None:
+                result.add(command)
+        self.lg.debug('%d commands completed according to journal',
+                      len(result))
+        return result
+
+    def start(self, resume=False):
+        """
+        Open the journal for recording executed commands.
+        :param bool resume: append to the existing journal
+                            (otherwise, a new journal is started)
+        :raises ManagerError: if the journal cannot be opened
+        """
+        try:
+            self.target = open(self.path, 'a' if resume else 'w')
+            if not resume:
+                self._write({'format': JOURNAL_FORMAT, 'plan': self.plan})
+        except (IOError, OSError) as e:
+            raise ManagerError('Cannot open push journal: %s' % e)
+        self.lg.debug('Recording executed commands to %s', self.path)
+
+    def record(self, command, error=None):
+        """
+        Record the outcome of an executed command. The journal is flushed
+        after each command, so that it is complete even if the push
+        is interrupted.
+        :param Command command: executed command
+        :param error: error of the command (None if successful)
+        """
+        self._write({'command': command.description,
+                     'error': None if error is None else unicode(error)})
+
+    def close(self):
+        if self.target:
+            self.target.close()
+            self.target = None
+
+    def _write(self, entry):
+        self.target.write('%s\n' % json.dumps(entry, sort_keys=True))
+        self.target.flush()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - built-in linter module
+
+A fast, single-pass alternative to yamllint for configuration files.
+
+Entity files only use a small subset of YAML (document start, block
+mappings & sequences indented by two spaces, scalars and flow sequences
+of scalars). The built-in linter recognizes files written in this
+canonical subset, which is constructed so that a file matching it
+cannot have any problems reported by yamllint with the rules used
+by `utils.run_yamllint_check`. Anything outside the subset (including
+every file with a style problem) is not judged by the built-in linter
+but checked by yamllint, so the reported problems are always the same.
+"""
+
+import re
+
+# plain scalars evaluated as booleans, forbidden by the yamllint truthy rule
+TRUTHY = frozenset([
+    'YES', 'Yes', 'yes', 'NO', 'No', 'no', 'TRUE', 'True',
+    'FALSE', 'False', 'ON', 'On', 'on', 'OFF', 'Off', 'off'])
+
+# control characters (except newline), comments & UTF-8 encoded characters
+# that YAML treats as line breaks (NEL, line & paragraph separators)
+_FORBIDDEN = re.compile(
+    r'[\x00-\x09\x0b-\x1f\x7f#]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+_KEY = re.compile(r'([A-Za-z0-9_][A-Za-z0-9_.@$+/-]*):(?: (.+))?$')
+_PLAIN = re.compile(r'[^-?:,\[\]{}&*!|>\'"%@`\s]([^:]|:(?! ))*$')
+_FLOW_ITEM = re.compile(r'[^-?:,\[\]{}&*!|>\'"%@`\s][^:,\[\]{}]*$')
+_QUOTED = re.compile(r'\'[^\']*\'$|"[^"\\]*"$')
+
+
+def is_canonical(data):
+    """
+    Check if the given file contents are written in the canonical YAML
+    subset, which guarantees that yamllint reports no problems for them.
+    The check is conservative: a negative result does not mean the file
+    has problems, only that it has to be checked by yamllint.
+    :param str data: contents of the configuration file to check
+    :returns: True if the contents are canonical, False otherwise
+    :rtype: bool
+    """
+    if not data.startswith('---\n') or not data.endswith('\n'):
+        return False
+    if data.endswith('\n\n') or _FORBIDDEN.search(data):
+        return False
+    lines = data.split('\n')[1:-1]
+    stack = []  # (indent, is sequence, set of mapping keys) per block
+    pending = None  # indentation of a key expecting a nested block
+    blank = 0
+    for line in lines:
+        if not line:
+            blank += 1
+            if blank > 2:
+                return False
+            continue
+        blank = 0
+        if line[-1] == ' ':
+            return False
+        content = line.lstrip(' ')
+        indent = len(line) - len(content)
+        is_seq = content.startswith('- ')
+        if pending is not None:
+            if indent != pending + 2:
+                return False
+            stack.append((indent, is_seq, set()))
+            pending = None
+        elif not stack:
+            if indent:
+                return False
+            stack.append((indent, is_seq, set()))
+        else:
+            while stack and stack[-1][0] > indent:
+                stack.pop()
+            if not stack or stack[-1][0] != indent or stack[-1][1] != is_seq:
+                return False
+        if is_seq:
+            if not _check_value(content[2:], flow=False):
+                return False
+            continue
+        match = _KEY.match(content)
+        if not match:
+            return False
+        key, value = match.groups()
+        if key in TRUTHY or key in stack[-1][2]:
+            return False
+        stack[-1][2].add(key)
+        if value is None:
+            pending = indent
+        elif not _check_value(value, flow=True):
+            return False
+    return bool(stack) and pending is None
+
+
+def _check_value(value, flow):
+    """
+    Check that a value is a canonical scalar (or, if `flow` is True,
+    a canonical flow sequence of scalars: `[]` or `[item, item]`).
+    :param str value: value to check
+    :param bool flow: whether a flow sequence is allowed
+    :rtype: bool
+    """
+    if flow and value.startswith('['):
+        if value == '[]':
+            return True
+        if not value.endswith(']'):
+            return False
+        for item in value[1:-1].split(', '):
+            if not _check_scalar(item, _FLOW_ITEM):
+                return False
+        return True
+    return _check_scalar(value, _PLAIN)
+
+
+def _check_scalar(value, plain_pattern):
+    if _QUOTED.match(value):
+        return True
+    if not plain_pattern.match(value) or value[-1] in ' :':
+        return False
+    return value not in TRUTHY
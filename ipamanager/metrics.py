@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - run metrics module
+
+Per-phase time & resource usage and counters of a tool run,
+written to a JSON stats file and/or a Prometheus textfile.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from core import FreeIPAManagerCore
+from errors import ManagerError
+from tracing import Tracer
+
+# bump when the format of the stats file changes
+STATS_FORMAT = 1
+PROMETHEUS_PREFIX = 'ipamanager'
+# help texts of the exported Prometheus metrics
+PROMETHEUS_HELP = {
+    'phase_wall_seconds': 'Wall time spent in the phase of the run.',
+    'phase_cpu_seconds': 'CPU time (including child processes) spent '
+                         'in the phase of the run.',
+    'phase_peak_rss_bytes': 'Peak resident set size of the process '
+                            'at the end of the phase of the run.',
+    'run_duration_seconds': 'Wall time of the whole run.',
+    'run_success': 'Whether the run finished successfully.',
+    'run_timestamp_seconds': 'Time the run finished at.'
+}
+# labels of counters counted per item (e.g., entities per entity type)
+COUNTER_LABELS = {'entities': 'type', 'remote_entities': 'type',
+                  'commands': 'command'}
+
+
+def _cpu_time():
+    # user & system time of the process & of its finished child processes
+    return sum(os.times()[:4])
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics(FreeIPAManagerCore):
+    """
+    Metrics of a run: wall time, CPU time & peak RSS of each phase
+    (e.g., config load, integrity check, remote load, push planning)
+    and counters (e.g., files parsed, entities per type, RPC calls).
+    Counters may be incremented from several threads.
+    API calls are traced by the `tracer` (see `Tracer`); phases
+    are profiled by the `profiler` if set (see `PhaseProfiler`).
+    """
+    def __init__(self, action=None):
+        """
+        :param str action: action of the run (e.g., push)
+        """
+        super(Metrics, self).__init__()
+        self.action = action
+        self.started = time.time()
+        self.finished = None
+        self.success = None
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.tracer = Tracer()
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Measure a phase of the run (as a context manager). Time of a phase
+        run several times is summed.
+        :param str name: name of the phase (e.g., load)
+        """
+        if self.profiler:
+            self.profiler.start(name)
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            yield
+        finally:
+            data = self.phases.setdefault(
+                name, {'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+            data['wall'] += time.time() - wall
+            data['cpu'] += _cpu_time() - cpu
+            data['peak_rss'] = _peak_rss()
+            self.lg.debug('Phase %s took %.3f s', name, data['wall'])
+            if self.profiler:
+                self.profiler.stop(name)
+
+    def count(self, name, value=1, item=None):
+        """
+        Increment a counter.
+        :param str name: name of the counter (e.g., rpc_calls)
+        :param int value: value to increment the counter by
+        :param str item: item counted by the counter (e.g., entity type
+                         for the entities counter, see `COUNTER_LABELS`)
+        """
+        with self.lock:
+            if item is None:
+                self.counters[name] = self.counters.get(name, 0) + value
+            else:
+                counter = self.counters.setdefault(name, dict())
+                counter[item] = counter.get(item, 0) + value
+
+    def finish(self, success):
+        """
+        Mark the end of the run.
+        :param bool success: whether the run finished successfully
+        """
+        self.finished = time.time()
+        self.success = success
+
+    def to_dict(self):
+        """
+        :returns: metrics in the format of the JSON stats file
+        :rtype: dict
+        """
+        finished = self.finished or time.time()
+        return {'format': STATS_FORMAT, 'action': self.action,
+                'success': self.success, 'started': self.started,
+                'finished': finished, 'duration': finished - self.started,
+                'phases': self.phases, 'counters': self.counters}
+
+    def to_prometheus(self):
+        """
+        Format the metrics in the Prometheus text exposition format
+        (as read by the node exporter textfile collector). Counters
+        are exported as gauges, as they only hold values of the last run.
+        :returns: metrics text
+        :rtype: str
+        """
+        data = self.to_dict()
+        metrics = collections.OrderedDict()
+        for phase, values in self.phases.iteritems():
+            for key, unit in (('wall', 'seconds'), ('cpu', 'seconds'),
+                              ('peak_rss', 'bytes')):
+                metrics.setdefault('phase_%s_%s' % (key, unit), []).append(
+                    ({'phase': phase}, values[key]))
+        for name, value in self.counters.iteritems():
+            if isinstance(value, dict):
+                label = COUNTER_LABELS.get(name, 'item')
+                metrics[name] = [({label: item}, count)
+                                 for item, count in sorted(value.iteritems())]
+            else:
+                metrics[name] = [({}, value)]
+        metrics['run_duration_seconds'] = [({}, data['duration'])]
+        metrics['run_success'] = [({}, int(bool(self.success)))]
+        metrics['run_timestamp_seconds'] = [({}, data['finished'])]
+        lines = []
+        for name, samples in metrics.iteritems():
+            full_name = '%s_%s' % (PROMETHEUS_PREFIX, name)
+            lines.append('# HELP %s %s' % (full_name, PROMETHEUS_HELP.get(
+                name, 'Number of %s in the run.' % name.replace('_', ' '))))
+            lines.append('# TYPE %s gauge' % full_name)
+            for labels, value in samples:
+                labels = dict(labels, action=self.action or '')
+                lines.append('%s{%s} %s' % (full_name, ','.join(
+                    '%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.iteritems())), _format(value)))
+        return '%s\n' % '\n'.join(lines)
+
+    def write_json(self, path):
+        """
+        Write the metrics into a JSON stats file.
+        :param str path: path of the stats file
+        :raises ManagerError: if the file cannot be written
+        """
+        self._write(path, json.dumps(self.to_dict(), indent=2,
+                                     sort_keys=True, separators=(',', ': ')))
+        self.lg.info('Run statistics written to %s', path)
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics into a Prometheus textfile.
+        :param str path: path of the textfile (should end with .prom)
+        :raises ManagerError: if the file cannot be written
+        """
+        self._write(path, self.to_prometheus())
+        self.lg.info('Run metrics written to %s', path)
+
+    def _write(self, path, data):
+        """
+        Write the file atomically (via a temporary file renamed
+        to the path), so that a collector never reads a partial file.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            fd, temp = tempfile.mkstemp(dir=directory, prefix='.ipamanager-')
+            try:
+                with os.fdopen(fd, 'w') as dest:
+                    dest.write(data)
+                os.chmod(temp, 0o644)
+                os.rename(temp, path)
+            except (IOError, OSError):
+                os.unlink(temp)
+                raise
+        except (IOError, OSError) as e:
+            raise ManagerError('Cannot write metrics to %s: %s' % (path, e))
+
+
+def _format(value):
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    return repr(float(value))
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
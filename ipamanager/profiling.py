@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - profiling module
+
+CPU profiles & allocation reports of run phases (see `Metrics.phase`).
+Only imported when profiling is requested (by the --profile option),
+so that normal runs do not pay for it.
+"""
+
+import collections
+import cProfile
+import gc
+import os
+import resource
+
+from core import FreeIPAManagerCore
+from errors import ManagerError
+
+try:
+    import tracemalloc
+except ImportError:  # not available before Python 3.4
+    tracemalloc = None
+
+# number of top allocation sites (or object types) in the memory report
+MEMORY_REPORT_TOP = 25
+
+
+class PhaseProfiler(FreeIPAManagerCore):
+    """
+    Profiles phases of a run with `cProfile` and records memory
+    allocated during each phase: top allocation sites by `tracemalloc`
+    where available, otherwise growth of the number of objects
+    (tracked by the garbage collector) of each type. Only the thread
+    the phase runs in is profiled (not API or config parsing workers).
+    A phase run several times is profiled cumulatively. Phases nested
+    in a profiled phase are not profiled separately.
+    """
+    def __init__(self, directory):
+        """
+        :param str directory: directory to write the profiles to
+                              (created if it does not exist)
+        :raises ManagerError: if the directory cannot be created
+        """
+        super(PhaseProfiler, self).__init__()
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                raise ManagerError(
+                    'Cannot create profile directory %s: %s' % (directory, e))
+        self.profiles = collections.OrderedDict()
+        self.reports = collections.OrderedDict()
+        self.active = None
+        self.memory = None
+
+    def start(self, name):
+        """
+        Start profiling a phase.
+        :param str name: name of the phase
+        """
+        if self.active:
+            return
+        self.active = name
+        self.memory = (self._snapshot(), _rss())
+        self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+    def stop(self, name):
+        """
+        Stop profiling a phase and record its memory report.
+        :param str name: name of the phase
+        """
+        if self.active != name:
+            return
+        self.profiles[name].disable()
+        self.active = None
+        before, rss_before = self.memory
+        self.memory = None
+        lines = ['Peak RSS: %d KiB at start, %d KiB at end' % (
+            rss_before, _rss())]
+        lines.extend(self._compare(before, self._snapshot()))
+        self.reports.setdefault(name, []).append('\n'.join(lines))
+
+    def write(self):
+        """
+        Write a pstats file (`PHASE.pstats`, readable by the `pstats`
+        module or tools like snakeviz) and a memory report
+        (`PHASE.memory.txt`) of each profiled phase.
+        :raises ManagerError: if a file cannot be written
+        """
+        for name, profile in self.profiles.iteritems():
+            path = os.path.join(self.directory, '%s.pstats' % name)
+            report_path = os.path.join(self.directory, '%s.memory.txt' % name)
+            try:
+                profile.dump_stats(path)
+                with open(report_path, 'w') as dest:
+                    dest.write('\n\n'.join(self.reports.get(name, [])))
+                    dest.write('\n')
+            except (IOError, OSError) as e:
+                raise ManagerError(
+                    'Cannot write profile of phase %s: %s' % (name, e))
+        self.lg.info('Profiles of %d phases written to %s',
+                     len(self.profiles), self.directory)
+
+    @staticmethod
+    def _snapshot():
+        if tracemalloc:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            return tracemalloc.take_snapshot()
+        counts = collections.Counter(
+            type(obj).__name__ for obj in gc.get_objects())
+        return counts
+
+    @staticmethod
+    def _compare(before, after):
+        """
+        :returns: lines of the report of the top allocations between
+                  the two snapshots (see `_snapshot`)
+        :rtype: [str]
+        """
+        if tracemalloc:
+            lines = ['Top %d allocation sites:' % MEMORY_REPORT_TOP]
+            lines.extend(str(stat) for stat in after.compare_to(
+                before, 'lineno')[:MEMORY_REPORT_TOP])
+            return lines
+        growth = after.copy()
+        growth.subtract(before)
+        lines = ['Top %d object types by growth of count:' % (
+            MEMORY_REPORT_TOP)]
+        lines.extend('%s: %+d (%d total)' % (name, count, after[name])
+                     for name, count in growth.most_common(MEMORY_REPORT_TOP)
+                     if count > 0)
+        return lines
+
+
+def _rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -8,7 +8,7 @@ FreeIPA Manager - configuration schemas module
 Validation schemas for FreeIPA entities configuration.
 """
 
-from voluptuous import Any, Required
+from voluptuous import All, Any, Range, Required
 
 _name_type = Any(str, unicode)
 _item_or_list = Any(str, [str])
@@ -26,13 +26,19 @@ schema_settings = {
             'config': dict
         }
     },
+    'api-batch-size': All(int, Range(min=1)),
+    'api-workers': All(int, Range(min=1)),
     'deletion-patterns': [str],
     'ignore': {
         Any('user', 'group', 'hostgroup', 'hbacrule', 'sudorule',
             'role', 'permission', 'privilege', 'service',
             'hbacsvc', 'hbacsvcgroup'): [str]
     },
+    'linter': Any('builtin', 'yamllint'),
+    'member-chunk-size': All(int, Range(min=1)),
     'nesting-limit': int,
+    'push-workers': All(int, Range(min=1)),
+    'slow-call-threshold': All(Any(int, float), Range(min=0)),
     'user-group-pattern': str
 }
 
@@ -20,6 +20,7 @@ import yaml
 from core import FreeIPAManagerCore
 from errors import ConfigError
 from schemas import schema_template
+from utils import YAML_LOADER
 
 
 class FreeIPATemplate(FreeIPAManagerCore):
@@ -230,7 +231,7 @@ class ConfigTemplateLoader(FreeIPAManagerCore):
         self.lg.debug('Opening template config file %s', self.config_path)
         try:
             with open(self.config_path, 'r') as f:
-                data = list(yaml.safe_load_all(f))
+                data = list(yaml.load_all(f, Loader=YAML_LOADER))
         except IOError as e:
             raise ConfigError(
                 'Error reading config file %s: %s' % (self.config_path, e))
@@ -16,10 +16,12 @@ import collections
 import logging
 import os
 
+from ipamanager.cache import DEFAULT_CACHE_DIR
 from ipamanager.config_loader import ConfigLoader
 from ipamanager.errors import ManagerError
 from ipamanager.integrity_checker import IntegrityChecker
-from ipamanager.utils import _args_common, find_entity
+from ipamanager.metrics import Metrics
+from ipamanager.utils import _args_common, _args_profile, find_entity
 from ipamanager.utils import load_settings, _type_verbosity
 from ipamanager.tools.core import FreeIPAManagerToolCore
 
@@ -29,18 +31,35 @@ class QueryTool(FreeIPAManagerToolCore):
     A query tool for inquiry operations over entities,
     like nested membership or security label checking.
     """
-    def __init__(self, config, settings=None, loglevel=logging.INFO):
+    def __init__(self, config, settings=None, loglevel=logging.INFO,
+                 workers=1, cache=False, since=None, state=None,
+                 revision=None, profile=None):
         """
         Initialize the query tool class instance.
         :param str config: path to a freeipa-manager-config folder
         :param str settings: path to a settings file
         :param int loglevel: logging level to use
+        :param int workers: number of config parsing processes
+        :param bool cache: whether to use the config parsing cache
+        :param str since: revision of the saved config state (see `state`)
+        :param str state: path of the saved config state file
+        :param str revision: git revision to load the config of
+        :param str profile: directory to write profiles of phases to
         """
         self.config = config
+        self.workers = workers
+        self.since = since
+        self.state = state
+        self.revision = revision
+        self.cache_dir = DEFAULT_CACHE_DIR if cache else None
         if not settings:
             settings = os.path.join(config, 'settings_common.yaml')
         self.settings = load_settings(settings)
         super(QueryTool, self).__init__(loglevel)
+        self.metrics = Metrics('query')
+        if profile:
+            from ipamanager.profiling import PhaseProfiler
+            self.metrics.profiler = PhaseProfiler(profile)
         self.graph = {}
         self.ancestors = {}
         self.paths = {}
@@ -51,9 +70,16 @@ class QueryTool(FreeIPAManagerToolCore):
         Uses the ConfigLoader and IntegrityChecker components.
         """
         self.lg.info('Running pre-query config load & checks')
-        self.entities = ConfigLoader(self.config, self.settings).load()
+        loader = ConfigLoader(
+            self.config, self.settings, workers=self.workers,
+            cache_dir=self.cache_dir, since=self.since,
+            state_path=self.state, revision=self.revision,
+            metrics=self.metrics)
+        with self.metrics.phase('load'):
+            self.entities = loader.load()
         self.checker = IntegrityChecker(self.entities, self.settings)
-        self.checker.check()
+        with self.metrics.phase('check'):
+            self.checker.check()
         self.lg.info('Pre-query config load & checks finished')
 
     def run(self, args):
@@ -61,10 +87,11 @@ class QueryTool(FreeIPAManagerToolCore):
         Run a query action based on arguments.
         :param argparse.Namespace args: parsed args
         """
-        if args.action == 'member':
-            self._query_membership(args.members, args.entities)
-        elif args.action == 'labels':
-            self._query_labels(args)
+        with self.metrics.phase('query'):
+            if args.action == 'member':
+                self._query_membership(args.members, args.entities)
+            elif args.action == 'labels':
+                self._query_labels(args)
 
     def _resolve_entities(self, entity_list):
         """
@@ -345,11 +372,11 @@ def load_query_tool(config, settings=None):
 
 
 def _parse_args(args=None):
-    common = _args_common()
+    parents = [_args_common(), _args_profile()]
     parser = argparse.ArgumentParser(description='FreeIPA Manager Query')
     actions = parser.add_subparsers(help='query action to execute')
 
-    member = actions.add_parser('member', parents=[common])
+    member = actions.add_parser('member', parents=parents)
     member.add_argument(
         '-m', '--members', nargs='+', type=_entity_type, default=[],
         required=True, help='members (type:name)')
@@ -362,26 +389,30 @@ def _parse_args(args=None):
     labels.set_defaults(action='labels')
     labels_actions = labels.add_subparsers(help='labels query action')
 
-    labels_check = labels_actions.add_parser('check', parents=[common])
+    labels_check = labels_actions.add_parser('check', parents=parents)
     labels_check.set_defaults(subaction='check')
     labels_check.add_argument('label', help='label value')
     labels_check.add_argument('group', help='group name')
 
-    labels_missing = labels_actions.add_parser('missing', parents=[common])
+    labels_missing = labels_actions.add_parser('missing', parents=parents)
     labels_missing.set_defaults(subaction='missing')
     labels_missing.add_argument('user', help='user name')
 
-    labels_necessary = labels_actions.add_parser('necessary', parents=[common])
+    labels_necessary = labels_actions.add_parser('necessary', parents=parents)
     labels_necessary.set_defaults(subaction='necessary')
     labels_necessary.add_argument('group', help='group name')
 
-    labels_user = labels_actions.add_parser('user', parents=[common])
+    labels_user = labels_actions.add_parser('user', parents=parents)
     labels_user.set_defaults(subaction='user')
     labels_user.add_argument('user', help='user name')
     labels_user.add_argument('group', help='group name')
 
     args = parser.parse_args(args)
     args.loglevel = _type_verbosity(args.loglevel)
+    if args.since and not args.state:
+        parser.error('argument --since: requires --state')
+    if args.since and args.revision:
+        parser.error('argument --revision: not allowed with --since')
     return args
 
 
@@ -399,9 +430,15 @@ def main():
     Main executable function used when run as a command-line script.
     """
     args = _parse_args()
-    querytool = QueryTool(args.config, args.settings, args.loglevel)
-    querytool.load()
-    querytool.run(args)
+    querytool = QueryTool(args.config, args.settings, args.loglevel,
+                          args.workers, not args.no_cache, args.since,
+                          args.state, args.revision, args.profile)
+    try:
+        querytool.load()
+        querytool.run(args)
+    finally:
+        if querytool.metrics.profiler:
+            querytool.metrics.profiler.write()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+"""
+FreeIPA Manager - API call tracing module
+
+Spans of FreeIPA API calls (command, target, sizes, duration & outcome),
+written to a JSON lines trace file, with slow calls logged
+and a latency histogram of each command reported in the end of the run.
+"""
+
+import bisect
+import json
+import threading
+import time
+
+from core import FreeIPAManagerCore
+from errors import ManagerError
+
+# calls taking longer than this (in seconds) are logged as slow by default
+# (except for *_find calls, whose duration grows with the number of entities)
+DEFAULT_SLOW_CALL_THRESHOLD = 10
+# upper bounds (in seconds) of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.01, 0.1, 1, 10)
+
+
+class Tracer(FreeIPAManagerCore):
+    """
+    Records a span for each traced API call. Payload & response sizes
+    (in bytes of their JSON representation) are only computed when
+    the spans are written into a trace file. Calls may be traced
+    from several threads.
+    """
+    def __init__(self, path=None, threshold=DEFAULT_SLOW_CALL_THRESHOLD):
+        """
+        :param str path: path of the trace file (spans not written if None)
+        :param float threshold: duration (in seconds) of calls
+                                to log as slow (no logging if None);
+                                not applied to *_find calls
+        """
+        super(Tracer, self).__init__()
+        self.path = path
+        self.threshold = threshold
+        self.durations = dict()
+        self.lock = threading.Lock()
+        self.output = None
+        if path:
+            try:
+                self.output = open(path, 'w')
+            except IOError as e:
+                raise ManagerError(
+                    'Cannot open trace file %s: %s' % (path, e))
+
+    def call(self, function, command, target, *args, **kwargs):
+        """
+        Call the API command function & record a span of the call.
+        :param function: API command function to call
+        :param str command: name of the command (e.g., group_add_member)
+        :param str target: name of the entity the command works on
+                           (None for commands without a single target)
+        :returns: result of the function
+        :raises Exception: any exception raised by the function
+        """
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            self._record(command, target, start, args or kwargs, None, e)
+            raise
+        self._record(command, target, start, args or kwargs, result, None)
+        return result
+
+    def _record(self, command, target, start, payload, result, error):
+        duration = time.time() - start
+        if (self.threshold is not None and duration > self.threshold and
+                not command.endswith('_find')):
+            self.lg.warning('Slow API call %s%s took %.3f s', command,
+                            ' %s' % target if target else '', duration)
+        if self.output is not None:
+            span = {'command': command, 'target': target, 'start': start,
+                    'duration': duration, 'payload_bytes': _size(payload),
+                    'response_bytes': _size(result),
+                    'outcome': 'error' if error else 'ok'}
+            if error:
+                span['error'] = unicode(error)
+            line = json.dumps(span, sort_keys=True, default=unicode)
+        with self.lock:
+            self.durations.setdefault(command, []).append(duration)
+            if self.output is not None:
+                self.output.write('%s\n' % line)
+
+    def close(self):
+        """
+        Close the trace file (if it was opened) & log the latency
+        histogram of the traced calls of each command.
+        """
+        if self.output is not None:
+            with self.lock:
+                self.output.close()
+                self.output = None
+            self.lg.info('API call trace written to %s', self.path)
+        if not self.durations:
+            return
+        self.lg.info('API call latency (calls per bucket: %s):', ' '.join(
+            ['<%s' % _duration(i) for i in HISTOGRAM_BUCKETS] +
+            ['>=%s' % _duration(HISTOGRAM_BUCKETS[-1])]))
+        for command, durations in sorted(self.durations.iteritems()):
+            self.lg.info(
+                '- %s: %d calls, %.3f s total, %.3f s max | %s', command,
+                len(durations), sum(durations), max(durations),
+                ' '.join(str(i) for i in self.histogram(durations)))
+
+    @staticmethod
+    def histogram(durations):
+        """
+        Count durations falling into each of the `HISTOGRAM_BUCKETS`
+        (durations below the bucket's bound and not below the previous one)
+        and into the bucket of durations not below the highest bound.
+        :param [float] durations: call durations (in seconds)
+        :returns: count of durations in each bucket
+        :rtype: [int]
+        """
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for duration in durations:
+            counts[bisect.bisect_right(HISTOGRAM_BUCKETS, duration)] += 1
+        return counts
+
+
+def _size(value):
+    if value is None:
+        return 0
+    return len(json.dumps(value, default=unicode))
+
+
+def _duration(seconds):
+    if seconds < 1:
+        return '%dms' % round(seconds * 1000)
+    return '%ds' % seconds
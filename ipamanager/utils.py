@@ -18,11 +18,14 @@ import socket
 import sys
 import voluptuous
 import yaml
+from yamllint import parser as yamllint_parser
 from yamllint.config import YamlLintConfig
+from yamllint.linter import get_cosmetic_problems
 from yamllint.linter import run as yamllint_check
 
 import entities
 from errors import ConfigError
+from linter import is_canonical
 from schemas import schema_settings
 
 
@@ -36,6 +39,13 @@ ENTITY_CLASSES = [
     entities.FreeIPAUserGroup
 ]
 
+# use the libyaml-based loader/dumper if available (significantly faster)
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# yamllint configuration, created once per process (see `_yamllint_config`)
+_YAMLLINT_CONFIG = None
+
 
 def _check_handler_present(logger, handler_type, *compare):
     """
@@ -118,6 +128,16 @@ def _type_threshold(value):
     return number
 
 
+def _type_workers(value):
+    try:
+        number = int(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if number < 0:
+        raise argparse.ArgumentTypeError('must be a non-negative number')
+    return number
+
+
 def _type_verbosity(value):
     return {0: logging.WARNING, 1: logging.INFO}.get(value, logging.DEBUG)
 
@@ -129,25 +149,57 @@ def _args_common():
                         help='Types of entities to pull',
                         choices=[cls.entity_name for cls in ENTITY_CLASSES])
     common.add_argument('-s', '--settings', help='Settings file')
+    common.add_argument('-w', '--workers', type=_type_workers, default=1,
+                        help='Config parsing processes (0 = CPU count)')
+    common.add_argument('-C', '--no-cache', action='store_true',
+                        help='Do not use the config parsing cache')
+    common.add_argument('--state', metavar='FILE',
+                        help='Saved config state file (saved after loading)')
+    common.add_argument('--since', metavar='REVISION',
+                        help='Only load files changed since the revision '
+                             'of the saved config state (needs --state)')
+    common.add_argument('--revision',
+                        help='Load config of the git revision (from git '
+                             'objects, without using the working tree)')
     common.add_argument('-v', '--verbose', action='count', default=0,
                         dest='loglevel', help='Verbose mode (-vv for debug)')
     return common
 
 
+def _args_profile():
+    profile = argparse.ArgumentParser(add_help=False)
+    profile.add_argument('--profile', metavar='DIR',
+                         help='Write CPU & memory profiles of phases to DIR')
+    return profile
+
+
+def _args_metrics():
+    metrics = argparse.ArgumentParser(add_help=False,
+                                      parents=[_args_profile()])
+    metrics.add_argument('--stats', metavar='FILE',
+                         help='Write run statistics into a JSON file')
+    metrics.add_argument('--prometheus', metavar='FILE',
+                         help='Write run metrics into a Prometheus textfile')
+    metrics.add_argument('--trace', metavar='FILE',
+                         help='Write API call spans into a JSON lines file')
+    return metrics
+
+
 def parse_args():
     common = _args_common()
+    metrics = _args_metrics()
 
     parser = argparse.ArgumentParser(description='FreeIPA Manager')
     actions = parser.add_subparsers(help='action to execute')
 
-    check = actions.add_parser('check', parents=[common])
+    check = actions.add_parser('check', parents=[common, metrics])
     check.set_defaults(action='check')
 
-    diff = actions.add_parser('diff', parents=[common])
+    diff = actions.add_parser('diff', parents=[common, metrics])
     diff.add_argument('sub_path', help='Path to the subtrahend directory')
     diff.set_defaults(action='diff')
 
-    push = actions.add_parser('push', parents=[common])
+    push = actions.add_parser('push', parents=[common, metrics])
     push.set_defaults(action='push')
     push.add_argument('-d', '--deletion', action='store_true',
                       help='Enable deletion of entities')
@@ -155,21 +207,32 @@ def parse_args():
                       help='Actually make changes (no dry run)')
     push.add_argument('-t', '--threshold', type=_type_threshold,
                       metavar='(%)', help='Change threshold', default=10)
-
-    pull = actions.add_parser('pull', parents=[common])
+    plan = push.add_mutually_exclusive_group()
+    plan.add_argument('--save-plan', metavar='FILE',
+                      help='Save the prepared commands into a plan file')
+    plan.add_argument('--apply-plan', metavar='FILE',
+                      help='Execute commands of a saved plan file '
+                           '(without loading the config repository)')
+    push.add_argument('--journal', metavar='FILE',
+                      help='Record executed commands into a journal file')
+    push.add_argument('--resume', action='store_true',
+                      help='Resume the push of the plan recorded in the '
+                           'journal (needs --apply-plan & --journal)')
+
+    pull = actions.add_parser('pull', parents=[common, metrics])
     pull.set_defaults(action='pull')
     pull.add_argument(
         '-a', '--add-only', action='store_true', help='Add-only mode')
     pull.add_argument(
         '-d', '--dry-run', action='store_true', help='Dry-run mode')
 
-    template = actions.add_parser('template', parents=[common])
+    template = actions.add_parser('template', parents=[common, metrics])
     template.add_argument('template', help='Path to template file')
     template.add_argument(
         '-d', '--dry-run', action='store_true', help='Dry-run mode')
     template.set_defaults(action='template')
 
-    roundtrip = actions.add_parser('roundtrip', parents=[common])
+    roundtrip = actions.add_parser('roundtrip', parents=[common, metrics])
     roundtrip.add_argument(
         '-I', '--no-ignored', action='store_true',
         help='Load all entities (including ignored ones)')
@@ -179,6 +242,16 @@ def parse_args():
     args = parser.parse_args()
     # type & action cannot be combined in arg constructor, so parse -v here
     args.loglevel = _type_verbosity(args.loglevel)
+    if args.since and not args.state:
+        parser.error('argument --since: requires --state')
+    if args.since and args.revision:
+        parser.error('argument --revision: not allowed with --since')
+    # these actions write the loaded config into the working tree
+    if args.revision and args.action in ('pull', 'roundtrip'):
+        parser.error('argument --revision: not allowed with %s' % args.action)
+    if getattr(args, 'resume', False) and not (
+            args.apply_plan and args.journal):
+        parser.error('argument --resume: requires --apply-plan and --journal')
 
     # set default settings file based on action
     if not args.settings:
@@ -189,20 +262,69 @@ def parse_args():
     return args
 
 
-def run_yamllint_check(data):
+def _yamllint_config():
+    """
+    Get the yamllint configuration used for checking config files.
+    The configuration is only created once per process, as creating it
+    is relatively expensive compared to linting a small file.
+    :returns: yamllint configuration
+    :rtype: yamllint.config.YamlLintConfig
+    """
+    global _YAMLLINT_CONFIG
+    if _YAMLLINT_CONFIG is None:
+        rules = {'extends': 'default', 'rules': {'line-length': 'disable'}}
+        _YAMLLINT_CONFIG = YamlLintConfig(yaml.dump(rules, Dumper=YAML_DUMPER))
+    return _YAMLLINT_CONFIG
+
+
+def run_yamllint_check(data, syntax_checked=False):
     """
     Run a yamllint check on parsed file contents
     to verify that the file syntax is correct.
     :param str data: contents of the configuration file to check
-    :param yamllint.config.YamlLintConfig: yamllint config to use
+    :param bool syntax_checked: whether the data is known to be valid YAML
+        (already parsed successfully), in which case yamllint's own parsing
+        of the data for syntax errors is skipped & only style is checked
     :raises ConfigError: in case of yamllint errors
     """
-    rules = {'extends': 'default', 'rules': {'line-length': 'disable'}}
-    lint_errs = list(yamllint_check(data, YamlLintConfig(yaml.dump(rules))))
+    conf = _yamllint_config()
+    if syntax_checked:
+        first_line = next(yamllint_parser.line_generator(data)).content
+        if re.match(r'^#\s*yamllint disable-file\s*$', first_line):
+            return
+        lint_errs = list(get_cosmetic_problems(data, conf, None))
+    else:
+        lint_errs = list(yamllint_check(data, conf))
     if lint_errs:
         raise ConfigError('yamllint errors: %s' % lint_errs)
 
 
+def load_yaml(data, linter='yamllint'):
+    """
+    Lint and parse YAML configuration file contents. The data is parsed
+    first (using libyaml if available), so that the parsing doubles as
+    the syntax check and yamllint only needs to check style. A full
+    yamllint check is only run if the parsing fails, so that syntax errors
+    are reported the same way as other yamllint errors.
+    :param str data: contents of the configuration file
+    :param str linter: linter to use (`yamllint` or `builtin`); the built-in
+        linter only checks whether the data is in the canonical subset
+        of YAML (see the `linter` module) & yamllint is used otherwise
+    :returns: parsed data
+    :raises ConfigError: in case of yamllint errors
+    :raises yaml.YAMLError: in case of errors not reported by yamllint
+    """
+    try:
+        parsed = yaml.load(data, Loader=YAML_LOADER)
+    except yaml.YAMLError:
+        run_yamllint_check(data)
+        raise
+    if linter == 'builtin' and is_canonical(data):
+        return parsed
+    run_yamllint_check(data, syntax_checked=True)
+    return parsed
+
+
 def _merge_include(target, source):
     for key, value in source.iteritems():
         if isinstance(value, dict) and key in target:
@@ -222,9 +344,7 @@ def load_settings(path):
     """
     result = {}
     with open(path) as src:
-        raw = src.read()
-        run_yamllint_check(raw)
-        settings = yaml.safe_load(raw)
+        settings = load_yaml(src.read())
     # run validation of parsed YAML against schema
     voluptuous.Schema(schema_settings)(settings)
     subconfigs = []
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import logging
+import mock
+import os.path
+import shutil
+from testfixtures import log_capture
+
+from _utils import _import
+tool = _import('ipamanager', 'cache')
+config_loader = _import('ipamanager', 'config_loader')
+modulename = 'ipamanager.cache'
+testpath = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_CORRECT = os.path.join(testpath, 'freeipa-manager-config/correct')
+
+
+class TestConfigCache(object):
+    def setup_method(self, method):
+        self.tmpdir = os.path.join(
+            '/tmp', 'ipamanager-cache-test-%d' % os.getpid())
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        shutil.copytree(CONFIG_CORRECT, self.repo)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self):
+        loader = config_loader.ConfigLoader(
+            self.repo, {}, cache_dir=self.cache_dir)
+        return loader.load()
+
+    def _cache(self, stamp=None):
+        cache = tool.ConfigCache(
+            self.cache_dir, self.repo, stamp or tool.cache_stamp())
+        cache.load()
+        return cache
+
+    def test_cache_stamp(self):
+        assert tool.cache_stamp({}) == tool.cache_stamp({})
+        assert tool.cache_stamp({}) != tool.cache_stamp({'user': ['a']})
+
+    def test_cache_stamp_format(self):
+        stamp = tool.cache_stamp({})
+        with mock.patch('%s.CACHE_FORMAT' % modulename, 42):
+            assert tool.cache_stamp({}) != stamp
+
+    def test_load_no_cache(self):
+        cache = self._cache()
+        assert cache.entries == {}
+        path = os.path.join(self.repo, 'users/test_user.yaml')
+        assert cache.lookup(path) is None
+
+    def test_load_save_roundtrip(self):
+        first = self._load()
+        cache = self._cache()
+        assert len(cache.entries) == 34
+        path = os.path.join(self.repo, 'users/test_user.yaml')
+        results = cache.lookup(path)
+        assert len(results) == 1
+        kind, entity = results[0]
+        assert kind == 'entity'
+        assert entity.path == path
+        assert entity.data_repo == first['user']['test.user'].data_repo
+        assert entity.data_ipa == first['user']['test.user'].data_ipa
+
+    def test_load_from_cache(self):
+        first = self._load()
+        with mock.patch(
+                'ipamanager.config_loader.load_yaml') as mock_lint:
+            second = self._load()
+        mock_lint.assert_not_called()
+        assert sorted(second) == sorted(first)
+        for entity_type, entity_list in first.iteritems():
+            assert second[entity_type] == entity_list
+            for name, entity in entity_list.iteritems():
+                cached = second[entity_type][name]
+                assert cached.data_repo == entity.data_repo
+                assert cached.metaparams == entity.metaparams
+                assert cached.path == entity.path
+
+    def test_load_from_cache_other_ignore_settings(self):
+        loader = config_loader.ConfigLoader(
+            self.repo, {'ignore': {'user': ['test.user']}},
+            cache_dir=self.cache_dir)
+        first = loader.load()
+        assert 'test.user' not in first['user']
+        loader = config_loader.ConfigLoader(
+            self.repo, {'ignore': {'user': ['test.user']}}, ignore=False,
+            cache_dir=self.cache_dir)
+        with mock.patch(
+                'ipamanager.config_loader.load_yaml') as mock_lint:
+            second = loader.load()
+        mock_lint.assert_not_called()
+        assert 'test.user' in second['user']
+
+    def test_lookup_mtime_changed_same_contents(self):
+        self._load()
+        path = os.path.join(self.repo, 'users/test_user.yaml')
+        os.utime(path, (1, 1))
+        cache = self._cache()
+        assert cache.lookup(path)
+        assert cache.used['users/test_user.yaml'][1] == 1
+
+    def test_lookup_contents_changed(self):
+        self._load()
+        path = os.path.join(self.repo, 'groups/group_one.yaml')
+        with open(path, 'a') as target:
+            target.write('  description: changed\n')
+        cache = self._cache()
+        assert cache.lookup(path) is None
+
+    def test_lookup_deleted(self):
+        self._load()
+        path = os.path.join(self.repo, 'groups/group_one.yaml')
+        os.unlink(path)
+        assert self._cache().lookup(path) is None
+
+    def test_load_outdated_stamp(self):
+        self._load()
+        cache = self._cache(stamp='other')
+        assert cache.entries == {}
+
+    @log_capture('ConfigCache', level=logging.WARNING)
+    def test_load_corrupted(self, captured_log):
+        self._load()
+        cache = self._cache()
+        with open(cache.path, 'w') as target:
+            target.write('garbage')
+        cache = self._cache()
+        assert cache.entries == {}
+        assert len(captured_log.records) == 1
+        assert captured_log.records[0].msg.startswith(
+            'Cannot read config cache')
+
+    def test_save_evicts_stale(self):
+        self._load()
+        os.unlink(os.path.join(self.repo, 'groups/group_one.yaml'))
+        self._load()
+        cache = self._cache()
+        assert len(cache.entries) == 33
+        assert 'groups/group_one.yaml' not in cache.entries
+
+    def test_save_nothing(self):
+        cache = self._cache()
+        cache.save()
+        assert not os.path.exists(cache.path)
+
+    def test_errors_not_cached(self):
+        path = os.path.join(self.repo, 'groups/group_one.yaml')
+        with open(path, 'a') as target:
+            target.write('  extra: key\n')
+        loader = config_loader.ConfigLoader(
+            self.repo, {}, cache_dir=self.cache_dir)
+        try:
+            loader.load()
+        except config_loader.ConfigError:
+            pass
+        cache = self._cache()
+        assert 'groups/group_one.yaml' not in cache.entries
+        assert len(cache.entries) == 33
+
+    @log_capture('ConfigCache', level=logging.WARNING)
+    def test_save_error(self, captured_log):
+        cache = self._cache()
+        cache.store(os.path.join(self.repo, 'users/test_user.yaml'),
+                    (1, 1, 'digest'), [])
+        with mock.patch('%s.os.makedirs' % modulename,
+                        side_effect=OSError('denied')):
+            cache.save()
+        assert [r.msg % r.args for r in captured_log.records] == [
+            'Cannot save config cache %s: denied' % cache.path]
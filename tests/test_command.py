@@ -10,6 +10,7 @@ from testfixtures import log_capture
 
 from _utils import _import
 tool = _import('ipamanager', 'command')
+tracing = _import('ipamanager', 'tracing')
 
 
 class TestCommand(object):
@@ -37,6 +38,17 @@ class TestCommand(object):
              u'Executing user_add t.user (givenname=Test; sn=User)'),
             ('Command', 'INFO', u'Added user "t.user"'))
 
+    def test_execute_traced(self):
+        mock_api = mock.MagicMock()
+        mock_api.Command.__getitem__.side_effect = self._api_call_execute_fail
+        tracer = tracing.Tracer()
+        tool.Command('user_add', {'givenName': 'Test', 'sn': 'User'},
+                     't.user', 'uid').execute(mock_api, tracer)
+        with pytest.raises(tool.CommandError):
+            tool.Command('group_add_member', {'user': 'user1'}, 'group1',
+                         'cn').execute(mock_api, tracer)
+        assert sorted(tracer.durations) == ['group_add_member', 'user_add']
+
     @log_capture('Command', level=logging.INFO)
     def test_execute_nosummary(self, captured_log):
         mock_api = mock.MagicMock()
@@ -84,6 +96,184 @@ class TestCommand(object):
             cmd.execute(mock_api)
         assert exc.value[0] == 'Non-existent command non_existent'
 
+    def test_coalesce(self):
+        commands = [
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group1', 'cn') for i in range(5)]
+        commands.extend([
+            tool.Command('group_add_member', {'group': 'group2'},
+                         'group1', 'cn'),
+            tool.Command('group_add_member', {'user': 'user1'},
+                         'group2', 'cn'),
+            tool.Command('group_remove_member', {'user': 'user5'},
+                         'group1', 'cn'),
+            tool.Command('sudorule_add_option', {'ipaSudoOpt': ['opt1']},
+                         'rule1', 'cn'),
+            tool.Command('sudorule_add_option', {'ipaSudoOpt': ['opt2']},
+                         'rule1', 'cn'),
+            tool.Command('user_mod', {'sn': 'User'}, 'user1', 'uid'),
+            tool.Command('user_mod', {'sn': 'User'}, 'user2', 'uid')])
+        result = tool.Command.coalesce(commands, 4)
+        assert [i.payload for i in result] == [
+            {'cn': u'rule1', 'ipasudoopt': u'opt1'},
+            {'cn': u'rule1', 'ipasudoopt': u'opt2'},
+            {'sn': u'User', 'uid': u'user1'},
+            {'sn': u'User', 'uid': u'user2'},
+            {'cn': u'group1',
+             'user': (u'user0', u'user1', u'user2', u'user3')},
+            {'cn': u'group1', 'user': u'user4', 'group': u'group2'},
+            {'cn': u'group2', 'user': u'user1'},
+            {'cn': u'group1', 'user': u'user5'}]
+        assert [len(i.parts) for i in result] == [1, 1, 1, 1, 4, 2, 1, 1]
+        assert result[4].parts == commands[:4]
+        assert result[5].parts == commands[4:6]
+        assert result[5].description == (
+            'group_add_member group1 (group=group2; user=user4)')
+
+    def test_coalesce_disabled(self):
+        commands = [
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group1', 'cn') for i in range(5)]
+        assert tool.Command.coalesce(commands, 1) == commands
+
+    def test_coalesce_sudo_options(self):
+        commands = [
+            tool.Command('sudorule_%s_option' % action,
+                         {'ipaSudoOpt': ['opt%d' % i]}, 'rule1', 'cn')
+            for action in ('add', 'remove') for i in range(3)]
+        assert not any(i.mergeable for i in commands)
+        assert tool.Command.coalesce(commands, 10) == commands
+
+    def test_coalesce_multivalue(self):
+        commands = [
+            tool.Command('group_add_member', {'user': ('user1', 'user2')},
+                         'group1', 'cn'),
+            tool.Command('group_add_member', {'user': 'user3'},
+                         'group1', 'cn')]
+        assert tool.Command.coalesce(commands, 10) == commands
+
+    @log_capture('Command', level=logging.ERROR)
+    def test_execute_coalesced_fail(self, captured_log):
+        mock_api = mock.MagicMock()
+        mock_api.Command.__getitem__.return_value.return_value = {
+            u'failed': {u'member': {
+                u'user': ((u'user1', u'no such entry'),
+                          (u'user3', u'This entry is already a member')),
+                u'group': ()}}}
+        cmd = tool.Command.coalesce([
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group1', 'cn') for i in range(1, 4)], 10)[0]
+        with pytest.raises(tool.CommandError) as exc:
+            cmd.execute(mock_api)
+        errs = cmd.member_errors(exc.value)
+        assert [(i.description, str(j)) for i, j in errs] == [
+            ('group_add_member group1 (user=user1)',
+             "Error executing group_add_member: [u'- user1: no such entry']"),
+            ('group_add_member group1 (user=user3)',
+             "Error executing group_add_member: "
+             "[u'- user3: This entry is already a member']")]
+        captured_log.check(
+            ('Command', 'ERROR',
+             "group_add_member group1 "
+             "(user=(u'user1', u'user2', u'user3')) failed:"),
+            ('Command', 'ERROR', u'- user1: no such entry'),
+            ('Command', 'ERROR', u'- user3: This entry is already a member'))
+
+    def test_member_errors_exception(self):
+        parts = [tool.Command('group_add_member', {'user': 'user%d' % i},
+                              'group1', 'cn') for i in range(1, 3)]
+        cmd = tool.Command.coalesce(parts, 10)[0]
+        err = tool.CommandError('Error executing group_add_member: timeout')
+        assert cmd.member_errors(err) == [(parts[0], err), (parts[1], err)]
+
+    def test_member_errors_unknown_member(self):
+        parts = [tool.Command('group_add_member', {'user': 'user%d' % i},
+                              'group1', 'cn') for i in range(1, 3)]
+        cmd = tool.Command.coalesce(parts, 10)[0]
+        with pytest.raises(tool.CommandError) as exc:
+            cmd._handle_output({u'failed': {u'member': {
+                u'user': ((u'user2', u'no such entry'),),
+                u'group': ((u'user1', u'no such entry'),)}}})
+        errs = cmd.member_errors(exc.value)
+        assert [(i, str(j)) for i, j in errs] == [
+            (parts[1], "Error executing group_add_member: "
+                       "[u'- user2: no such entry']"),
+            (cmd, "Error executing group_add_member: "
+                  "[u'- user1: no such entry']")]
+
+    def test_member_errors_single(self):
+        cmd = tool.Command('group_add_member', {'user': 'user1'},
+                           'group1', 'cn')
+        err = tool.CommandError('Error executing group_add_member: timeout')
+        assert cmd.member_errors(err) == [(cmd, err)]
+
+    @log_capture('Command', level=logging.INFO)
+    def test_execute_batch(self, captured_log):
+        mock_api = mock.MagicMock()
+        mock_api.Command.__getitem__.return_value.return_value = {
+            'count': 3, 'results': [
+                {'summary': u'Added user "t.user"'},
+                {u'failed': {u'attr1': {'param1': (
+                    (u'test', u'no such attr2'),)}}},
+                {'error': u'group2: group not found',
+                 'error_name': u'NotFound', 'error_code': 4001}]}
+        commands = [
+            tool.Command('user_add', {'givenName': 'Test', 'sn': 'User'},
+                         't.user', 'uid'),
+            tool.Command('group_add_member', {'user': 't.user'},
+                         'group1', 'cn'),
+            tool.Command('group_add_member', {'user': 't.user'},
+                         'group2', 'cn')]
+        errs = tool.Command.execute_batch(mock_api, commands)
+        mock_api.Command.__getitem__.assert_called_with('batch')
+        mock_api.Command.__getitem__.return_value.assert_called_with(
+            {'method': 'user_add', 'params': [[], {
+                'givenname': u'Test', 'sn': u'User', 'uid': u't.user'}]},
+            {'method': 'group_add_member', 'params': [[], {
+                'user': u't.user', 'cn': u'group1'}]},
+            {'method': 'group_add_member', 'params': [[], {
+                'user': u't.user', 'cn': u'group2'}]})
+        assert [str(i) if i else None for i in errs] == [
+            None,
+            "Error executing group_add_member: [u'- test: no such attr2']",
+            'Error executing group_add_member: group2: group not found']
+        captured_log.check(
+            ('Command', 'INFO',
+             u'Executing user_add t.user (givenname=Test; sn=User)'),
+            ('Command', 'INFO',
+             u'Executing group_add_member group1 (user=t.user)'),
+            ('Command', 'INFO',
+             u'Executing group_add_member group2 (user=t.user)'),
+            ('Command', 'INFO', u'Added user "t.user"'),
+            ('Command', 'ERROR',
+             u'group_add_member group1 (user=t.user) failed:'),
+            ('Command', 'ERROR', u'- test: no such attr2'))
+
+    def test_execute_batch_exception(self):
+        mock_api = mock.MagicMock()
+        mock_api.Command.__getitem__.return_value.side_effect = Exception(
+            'Connection lost')
+        commands = [
+            tool.Command('group_add_member', {'user': 'user1'},
+                         'group1', 'cn'),
+            tool.Command('group_add_member', {'user': 'user2'},
+                         'group1', 'cn')]
+        errs = tool.Command.execute_batch(mock_api, commands)
+        assert [str(i) for i in errs] == [
+            'Error executing batch: Connection lost'] * 2
+
+    def test_execute_batch_traced(self):
+        mock_api = mock.MagicMock()
+        mock_api.Command.__getitem__.return_value.return_value = {
+            'count': 2, 'results': [{'summary': u'Added user "t.user"'}] * 2}
+        commands = [
+            tool.Command('user_add', {'sn': 'User'}, 't.user%d' % i, 'uid')
+            for i in range(2)]
+        tracer = tracing.Tracer()
+        assert tool.Command.execute_batch(mock_api, commands, tracer) == [
+            None, None]
+        assert tracer.durations.keys() == ['batch']
+
     @log_capture('Command', level=logging.INFO)
     def test_handle_command_output_summary(self, captured_log):
         cmd = tool.Command('test', {'user': 'user1'}, 'group1', 'cn')
@@ -4,6 +4,7 @@
 # Copyright © 2017-2019, GoodData Corporation. All rights reserved.
 
 import logging
+import mock
 import os.path
 import pytest
 from testfixtures import log_capture
@@ -106,25 +107,80 @@ class TestConfigLoader(object):
     @log_capture('ConfigLoader', level=logging.DEBUG)
     def test_run_yamllint_check_ok(self, captured_log):
         data = '---\ntest-group:\n  description: A test group.\n'
-        tool.run_yamllint_check(data)
+        utils.run_yamllint_check(data)
         captured_log.check()
 
     @log_capture('ConfigLoader', level=logging.DEBUG)
     def test_run_yamllint_check_long_line(self, captured_log):
         data = '---\ntest-group:\n  description: %s\n' % ('x' * 80)
-        tool.run_yamllint_check(data)
+        utils.run_yamllint_check(data)
         captured_log.check()
 
     def test_run_yamllint_check_error(self):
         data = 'test-group:\n  description: A test group.\n  description: test'
         with pytest.raises(tool.ConfigError) as exc:
-            tool.run_yamllint_check(data)
+            utils.run_yamllint_check(data)
         assert exc.value[0] == (
             'yamllint errors: [1:1: missing document start "---" '
             '(document-start), 3:3: duplication of key "description" '
             'in mapping (key-duplicates), 3:20: no new line character '
             'at the end of file (new-line-at-end-of-file)]')
 
+    def test_run_yamllint_check_config_cached(self):
+        data = '---\ntest-group:\n  description: A test group.\n'
+        with mock.patch('ipamanager.utils._YAMLLINT_CONFIG', None):
+            with mock.patch('ipamanager.utils.YamlLintConfig') as mock_conf:
+                utils.run_yamllint_check(data)
+                utils.run_yamllint_check(data)
+        mock_conf.assert_called_once()
+
+    def test_run_yamllint_check_syntax_checked(self):
+        data = 'test-group:\n  description: A test group.\n  description: test'
+        with pytest.raises(tool.ConfigError) as exc:
+            utils.run_yamllint_check(data, syntax_checked=True)
+        assert exc.value[0] == (
+            'yamllint errors: [1:1: missing document start "---" '
+            '(document-start), 3:3: duplication of key "description" '
+            'in mapping (key-duplicates), 3:20: no new line character '
+            'at the end of file (new-line-at-end-of-file)]')
+
+    def test_run_yamllint_check_syntax_checked_disabled(self):
+        data = '# yamllint disable-file\ntest-group: {description: x}'
+        utils.run_yamllint_check(data, syntax_checked=True)
+
+    def test_load_yaml(self):
+        data = '---\ntest-group:\n  description: A test group.\n'
+        assert utils.load_yaml(data) == {
+            'test-group': {'description': 'A test group.'}}
+
+    def test_load_yaml_lint_error(self):
+        data = '---\ntest-group:\n  description:   A test group.\n'
+        with pytest.raises(tool.ConfigError) as exc:
+            utils.load_yaml(data)
+        assert exc.value[0] == (
+            'yamllint errors: [3:17: too many spaces after colon (colons)]')
+
+    def test_load_yaml_syntax_error(self):
+        data = '---\ntest-group:\n  description: [A test group.\n'
+        with pytest.raises(tool.ConfigError) as exc:
+            utils.load_yaml(data)
+        assert exc.value[0].startswith('yamllint errors: [4:1: syntax error')
+
+    def test_load_yaml_syntax_error_not_linted(self):
+        data = '---\ntest-group: x\n'
+        with mock.patch('ipamanager.utils.yaml.load',
+                        side_effect=utils.yaml.YAMLError('bad')):
+            with pytest.raises(utils.yaml.YAMLError) as exc:
+                utils.load_yaml(data)
+        assert str(exc.value) == 'bad'
+
+    def test_load_yaml_pure_python_loader(self):
+        data = '---\ntest-group:\n  description: A test group.\n'
+        with mock.patch('ipamanager.utils.YAML_LOADER',
+                        utils.yaml.SafeLoader):
+            assert utils.load_yaml(data) == {
+                'test-group': {'description': 'A test group.'}}
+
     def test_parse(self):
         self.loader.entities = {'user': {}}
         data = {'test.user': {'firstName': 'first', 'lastName': 'last'}}
@@ -187,6 +243,19 @@ class TestConfigLoader(object):
                             ('Not creating ignored user test.user '
                              'from users/test_user.yaml')))
 
+    @log_capture('ConfigLoader', level=logging.INFO)
+    def test_parse_ignored_invalid(self, captured_log):
+        data = {'test.user': {'firstName': 'first', 'extra': 'invalid'}}
+        self.loader.entities['user'] = dict()
+        self.loader.ignored['user'] = ['test.user']
+        self.loader._parse(
+            data, entities.FreeIPAUser,
+            '%s/users/test_user.yaml' % CONFIG_CORRECT)
+        assert self.loader.entities['user'] == dict()
+        captured_log.check(('ConfigLoader', 'INFO',
+                            ('Not creating ignored user test.user '
+                             'from users/test_user.yaml')))
+
     @log_capture('ConfigLoader', level=logging.INFO)
     def test_load(self, captured_log):
         self.loader.basepath = CONFIG_CORRECT
@@ -342,3 +411,56 @@ class TestConfigLoader(object):
             ' services/invalidmember.yaml, sudorules/extrakey.yaml,'
             ' users/duplicit.yaml, users/duplicit2.yaml, users/extrakey.yaml,'
             ' users/invalidmember.yaml]')
+
+    def test_load_parallel(self):
+        self.loader.load()
+        serial = self.loader.entities
+        loader = tool.ConfigLoader(
+            CONFIG_CORRECT, {'ignore': self.loader.ignored}, workers=3)
+        loader.load()
+        assert sorted(loader.entities.keys()) == sorted(serial.keys())
+        for entity_type, entity_list in serial.iteritems():
+            assert loader.entities[entity_type] == entity_list
+            for name, entity in entity_list.iteritems():
+                parallel_entity = loader.entities[entity_type][name]
+                assert parallel_entity.data_repo == entity.data_repo
+                assert parallel_entity.data_ipa == entity.data_ipa
+                assert parallel_entity.metaparams == entity.metaparams
+                assert parallel_entity.path == entity.path
+                assert parallel_entity.lg is not None
+
+    def test_load_invalid_parallel(self):
+        self.loader.basepath = CONFIG_INVALID
+        with pytest.raises(tool.ConfigError) as exc:
+            self.loader.load()
+        loader = tool.ConfigLoader(CONFIG_INVALID, {}, workers=4)
+        with pytest.raises(tool.ConfigError) as exc_parallel:
+            loader.load()
+        assert exc_parallel.value[0] == exc.value[0]
+        assert sorted(loader.errs) == sorted(self.loader.errs)
+
+    def test_load_builtin_linter(self):
+        self.loader.load()
+        loader = tool.ConfigLoader(
+            CONFIG_CORRECT,
+            {'ignore': self.loader.ignored, 'linter': 'builtin'})
+        with mock.patch('ipamanager.utils.run_yamllint_check') as mock_lint:
+            loader.load()
+        mock_lint.assert_not_called()
+        for entity_type, entity_list in self.loader.entities.iteritems():
+            assert loader.entities[entity_type] == entity_list
+
+    def test_load_invalid_builtin_linter(self):
+        self.loader.basepath = CONFIG_INVALID
+        with pytest.raises(tool.ConfigError) as exc:
+            self.loader.load()
+        loader = tool.ConfigLoader(CONFIG_INVALID, {'linter': 'builtin'})
+        with pytest.raises(tool.ConfigError) as exc_builtin:
+            loader.load()
+        assert exc_builtin.value[0] == exc.value[0]
+
+    def test_workers_default_cpu_count(self):
+        with mock.patch('%s.multiprocessing.cpu_count' % modulename,
+                        return_value=6):
+            loader = tool.ConfigLoader(CONFIG_CORRECT, {}, workers=0)
+        assert loader.workers == 6
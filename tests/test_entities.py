@@ -505,6 +505,28 @@ class TestFreeIPAUser(object):
             'organizationUnit': 'CISTA'}
         assert all(isinstance(i, unicode) for i in result.itervalues())
 
+    def test_ipa_attributes(self):
+        assert tool.FreeIPAUser.ipa_attributes() == set([
+            'uid', 'givenname', 'sn', 'initials', 'mail', 'ou', 'manager',
+            'carlicense', 'title'])
+
+    def test_prune_ipa_data(self):
+        data = {
+            u'uid': (u'firstname.lastname',), u'givenname': (u'Firstname',),
+            u'sn': (u'Lastname',), u'manager': (u'firstname.lastname2',),
+            u'memberof_group': (u'ipausers', u'group-one-users'),
+            u'memberofindirect_group': (u'group-two',),
+            u'usercertificate': ('certificate',),
+            u'krbprincipalkey': ('key',), u'dn': u'uid=firstname.lastname',
+            u'objectclass': (u'person', u'top')}
+        pruned = tool.FreeIPAUser.prune_ipa_data(data)
+        assert pruned == {
+            u'uid': (u'firstname.lastname',), u'givenname': (u'Firstname',),
+            u'sn': (u'Lastname',), u'manager': (u'firstname.lastname2',),
+            u'memberof_group': (u'ipausers', u'group-one-users')}
+        user = tool.FreeIPAUser('firstname.lastname', {})
+        assert user._convert_to_repo(pruned) == user._convert_to_repo(data)
+
 
 class TestFreeIPAUserGroup(object):
     def setup_method(self, method):
@@ -592,6 +614,18 @@ class TestFreeIPAUserGroup(object):
         assert result == {'description': 'Sample group three.'}
         assert isinstance(result['description'], unicode)
 
+    def test_prune_ipa_data(self):
+        pruned = tool.FreeIPAUserGroup.prune_ipa_data(self.data)
+        assert pruned == {
+            u'cn': (u'group-three-users',),
+            u'objectclass': (u'ipaobject', u'top', u'ipausergroup',
+                             u'posixgroup', u'groupofnames', u'nestedgroup'),
+            u'member_group': (u'group-two',),
+            u'member_user': (u'firstname.lastname2',),
+            u'description': (u'Sample group three.',)}
+        group = tool.FreeIPAUserGroup('group-three-users', pruned)
+        assert group.posix
+
     def test_can_contain_users_yes(self):
         group = tool.FreeIPAUserGroup('group-one-users', {}, 'path')
         assert group.can_contain_users(USER_GROUP_REGEX)
@@ -866,6 +900,17 @@ class TestFreeIPAHBACRule(object):
         assert output == {'rule-one': '---\nrule-one:\n'
                                       '  description: Sample HBAC rule\n'}
 
+    def test_prune_ipa_data(self):
+        data = {u'cn': (u'rule-one',), u'description': (u'A rule',),
+                u'memberuser_group': (u'group-one',),
+                u'memberhost_hostgroup': (u'hosts-one',),
+                u'ipaenabledflag': (u'TRUE',), u'accessruletype': (u'allow',),
+                u'dn': u'ipaUniqueID=ab-cd,cn=hbac'}
+        assert tool.FreeIPAHBACRule.prune_ipa_data(data) == {
+            u'cn': (u'rule-one',), u'description': (u'A rule',),
+            u'memberuser_group': (u'group-one',),
+            u'memberhost_hostgroup': (u'hosts-one',)}
+
 
 class TestFreeIPASudoRule(object):
     def setup_method(self, method):
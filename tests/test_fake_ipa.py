@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import logging
+import pytest
+
+from _utils import _import
+tool = _import('benchmarks', 'fake_ipa')
+push_pull = _import('benchmarks', 'push_pull')
+command = _import('ipamanager', 'command')
+
+
+class TestFakeIpaApi(object):
+    def setup_method(self, method):
+        self.api = tool.FakeIpaApi()
+        self.api.add('user', 'user1', givenname='First', sn='User')
+        self.api.add('user', 'user2', givenname='Second', sn='User')
+        self.api.add('group', 'group1', member_user=['user1'])
+
+    def test_find(self):
+        result = self.api.Command['user_find'](all=True, sizelimit=0)
+        assert result['count'] == 2
+        assert result['result'] == (
+            {'uid': (u'user1',), 'givenname': (u'First',), 'sn': (u'User',),
+             'memberof_group': (u'group1',)},
+            {'uid': (u'user2',), 'givenname': (u'Second',),
+             'sn': (u'User',)})
+
+    def test_find_pkey_only(self):
+        result = self.api.Command['user_find'](sizelimit=0, pkey_only=True)
+        assert result['result'] == ({'uid': (u'user1',)},
+                                    {'uid': (u'user2',)})
+
+    def test_add(self):
+        self.api.Command['group_add'](cn=u'group2', description=u'Group')
+        self.api.Command['group_add'](cn=u'group3', nonposix=True)
+        groups = self.api.snapshot()['group']
+        assert groups['group2'] == {
+            'cn': [u'group2'], 'description': [u'Group'],
+            'objectclass': [u'groupofnames', u'ipausergroup',
+                            u'posixgroup']}
+        assert self.api.entries['group']['group2']['gidnumber'] == [u'10001']
+        assert groups['group3']['objectclass'] == [
+            u'groupofnames', u'ipausergroup']
+
+    def test_add_duplicate(self):
+        with pytest.raises(tool.FakeIpaError) as exc:
+            self.api.Command['user_add'](uid=u'user1', sn=u'User')
+        assert exc.value.name == 'DuplicateEntry'
+
+    def test_mod(self):
+        self.api.Command['group_add'](cn=u'group2')
+        self.api.Command['group_mod'](
+            cn=u'group2', setattr=(u'gidnumber=',),
+            delattr=(u'objectclass=posixgroup',))
+        assert self.api.entries['group']['group2'] == {
+            'cn': [u'group2'], 'objectclass': [u'ipausergroup',
+                                               u'groupofnames']}
+        self.api.Command['group_mod'](cn=u'group2', posix=True)
+        assert self.api.entries['group']['group2']['gidnumber'] == [u'10002']
+
+    def test_mod_empty(self):
+        with pytest.raises(tool.FakeIpaError) as exc:
+            self.api.Command['user_mod'](uid=u'user1', sn=u'User')
+        assert exc.value.name == 'EmptyModlist'
+
+    def test_del(self):
+        self.api.Command['user_del'](uid=u'user1')
+        assert self.api.snapshot()['group']['group1'] == {'cn': [u'group1']}
+        with pytest.raises(tool.FakeIpaError) as exc:
+            self.api.Command['user_del'](uid=u'user1')
+        assert exc.value.name == 'NotFound'
+
+    def test_add_member(self):
+        result = self.api.Command['group_add_member'](
+            cn=u'group1', user=(u'user1', u'user2', u'user3'))
+        assert result['completed'] == 1
+        assert result['failed'] == {'member': {'user': (
+            (u'user1', u'This entry is already a member'),
+            (u'user3', u'no such entry'))}}
+        assert self.api.entries['group']['group1']['member_user'] == [
+            u'user1', u'user2']
+
+    def test_rule_members_and_options(self):
+        self.api.add('sudorule', 'rule1')
+        self.api.Command['sudorule_add_user'](cn=u'rule1', group=u'group1')
+        self.api.Command['sudorule_add_option'](
+            cn=u'rule1', ipasudoopt=u'!authenticate')
+        self.api.Command['sudorule_remove_option'](
+            cn=u'rule1', ipasudoopt=u'!authenticate')
+        assert self.api.snapshot()['sudorule']['rule1'] == {
+            'cn': [u'rule1'], 'memberuser_group': [u'group1']}
+
+    def test_unknown_command(self):
+        with pytest.raises(tool.FakeIpaError) as exc:
+            self.api.Command['user_frobnicate'](uid=u'user1')
+        assert exc.value[0] == 'unknown command user_frobnicate'
+
+    def test_fail_commands(self):
+        self.api.fail_commands.add('user_add')
+        with pytest.raises(tool.FakeIpaError) as exc:
+            self.api.Command['user_add'](uid=u'user3', sn=u'User')
+        assert exc.value.name == 'NetworkError'
+        assert 'user3' not in self.api.entries['user']
+
+    def test_error_rate(self):
+        self.api.error_rate = 0.5
+        errors = 0
+        for _ in range(100):
+            try:
+                self.api.Command['user_show'](uid=u'user1')
+            except tool.FakeIpaError:
+                errors += 1
+        assert 30 < errors < 70
+
+    def test_batch(self):
+        result = self.api.Command['batch'](
+            {'method': 'user_mod', 'params': [[], {'uid': u'user1',
+                                                   'sn': u'Changed'}]},
+            {'method': 'user_mod', 'params': [[], {'uid': u'user3',
+                                                   'sn': u'Changed'}]})
+        assert result['count'] == 2
+        assert result['results'][0]['value'] == u'user1'
+        assert result['results'][1] == {
+            'error': u'user3: user not found', 'error_name': 'NotFound',
+            'error_code': 4001}
+        assert self.api.calls['calls'] == 1
+
+    def test_execute_commands(self):
+        commands = [
+            command.Command('user_add', {'sn': 'User'}, 'user3', 'uid'),
+            command.Command('group_add_member', {'user': ('user3',)},
+                            'group1', 'cn')]
+        assert command.Command.execute_batch(self.api, commands) == [
+            None, None]
+        assert self.api.snapshot()['group']['group1']['member_user'] == [
+            u'user1', u'user3']
+
+
+class TestFakeIpaServer(object):
+    def setup_method(self, method):
+        self.api = tool.FakeIpaApi()
+        self.api.add('user', 'user1', sn='User')
+        self.server = tool.FakeIpaServer(self.api).start()
+        self.client = tool.FakeIpaClient(self.server.port)
+
+    def teardown_method(self, method):
+        self.client.Backend.rpcclient.disconnect()
+        self.server.stop()
+
+    def test_call(self):
+        result = self.client.Command['user_find'](all=True, sizelimit=0)
+        assert result['result'] == ({'uid': (u'user1',), 'sn': (u'User',)},)
+        self.client.Command['user_mod'](uid=u'user1', sn=u'Changed')
+        assert self.api.entries['user']['user1']['sn'] == [u'Changed']
+
+    def test_call_error(self):
+        with pytest.raises(tool.FakeIpaError) as exc:
+            self.client.Command['user_del'](uid=u'user2')
+        assert exc.value[0] == 'user2: user not found'
+        assert exc.value.name == 'NotFound'
+
+
+class TestRoundTrip(object):
+    def setup_method(self, method):
+        logging.disable(logging.ERROR)
+
+    def teardown_method(self, method):
+        logging.disable(logging.NOTSET)
+
+    @pytest.mark.parametrize('settings', [
+        {}, {'api-batch-size': 10, 'push-workers': 3}])
+    def test_round_trip(self, tmpdir, settings):
+        source, target = tool.FakeIpaApi(), tool.FakeIpaApi()
+        tool.populate(source, 50, 10, 5, 3)
+        timings = push_pull.round_trip(
+            source, target, settings, tmpdir.strpath)
+        assert [i[0] for i in timings] == ['pull', 'load', 'check', 'push']
+        assert source.snapshot() == target.snapshot()
+        assert len(target.snapshot()['user']) == 50
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright © 2017-2019, GoodData Corporation. All rights reserved.
 
+import json
 import logging
 import mock
 import os
@@ -107,12 +108,84 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
     def test_run_check(self, mock_config, mock_check, log):
         manager = self._init_tool(['check', 'config_path', '-v'])
         manager.run()
-        mock_config.assert_called_with('config_path', manager.settings, True)
+        mock_config.assert_called_with(
+            'config_path', manager.settings, True, 1, '~/.ipamanager-cache',
+            None, None, None, metrics=manager.metrics)
         mock_check.assert_called_with(
             manager.config_loader.load.return_value, manager.settings)
         log.check(('FreeIPAManager', 'INFO',
                    'No alerting plugins configured in settings'))
 
+    @mock.patch('%s.IntegrityChecker' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_run_check_workers(self, mock_config, mock_check):
+        manager = self._init_tool(['check', 'config_path', '-w', '4'])
+        manager.run()
+        mock_config.assert_called_with(
+            'config_path', manager.settings, True, 4, '~/.ipamanager-cache',
+            None, None, None, metrics=manager.metrics)
+
+    @mock.patch('%s.IntegrityChecker' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_run_check_no_cache(self, mock_config, mock_check):
+        manager = self._init_tool(['check', 'config_path', '--no-cache'])
+        manager.run()
+        mock_config.assert_called_with(
+            'config_path', manager.settings, True, 1, None, None, None,
+            None, metrics=manager.metrics)
+
+    @mock.patch('%s.IntegrityChecker' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_run_check_since(self, mock_config, mock_check):
+        manager = self._init_tool(['check', 'config_path', '--since',
+                                   'origin/master', '--state', 'state'])
+        manager.run()
+        mock_config.assert_called_with(
+            'config_path', manager.settings, True, 1, '~/.ipamanager-cache',
+            'origin/master', 'state', None, metrics=manager.metrics)
+
+    @mock.patch('%s.IntegrityChecker' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_run_check_revision(self, mock_config, mock_check):
+        manager = self._init_tool(
+            ['check', 'config_path', '--revision', 'HEAD~50'])
+        manager.run()
+        mock_config.assert_called_with(
+            'config_path', manager.settings, True, 1, '~/.ipamanager-cache',
+            None, None, 'HEAD~50', metrics=manager.metrics)
+
+    def test_run_since_with_revision(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            self._init_tool(['check', 'config_path', '--since', 'HEAD',
+                             '--state', 'state', '--revision', 'HEAD~1'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert 'error: argument --revision: not allowed with --since' in err
+
+    @pytest.mark.parametrize('action', ['pull', 'roundtrip'])
+    def test_run_revision_writing_action(self, capsys, action):
+        with pytest.raises(SystemExit) as exc:
+            self._init_tool([action, 'config_path', '--revision', 'HEAD~1'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert ('error: argument --revision: not allowed with %s' % action
+                in err)
+
+    def test_run_since_without_state(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            self._init_tool(['check', 'config_path', '--since', 'HEAD'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert 'error: argument --since: requires --state' in err
+
+    def test_run_workers_bad_value(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            self._init_tool(['check', 'config_path', '-w', '-1'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert ("manager check: error: argument -w/--workers: "
+                "must be a non-negative number") in err
+
     @mock.patch('%s.IntegrityChecker' % modulename)
     @mock.patch('%s.ConfigLoader' % modulename)
     @mock.patch('%s.logging.RootLogger.addHandler' % modulename)
@@ -131,7 +204,9 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
             }
         }
         manager.run()
-        mock_config.assert_called_with('config_path', manager.settings, True)
+        mock_config.assert_called_with(
+            'config_path', manager.settings, True, 1, '~/.ipamanager-cache',
+            None, None, None, metrics=manager.metrics)
         mock_check.assert_called_with(
             manager.config_loader.load.return_value, manager.settings)
         plugin1 = mock_import(
@@ -163,13 +238,80 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
         captured_errors.check(
             ('FreeIPAManager', 'ERROR', 'Error loading config'))
 
+    @mock.patch('%s.IntegrityChecker' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_run_check_metrics(self, mock_config, mock_check, tmpdir):
+        stats = tmpdir.join('stats.json')
+        prom = tmpdir.join('ipamanager.prom')
+        self._init_tool(['check', 'config_path', '--stats', stats.strpath,
+                         '--prometheus', prom.strpath]).run()
+        data = json.loads(stats.read())
+        assert data['action'] == 'check'
+        assert data['success'] is True
+        assert sorted(data['phases']) == ['check', 'load', 'settings']
+        assert 'ipamanager_run_success{action="check"} 1' in prom.read()
+
+    def test_run_check_trace(self, tmpdir):
+        trace = tmpdir.join('trace.jsonl')
+        manager = self._init_tool(
+            ['check', 'config_path', '--trace', trace.strpath])
+        with mock.patch('%s.Tracer.close' % modulename) as mock_close:
+            with mock.patch('%s.FreeIPAManager.check' % modulename):
+                manager.run()
+        mock_close.assert_called_with()
+        assert trace.check()
+
+    def test_init_profile(self, tmpdir):
+        manager = self._init_tool(['check', 'config_path'])
+        assert manager.metrics.profiler is None
+        manager = self._init_tool(
+            ['check', 'config_path', '--profile', tmpdir.strpath])
+        assert manager.metrics.profiler.profiles.keys() == ['settings']
+
+    @mock.patch('%s.IntegrityChecker' % modulename)
+    @mock.patch('%s.ConfigLoader' % modulename)
+    def test_run_check_profile(self, mock_config, mock_check, tmpdir):
+        self._init_tool(
+            ['check', 'config_path', '--profile', tmpdir.strpath]).run()
+        assert sorted(i.basename for i in tmpdir.listdir()) == [
+            'check.memory.txt', 'check.pstats', 'load.memory.txt',
+            'load.pstats', 'settings.memory.txt', 'settings.pstats']
+
+    def test_init_tracer(self, tmpdir):
+        trace = tmpdir.join('trace.jsonl').strpath
+        manager = self._init_tool(['check', 'config_path'])
+        assert manager.metrics.tracer.threshold == 10
+        assert manager.metrics.tracer.output is None
+        with mock.patch('%s.utils.load_settings' % modulename,
+                        return_value={'slow-call-threshold': 0.5}):
+            manager = self._init_tool(['check', 'config_path',
+                                       '--trace', trace])
+        assert manager.metrics.tracer.threshold == 0.5
+        assert manager.metrics.tracer.path == trace
+
+    def test_run_check_metrics_error(self, tmpdir):
+        stats = tmpdir.join('stats.json')
+        prom = tmpdir.join('missing', 'ipamanager.prom').strpath
+        with mock.patch('%s.ConfigLoader.load' % modulename) as mock_load:
+            mock_load.side_effect = errors.ConfigError('Error loading config')
+            with pytest.raises(SystemExit):
+                with LogCapture('FreeIPAManager', level=logging.ERROR) as log:
+                    self._init_tool(['check', 'nonexistent', '--stats',
+                                     stats.strpath, '--prometheus', prom]).run()
+        assert json.loads(stats.read())['success'] is False
+        log.check(
+            ('FreeIPAManager', 'ERROR', 'Error loading config'),
+            ('FreeIPAManager', 'ERROR', StringComparison(
+                'Cannot write metrics to %s: .*' % prom)))
+
     def test_run_push(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
             with mock.patch('%s.FreeIPAManager.check' % modulename):
                 manager = self._init_tool(['push', 'config_repo', '-ft', '10'])
                 manager.entities = dict()
                 manager.run()
-        mock_conn.assert_called_with(manager.settings, {}, 10, True, False)
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, True, False, metrics=manager.metrics)
 
     def test_run_push_enable_deletion(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
@@ -177,7 +319,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager = self._init_tool(['push', 'repo_path', '-fdt', '10'])
                 manager.entities = dict()
                 manager.run()
-        mock_conn.assert_called_with(manager.settings, {}, 10, True, True)
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, True, True, metrics=manager.metrics)
 
     def test_run_push_dry_run(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
@@ -185,7 +328,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager = self._init_tool(['push', 'config_repo'])
                 manager.entities = dict()
                 manager.run()
-        mock_conn.assert_called_with(manager.settings, {}, 10, False, False)
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, False, False, metrics=manager.metrics)
 
     def test_run_push_dry_run_enable_deletion(self):
         with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
@@ -193,7 +337,71 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager = self._init_tool(['push', 'config_repo', '-d'])
                 manager.entities = dict()
                 manager.run()
-        mock_conn.assert_called_with(manager.settings, {}, 10, False, True)
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, False, True, metrics=manager.metrics)
+
+    def test_run_push_save_plan(self):
+        with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
+            with mock.patch('%s.FreeIPAManager.check' % modulename) as check:
+                manager = self._init_tool(
+                    ['push', 'config_repo', '--save-plan', 'plan.json'])
+                manager.entities = dict()
+                manager.run()
+        check.assert_called_with()
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, False, False, metrics=manager.metrics)
+        mock_conn.return_value.push.assert_called_with('plan.json', None)
+
+    def test_run_push_apply_plan(self):
+        with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
+            with mock.patch('%s.FreeIPAManager.check' % modulename) as check:
+                manager = self._init_tool(
+                    ['push', 'config_repo', '-f', '--apply-plan', 'plan.json'])
+                manager.run()
+        check.assert_not_called()
+        mock_conn.assert_called_with(
+            manager.settings, {}, 10, True, False, metrics=manager.metrics)
+        mock_conn.return_value.apply_plan.assert_called_with(
+            'plan.json', None, False)
+        mock_conn.return_value.push.assert_not_called()
+
+    def test_run_push_resume(self):
+        with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
+            with mock.patch('%s.FreeIPAManager.check' % modulename) as check:
+                manager = self._init_tool(
+                    ['push', 'config_repo', '-f', '--apply-plan', 'plan.json',
+                     '--journal', 'journal.json', '--resume'])
+                manager.run()
+        check.assert_not_called()
+        mock_conn.return_value.apply_plan.assert_called_with(
+            'plan.json', 'journal.json', True)
+
+    def test_run_push_journal(self):
+        with mock.patch('ipamanager.ipa_connector.IpaUploader') as mock_conn:
+            with mock.patch('%s.FreeIPAManager.check' % modulename):
+                manager = self._init_tool(
+                    ['push', 'config_repo', '-f', '--journal', 'journal.json'])
+                manager.entities = dict()
+                manager.run()
+        mock_conn.return_value.push.assert_called_with(None, 'journal.json')
+
+    def test_run_push_resume_no_plan(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            self._init_tool(['push', 'config_repo', '-f',
+                             '--journal', 'journal.json', '--resume'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert ('argument --resume: requires --apply-plan and --journal'
+                in err)
+
+    def test_run_push_plan_both(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            self._init_tool(['push', 'config_repo', '--save-plan', 'a.json',
+                             '--apply-plan', 'b.json'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert ('argument --apply-plan: not allowed with argument '
+                '--save-plan') in err
 
     def test_run_pull(self):
         with mock.patch('ipamanager.ipa_connector.IpaDownloader') as mock_conn:
@@ -202,7 +410,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(manager.settings, manager.entities,
-                                     'dump_repo', False, False, ['user'])
+                                     'dump_repo', False, False, ['user'],
+                                     metrics=manager.metrics)
         manager.downloader.pull.assert_called_with()
 
     def test_run_pull_dry_run(self):
@@ -212,7 +421,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(manager.settings, manager.entities,
-                                     'dump_repo', True, False, ['user'])
+                                     'dump_repo', True, False, ['user'],
+                                     metrics=manager.metrics)
         manager.downloader.pull.assert_called()
 
     def test_run_pull_add_only(self):
@@ -222,7 +432,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
                 manager.entities = dict()
                 manager.run()
         mock_conn.assert_called_with(manager.settings, manager.entities,
-                                     'dump_repo', False, True, ['user'])
+                                     'dump_repo', False, True, ['user'],
+                                     metrics=manager.metrics)
         manager.downloader.pull.assert_called()
 
     def test_run_diff(self):
@@ -259,7 +470,8 @@ class TestFreeIPAManagerRun(TestFreeIPAManagerBase):
     def _mock_load(self):
         def f(manager, *args, **kwargs):
             self.mock_load_args = (args, kwargs)
-            manager.entities = {'users': {'user1': mock.Mock()}}
+            manager.entities = {'users': {'user1': mock.Mock(
+                **{'write_to_file.return_value': 42})}}
         return f
 
     def test_run_roundtrip(self):
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import logging
+import mock
+import os.path
+import pytest
+import shutil
+import subprocess
+from testfixtures import log_capture
+
+from _utils import _import
+tool = _import('ipamanager', 'git_repo')
+cache = _import('ipamanager', 'cache')
+config_loader = _import('ipamanager', 'config_loader')
+testpath = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_CORRECT = os.path.join(testpath, 'freeipa-manager-config/correct')
+SETTINGS = {'ignore': {'group': ['group-one-users']}}
+
+
+class TestGitBase(object):
+    def setup_method(self, method):
+        self.tmpdir = os.path.join(
+            '/tmp', 'ipamanager-git-test-%d' % os.getpid())
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        self.state_path = os.path.join(self.tmpdir, 'state.pickle')
+        shutil.copytree(CONFIG_CORRECT, self.repo)
+        self._git('init', '-q')
+        self._commit()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def _git(self, *args):
+        cmd = ('git', '-c', 'user.name=test', '-c', 'user.email=test@test')
+        return subprocess.check_output(cmd + args, cwd=self.repo)
+
+    def _commit(self):
+        self._git('add', '-A', '.')
+        self._git('commit', '-q', '-m', 'commit')
+        return self._git('rev-parse', 'HEAD').strip()
+
+    def _path(self, key):
+        return os.path.join(self.repo, key)
+
+    def _write(self, key, contents):
+        with open(self._path(key), 'w') as target:
+            target.write(contents)
+
+
+class TestGitRepo(TestGitBase):
+    def test_resolve(self):
+        repo = tool.GitRepo(self.repo)
+        assert repo.resolve('HEAD') == self._git('rev-parse', 'HEAD').strip()
+        assert repo.resolve('master') == repo.resolve('HEAD')
+
+    def test_resolve_invalid(self):
+        with pytest.raises(tool.ConfigError) as exc:
+            tool.GitRepo(self.repo).resolve('nonexistent')
+        assert exc.value[0] == (
+            'git rev-parse failed: fatal: Needed a single revision')
+
+    def test_resolve_not_repository(self):
+        with pytest.raises(tool.ConfigError) as exc:
+            tool.GitRepo('/').resolve('HEAD')
+        assert exc.value[0].startswith(
+            'git rev-parse failed: fatal: not a git repository')
+
+    def test_resolve_no_git(self):
+        with pytest.raises(tool.ConfigError) as exc:
+            tool.GitRepo('/nonexistent/path').resolve('HEAD')
+        assert exc.value[0].startswith('Cannot run git: ')
+
+    def test_changed_files_none(self):
+        assert tool.GitRepo(self.repo).changed_files('HEAD') == set()
+
+    def test_changed_files(self):
+        base = self._git('rev-parse', 'HEAD').strip()
+        self._write('users/new.yaml', '---\nnew.user: {}\n')
+        self._git('mv', 'groups/group_two.yaml', 'groups/group_2.yaml')
+        self._commit()
+        self._write('roles/role_one.yaml', '---\nchanged: {}\n')
+        os.unlink(self._path('roles/role_two.yaml'))
+        self._write('services/untracked.yaml', '---\n')
+        assert tool.GitRepo(self.repo).changed_files(base) == set([
+            'users/new.yaml', 'groups/group_two.yaml', 'groups/group_2.yaml',
+            'roles/role_one.yaml', 'roles/role_two.yaml',
+            'services/untracked.yaml'])
+
+    def test_changed_files_gitignored(self):
+        self._write('.gitignore', '*.swp\nstate.pickle\n')
+        self._commit()
+        self._write('users/.new.yaml.swp', 'swap')
+        self._write('state.pickle', 'state')
+        self._write('users/new.yaml', '---\nnew.user: {}\n')
+        assert tool.GitRepo(self.repo).changed_files('HEAD') == set([
+            'users/new.yaml'])
+
+    def test_changed_files_subdirectory(self):
+        self._write('users/new.yaml', '---\nnew.user: {}\n')
+        self._write('groups/group_two.yaml', '---\nchanged: {}\n')
+        changed = tool.GitRepo(self._path('users')).changed_files('HEAD')
+        assert changed == set(['new.yaml'])
+
+
+class TestIncrementalLoading(TestGitBase):
+    def _load(self, since=None, state_path=None):
+        loader = config_loader.ConfigLoader(
+            self.repo, SETTINGS, since=since, state_path=state_path)
+        loader.load()
+        return loader
+
+    def _check_same_as_full(self, loader):
+        full = self._load()
+        assert sorted(loader.entities) == sorted(full.entities)
+        for entity_type, entity_list in full.entities.iteritems():
+            assert loader.entities[entity_type] == entity_list
+            for name, entity in entity_list.iteritems():
+                loaded = loader.entities[entity_type][name]
+                assert loaded.data_repo == entity.data_repo
+                assert loaded.path == entity.path
+
+    def test_save_state(self):
+        loader = self._load(state_path=self.state_path)
+        state = cache.ConfigState(
+            self.state_path, cache.cache_stamp())
+        assert state.load()
+        assert state.revision == self._git('rev-parse', 'HEAD').strip()
+        assert len(state.entries) == len(loader.results) == 34
+        assert state.entries['users/test_user.yaml'][0][1].name == 'test.user'
+
+    @log_capture('ConfigLoader', level=logging.INFO)
+    def test_save_state_uncommitted(self, captured_log):
+        self._write('users/new.yaml',
+                    '---\nnew.user:\n  firstName: New\n  lastName: User\n')
+        self._load(state_path=self.state_path)
+        assert not os.path.exists(self.state_path)
+        assert captured_log.records[-1].msg % captured_log.records[-1].args \
+            == 'Uncommitted changes in %s, not saving state' % self.repo
+
+    @log_capture('ConfigLoader', level=logging.WARNING)
+    def test_save_state_not_repository(self, captured_log):
+        shutil.rmtree(self._path('.git'))
+        self._load(state_path=self.state_path)
+        assert not os.path.exists(self.state_path)
+        assert captured_log.records[-1].msg == 'Cannot save config state: %s'
+
+    @log_capture('ConfigLoader', level=logging.INFO)
+    def test_save_state_other_revision(self, captured_log):
+        self._load(state_path=self.state_path)
+        base = self._git('rev-parse', 'HEAD').strip()
+        self._write('users/new.yaml',
+                    '---\nnew.user:\n  firstName: New\n  lastName: User\n')
+        self._commit()
+        loader = self._load(base, self.state_path)
+        assert 'new.user' in loader.entities['user']
+        state = cache.ConfigState(self.state_path, cache.cache_stamp())
+        assert state.load()
+        assert state.revision == base
+        assert captured_log.records[-1].msg % captured_log.records[-1].args \
+            == 'HEAD is not at %s, not saving state' % base
+
+    def test_save_state_incremental_same_revision(self):
+        self._load(state_path=self.state_path)
+        self._write('users/new.yaml',
+                    '---\nnew.user:\n  firstName: New\n  lastName: User\n')
+        self._commit()
+        self._load('HEAD', self.state_path)
+        state = cache.ConfigState(self.state_path, cache.cache_stamp())
+        assert state.load()
+        assert state.revision == self._git('rev-parse', 'HEAD').strip()
+        assert 'users/new.yaml' in state.entries
+
+    def test_state_not_saved_on_error(self):
+        self._write('users/new.yaml', '---\nnew.user: {extra: key}\n')
+        self._commit()
+        with pytest.raises(config_loader.ConfigError):
+            self._load(state_path=self.state_path)
+        assert not os.path.exists(self.state_path)
+
+    def test_load_incremental(self):
+        self._load(state_path=self.state_path)
+        base = self._git('rev-parse', 'HEAD').strip()
+        self._git('mv', 'groups/group_two.yaml', 'groups/group_2.yaml')
+        self._git('rm', '-q', 'roles/role_two.yaml')
+        self._write('hostgroups/group_one.yaml',
+                    '---\nhostgroup-one:\n  description: changed\n')
+        self._commit()
+        self._write('users/new.yaml',
+                    '---\nnew.user:\n  firstName: New\n  lastName: User\n')
+        os.unlink(self._path('privileges/privilege_three.yaml'))
+        self._write('users/.hidden.yaml', '---\n')
+        self._write('users/notes.txt', 'not a config file')
+        with mock.patch('ipamanager.config_loader._load_file',
+                        wraps=config_loader._load_file) as mock_load:
+            loader = self._load(base, self.state_path)
+        assert sorted(i[0][0][1] for i in mock_load.call_args_list) == [
+            self._path('groups/group_2.yaml'),
+            self._path('hostgroups/group_one.yaml'),
+            self._path('users/new.yaml')]
+        assert 'group-two' in loader.entities['group']
+        assert 'role-two' not in loader.entities['role']
+        assert 'privilege_three' not in loader.entities['privilege']
+        assert loader.entities['hostgroup']['hostgroup-one'].data_repo == {
+            'description': 'changed'}
+        self._check_same_as_full(loader)
+
+    def test_load_incremental_errors(self):
+        self._load(state_path=self.state_path)
+        self._write('users/new.yaml',
+                    '---\ntest.user:\n  firstName: New\n  lastName: User\n')
+        self._write('roles/role_one.yaml', 'invalid')
+        with pytest.raises(config_loader.ConfigError) as exc:
+            self._load('HEAD', self.state_path)
+        full = config_loader.ConfigLoader(self.repo, SETTINGS)
+        with pytest.raises(config_loader.ConfigError) as exc_full:
+            full.load()
+        assert exc.value[0] == exc_full.value[0] == (
+            'There have been errors in 2 configuration files: '
+            '[roles/role_one.yaml, users/test_user.yaml]')
+
+    @log_capture('ConfigLoader', level=logging.WARNING)
+    def test_load_incremental_other_revision(self, captured_log):
+        self._load(state_path=self.state_path)
+        self._write('users/new.yaml',
+                    '---\nnew.user:\n  firstName: New\n  lastName: User\n')
+        self._commit()
+        with mock.patch('ipamanager.config_loader._load_file',
+                        wraps=config_loader._load_file) as mock_load:
+            loader = self._load('HEAD', self.state_path)
+        assert mock_load.call_count == 35
+        self._check_same_as_full(loader)
+        assert captured_log.records[0].msg == (
+            'Config state is at %s, not at %s (%s); loading all files')
+
+    @log_capture('ConfigLoader', level=logging.INFO)
+    def test_load_incremental_no_state(self, captured_log):
+        with mock.patch('ipamanager.config_loader._load_file',
+                        wraps=config_loader._load_file) as mock_load:
+            loader = self._load('HEAD', self.state_path)
+        assert mock_load.call_count == 34
+        self._check_same_as_full(loader)
+        assert os.path.exists(self.state_path)
+
+    def test_load_incremental_outdated_state(self):
+        self._load(state_path=self.state_path)
+        with mock.patch('ipamanager.cache.CACHE_FORMAT', 42):
+            with mock.patch('ipamanager.config_loader._load_file',
+                            wraps=config_loader._load_file) as mock_load:
+                loader = config_loader.ConfigLoader(
+                    self.repo, {}, since='HEAD', state_path=self.state_path)
+                loader.load()
+        assert mock_load.call_count == 34
+
+    def test_load_incremental_invalid_revision(self):
+        self._load(state_path=self.state_path)
+        with pytest.raises(config_loader.ConfigError) as exc:
+            self._load('nonexistent', self.state_path)
+        assert exc.value[0] == (
+            'git rev-parse failed: fatal: Needed a single revision')
+
+
+class TestGitObjects(TestGitBase):
+    def test_prefix(self):
+        assert tool.GitRepo(self.repo).prefix() == ''
+        assert tool.GitRepo(self._path('users')).prefix() == 'users/'
+
+    def test_read_object(self):
+        repo = tool.GitRepo(self.repo)
+        obj_hash, obj_type, contents = repo.read_object(
+            'HEAD:users/test_user.yaml')
+        assert obj_type == 'blob'
+        with open(self._path('users/test_user.yaml')) as src:
+            assert contents == src.read()
+        assert repo.read_object(obj_hash) == (obj_hash, obj_type, contents)
+        assert repo.read_object('HEAD:users/nonexistent.yaml') is None
+        assert repo.batch.poll() is None  # single process for all reads
+        repo.close()
+        assert repo.batch is None
+
+    def test_read_object_not_repository(self):
+        with pytest.raises(tool.ConfigError) as exc:
+            tool.GitRepo('/').read_object('HEAD')
+        assert exc.value[0].startswith(
+            'git cat-file failed: fatal: not a git repository')
+
+    def test_list_tree(self):
+        repo = tool.GitRepo(self.repo)
+        entries = repo.list_tree('HEAD:hostgroups')
+        assert sorted(name for _, name, _ in entries) == [
+            'group_one.yaml', 'group_three.yaml', 'group_two.yaml']
+        for mode, name, obj_hash in entries:
+            assert mode == '100644'
+            assert obj_hash == self._git(
+                'rev-parse', 'HEAD:hostgroups/%s' % name).strip()
+        assert repo.list_tree('HEAD:nonexistent') is None
+        assert repo.list_tree('HEAD:users/test_user.yaml') is None
+
+
+class TestRevisionLoading(TestGitBase):
+    def _load(self, revision=None, path=None):
+        loader = config_loader.ConfigLoader(
+            path or self.repo, SETTINGS, revision=revision)
+        loader.load()
+        return loader
+
+    def _check_same(self, loader, expected):
+        assert sorted(loader.entities) == sorted(expected.entities)
+        for entity_type, entity_list in expected.entities.iteritems():
+            assert loader.entities[entity_type] == entity_list
+            for name, entity in entity_list.iteritems():
+                loaded = loader.entities[entity_type][name]
+                assert loaded.data_repo == entity.data_repo
+                assert loaded.path == entity.path
+
+    def test_load_revision(self):
+        expected = self._load()
+        self._write('hostgroups/group_one.yaml',
+                    '---\nhostgroup-one:\n  description: changed\n')
+        self._git('mv', 'groups/group_two.yaml', 'groups/group_2.yaml')
+        self._commit()
+        shutil.rmtree(self._path('users'))
+        loader = self._load('HEAD~1')
+        self._check_same(loader, expected)
+        assert loader.git.batch is None
+
+    def test_load_revision_head(self):
+        self._write('hostgroups/group_one.yaml',
+                    '---\nhostgroup-one:\n  description: changed\n')
+        self._git('mv', 'groups/group_two.yaml', 'groups/group_2.yaml')
+        self._commit()
+        expected = self._load()
+        self._write('hostgroups/group_one.yaml', 'uncommitted')
+        self._check_same(self._load('HEAD'), expected)
+
+    def test_load_revision_subdirectory(self):
+        shutil.copytree(CONFIG_CORRECT, self._path('domain'))
+        self._commit()
+        expected = self._load(path=self._path('domain'))
+        for folder in os.listdir(self._path('domain')):
+            if os.path.isdir(self._path('domain/%s' % folder)):
+                shutil.rmtree(self._path('domain/%s' % folder))
+        self._check_same(
+            self._load('HEAD', path=self._path('domain')), expected)
+
+    def test_load_revision_errors(self):
+        self._write('users/new.yaml',
+                    '---\ntest.user:\n  firstName: New\n  lastName: User\n')
+        self._write('roles/role_one.yaml', 'invalid')
+        self._commit()
+        with pytest.raises(config_loader.ConfigError) as exc:
+            self._load()
+        with pytest.raises(config_loader.ConfigError) as exc_revision:
+            self._load('HEAD')
+        assert exc_revision.value[0] == exc.value[0]
+
+    @log_capture('ConfigLoader', level=logging.WARNING)
+    def test_load_revision_not_regular_file(self, captured_log):
+        os.symlink('test_user.yaml', self._path('users/link.yaml'))
+        self._commit()
+        loader = self._load('HEAD')
+        assert len(loader.entities['user']) == 3
+        captured_log.check(
+            ('ConfigLoader', 'WARNING',
+             'Not loading %s, not a regular file (mode 120000)'
+             % self._path('users/link.yaml')))
+
+    def test_load_revision_reuse_blobs(self):
+        self._write('hostgroups/group_one.yaml',
+                    '---\ngroup-one-hosts:\n  description: changed\n')
+        self._commit()
+        loader = config_loader.ConfigLoader(
+            self.repo, SETTINGS, revision='HEAD~1')
+        with mock.patch('ipamanager.config_loader._load_file',
+                        wraps=config_loader._load_file) as mock_load:
+            loader.load()
+            assert mock_load.call_count == 34
+            first = loader.entities
+            loader.revision = 'HEAD'
+            loader.load()
+            assert mock_load.call_count == 35
+        assert mock_load.call_args[0][0][1] == self._path(
+            'hostgroups/group_one.yaml')
+        expected = self._load()
+        self._check_same(loader, expected)
+        assert first['hostgroup']['group-one-hosts'].data_repo == {
+            'description': 'Sample host group one'}
+        assert loader.entities['hostgroup']['group-one-hosts'].data_repo == {
+            'description': 'changed'}
+        assert first['user']['test.user'] is not (
+            loader.entities['user']['test.user'])
+
+    def test_load_revision_read_error(self):
+        loader = config_loader.ConfigLoader(
+            self.repo, SETTINGS, revision='HEAD')
+        with mock.patch('ipamanager.git_repo.GitRepo.list_tree') as tree:
+            tree.side_effect = config_loader.ConfigError('git failed')
+            with mock.patch('ipamanager.git_repo.GitRepo.close') as close:
+                with pytest.raises(config_loader.ConfigError):
+                    loader.load()
+        close.assert_called_once_with()
+
+    def test_load_revision_invalid(self):
+        with pytest.raises(config_loader.ConfigError) as exc:
+            self._load('nonexistent')
+        assert exc.value[0] == (
+            'git rev-parse failed: fatal: Needed a single revision')
@@ -7,6 +7,7 @@ import logging
 import mock
 import os.path
 import pytest
+import random
 from testfixtures import log_capture
 
 from _utils import _import
@@ -58,10 +59,10 @@ class TestIntegrityChecker(object):
 
     def test_check_correct_no_nesting_limit(self):
         self._create_checker(self._sample_entities_correct())
-        self.checker._check_nesting_level = mock.Mock()
+        self.checker._compute_nesting = mock.Mock()
         self.checker.check()
         assert not self.checker.errs
-        self.checker._check_nesting_level.assert_not_called()
+        self.checker._compute_nesting.assert_not_called()
 
     def test_check_memberof_nonexistent(self):
         self._create_checker(self._sample_entities_member_nonexistent())
@@ -181,6 +182,77 @@ class TestIntegrityChecker(object):
                 ('Cyclic membership: '
                  '[group group-two, group group-three, group group-one]')]}
 
+    def test_check_cycle_shortest_path(self):
+        self._create_checker(self._sample_entities_cycle_complex())
+        with pytest.raises(tool.IntegrityError):
+            self.checker.check()
+        assert self.checker.errs == {
+            ('group', 'group-one'): [
+                'Cyclic membership: [group group-one, group group-two]'],
+            ('group', 'group-two'): [
+                'Cyclic membership: [group group-two, group group-one]'],
+            ('group', 'group-three'): [
+                ('Cyclic membership: '
+                 '[group group-three, group group-one, group group-two]')],
+            ('hostgroup', 'hosts-one'): [
+                ('Cyclic membership: '
+                 '[hostgroup hosts-one, hostgroup hosts-two]')],
+            ('hostgroup', 'hosts-two'): [
+                ('Cyclic membership: '
+                 '[hostgroup hosts-two, hostgroup hosts-one]')]}
+
+    def test_check_cycle_long_chain(self):
+        groups = dict()
+        for i in range(5000):
+            name = 'group-%d' % i
+            groups[name] = tool.entities.FreeIPAUserGroup(
+                name, {'memberOf': {'group': ['group-%d' % (i + 1)]}}, 'path')
+        groups['group-5000'] = tool.entities.FreeIPAUserGroup(
+            'group-5000', {}, 'path')
+        self._create_checker({'group': groups})
+        self.checker.check()
+        assert not self.checker.errs
+        groups['group-5000'].data_repo['memberOf'] = {'group': ['group-4990']}
+        with pytest.raises(tool.IntegrityError):
+            self.checker.check()
+        assert len(self.checker.errs) == 11
+        path = self.checker.cycles[('group', 'group-4995')]
+        assert [i.name for i in path] == ['group-%d' % i for i in (
+            4995, 4996, 4997, 4998, 4999, 5000, 4990, 4991, 4992, 4993, 4994)]
+
+    def test_strongly_connected_components(self):
+        graph = {'a': ['b'], 'b': ['c', 'd'], 'c': ['a'], 'd': ['e'],
+                 'e': ['d', 'f'], 'f': [], 'g': ['g', 'a']}
+        assert sorted(sorted(i) for i in tool.strongly_connected_components(
+            graph)) == [['a', 'b', 'c'], ['d', 'e'], ['f'], ['g']]
+
+    def test_find_cycles_random(self):
+        rand = random.Random(42)
+        for _ in range(20):
+            graph = dict(('group-%d' % i, sorted(set(
+                'group-%d' % rand.randrange(30)
+                for _ in range(rand.randint(0, 2))))) for i in range(30))
+            self._create_checker({'group': dict(
+                (name, tool.entities.FreeIPAUserGroup(
+                    name, {'memberOf': {'group': targets}}, 'path'))
+                for name, targets in graph.iteritems())})
+            cycles = self.checker._find_cycles()
+            for name in graph:  # brute force reachability check
+                reached = set()
+                queue = list(graph[name])
+                while queue:
+                    target = queue.pop()
+                    if target not in reached:
+                        reached.add(target)
+                        queue.extend(graph[target])
+                assert (name in reached) == (('group', name) in cycles)
+            for (_, name), path in cycles.iteritems():
+                names = [i.name for i in path]
+                assert names[0] == name
+                assert len(set(names)) == len(names)
+                for i, target in enumerate(names[1:] + names[:1]):
+                    assert target in graph[names[i]]
+
     def test_check_nesting_limit_ok(self):
         self._create_checker(self._sample_entities_correct())
         self.checker.nesting_limit = 3
@@ -246,40 +318,173 @@ class TestIntegrityChecker(object):
             "group-one can only have members of type ['user', 'group']")
 
     @log_capture('IntegrityChecker', level=logging.DEBUG)
-    def test_check_nesting_level(self, captured_log):
+    def test_compute_nesting(self, captured_log):
         self._create_checker(self._sample_entities_correct())
-        assert self.checker._check_nesting_level(
-            'group', 'group-two') == 2
-        assert self.checker.nesting == {
-            'group': {'group-two': 2, 'group-three': 1, 'group-four': 0},
-            'hostgroup': {}}
-        assert self.checker._check_nesting_level(
-            'group', 'group-one-users') == 3
-        assert self.checker.nesting == {
+        assert self.checker._compute_nesting() == {
             'group': {'group-one-users': 3, 'group-two': 2,
                       'group-three': 1, 'group-four': 0},
-            'hostgroup': {}}
+            'hostgroup': {'group-one-hosts': 1, 'group-two': 0}}
         captured_log.check(
             ('IntegrityChecker', 'DEBUG',
-             'Checking nesting level for group group-two'),
-            ('IntegrityChecker', 'DEBUG',
-             'Checking nesting level for group group-three'),
-            ('IntegrityChecker', 'DEBUG',
-             'Checking nesting level for group group-four'),
-            ('IntegrityChecker', 'DEBUG',
-             'Nesting level of group group-four is 0'),
-            ('IntegrityChecker', 'DEBUG',
-             'Nesting level of group group-three is 1'),
-            ('IntegrityChecker', 'DEBUG',
-             'Nesting level of group group-two is 2'),
+             'Computed nesting levels of 4 group entities'),
             ('IntegrityChecker', 'DEBUG',
-             'Checking nesting level for group group-one-users'),
-            ('IntegrityChecker', 'DEBUG',
-             'Checking nesting level for group group-two'),
-            ('IntegrityChecker', 'DEBUG',
-             'Returning cached nesting level for group group-two (2)'),
-            ('IntegrityChecker', 'DEBUG',
-             'Nesting level of group group-one-users is 3'))
+             'Computed nesting levels of 2 hostgroup entities'))
+
+    def test_compute_nesting_longest_path(self):
+        groups = dict(
+            (name, tool.entities.FreeIPAUserGroup(
+                name, {'memberOf': {'group': targets}}, 'path'))
+            for name, targets in [
+                ('group-one', ['group-two', 'group-four', 'group-four']),
+                ('group-two', ['group-three']),
+                ('group-three', ['group-four', 'group-five']),
+                ('group-four', []), ('group-five', ['group-four'])])
+        self._create_checker({'group': groups})
+        assert self.checker._compute_nesting() == {
+            'group': {'group-one': 4, 'group-two': 3, 'group-three': 2,
+                      'group-four': 0, 'group-five': 1},
+            'hostgroup': {}}
+
+    def test_compute_nesting_cycle(self):
+        self._create_checker(self._sample_entities_cycle_complex())
+        assert self.checker._compute_nesting() == {
+            'group': {}, 'hostgroup': {}}
+
+    def test_compute_nesting_cycle_with_levelled_targets(self):
+        groups = dict(
+            (name, tool.entities.FreeIPAUserGroup(
+                name, {'memberOf': {'group': targets}}, 'path'))
+            for name, targets in [
+                ('group-root', []), ('group-one', ['group-root']),
+                ('group-two', ['group-one', 'group-three']),
+                ('group-three', ['group-two']),
+                ('group-four', ['group-two'])])
+        self._create_checker({'group': groups})
+        assert self.checker._compute_nesting() == {
+            'group': {'group-root': 0, 'group-one': 1}, 'hostgroup': {}}
+
+    def test_check_nesting_limit_long_chain(self):
+        groups = dict(
+            ('group-%d' % i, tool.entities.FreeIPAUserGroup(
+                'group-%d' % i,
+                {'memberOf': {'group': ['group-%d' % (i + 1)]}}, 'path'))
+            for i in range(5000))
+        groups['group-5000'] = tool.entities.FreeIPAUserGroup(
+            'group-5000', {}, 'path')
+        self._create_checker({'group': groups})
+        self.checker.nesting_limit = 4997
+        with pytest.raises(tool.IntegrityError):
+            self.checker.check()
+        assert self.checker.errs == {
+            ('group', 'group-0'): ['Nesting level exceeded: 5000 > 4997'],
+            ('group', 'group-1'): ['Nesting level exceeded: 4999 > 4997'],
+            ('group', 'group-2'): ['Nesting level exceeded: 4998 > 4997']}
+
+    def test_check_nesting_limit_cycle(self):
+        self._create_checker(self._sample_entities_cycle_complex())
+        self.checker.nesting_limit = 1
+        with pytest.raises(tool.IntegrityError):
+            self.checker.check()
+        assert sorted(self.checker.errs) == [
+            ('group', 'group-one'), ('group', 'group-three'),
+            ('group', 'group-two'), ('hostgroup', 'hosts-one'),
+            ('hostgroup', 'hosts-two')]
+
+    def test_check_changed_no_full_check(self):
+        self._create_checker(self._sample_entities_correct())
+        with mock.patch.object(self.checker, 'check') as mock_check:
+            self.checker.check_changed([('group', 'group-two')])
+        mock_check.assert_called_with()
+
+    @log_capture('IntegrityChecker', level=logging.INFO)
+    def test_check_changed(self, captured_log):
+        self._create_checker(self._sample_entities_correct())
+        self.checker.check()
+        groups = self.checker.entity_dict['group']
+        groups['group-four'].data_repo['memberOf'] = {
+            'group': ['group-two']}
+        with mock.patch.object(self.checker, '_check_single',
+                               wraps=self.checker._check_single) as checked:
+            with pytest.raises(tool.IntegrityError):
+                self.checker.check_changed([('group', 'group-four')])
+        assert sorted(i[0][0].name for i in checked.call_args_list) == [
+            'group-four', 'group-one-users', 'group-three', 'group-two']
+        assert sorted(self.checker.errs) == [
+            ('group', 'group-four'), ('group', 'group-three'),
+            ('group', 'group-two')]
+        del groups['group-four']
+        with pytest.raises(tool.IntegrityError):
+            self.checker.check_changed([('group', 'group-four')])
+        assert self.checker.errs == {
+            ('group', 'group-three'): [
+                'memberOf non-existent group group-four']}
+        captured_log.check_present(
+            ('IntegrityChecker', 'INFO',
+             'Running integrity check of 1 changed entities'))
+
+    def test_check_changed_random(self):
+        rand = random.Random(42)
+        settings = {'user-group-pattern': '^role-.+|.+-users$',
+                    'nesting-limit': 3}
+
+        def create(entity_type, name):
+            groups = ['group-%d' % rand.randrange(12)
+                      for _ in range(rand.randint(0, 2))]
+            hostgroups = ['hostgroup-%d' % rand.randrange(8)
+                          for _ in range(rand.randint(0, 2))]
+            if entity_type == 'group':
+                return tool.entities.FreeIPAUserGroup(
+                    name, {'memberOf': {'group': groups}}, 'path')
+            elif entity_type == 'hostgroup':
+                return tool.entities.FreeIPAHostGroup(
+                    name, {'memberOf': {'hostgroup': hostgroups}}, 'path')
+            elif entity_type == 'user':
+                data = {'firstName': 'Firstname', 'lastName': 'Lastname',
+                        'memberOf': {'group': groups}}
+                if rand.random() < 0.5:
+                    data['manager'] = 'user-%d' % rand.randrange(8)
+                return tool.entities.FreeIPAUser(name, data, 'path')
+            return tool.entities.FreeIPAHBACRule(
+                name, {'memberHost': hostgroups, 'memberUser': groups},
+                'path')
+
+        def full_check(parsed):
+            checker = tool.IntegrityChecker(parsed, settings)
+            try:
+                checker.check()
+            except tool.IntegrityError:
+                pass
+            return checker
+
+        parsed = dict()
+        for entity_type, count in [('group', 10), ('hostgroup', 6),
+                                   ('user', 6), ('hbacrule', 4)]:
+            parsed[entity_type] = dict(
+                (name, create(entity_type, name)) for name in (
+                    '%s-%d' % (entity_type, i) for i in range(count)))
+        self._create_checker(parsed)
+        self.checker.nesting_limit = 3
+        with pytest.raises(tool.IntegrityError):
+            self.checker.check_changed([])  # runs the full check
+        for _ in range(200):
+            changed = set()
+            for _ in range(rand.randint(1, 3)):
+                entity_type = rand.choice(sorted(parsed))
+                name = '%s-%d' % (entity_type, rand.randrange(12))
+                if rand.random() < 0.3:
+                    parsed[entity_type].pop(name, None)
+                else:
+                    parsed[entity_type][name] = create(entity_type, name)
+                changed.add((entity_type, name))
+            try:
+                self.checker.check_changed(changed)
+            except tool.IntegrityError:
+                pass
+            expected = full_check(parsed)
+            assert self.checker.errs == expected.errs
+            assert self.checker.cycles == expected.cycles
+            assert self.checker.nesting == expected.nesting
+            assert self.checker.references == expected.references
 
     def _sample_entities_correct(self):
         return {
@@ -418,6 +623,30 @@ class TestIntegrityChecker(object):
                     'group-two', {
                         'memberOf': {'group': ['group-one']}}, 'path')}}
 
+    def _sample_entities_cycle_complex(self):
+        return {
+            'group': {
+                'group-one': tool.entities.FreeIPAUserGroup(
+                    'group-one', {
+                        'memberOf': {'group': ['group-two']}}, 'path'),
+                'group-two': tool.entities.FreeIPAUserGroup(
+                    'group-two', {
+                        'memberOf': {'group': ['group-three', 'group-one']}},
+                    'path'),
+                'group-three': tool.entities.FreeIPAUserGroup(
+                    'group-three', {
+                        'memberOf': {'group': ['group-one']}}, 'path'),
+                'group-four': tool.entities.FreeIPAUserGroup(
+                    'group-four', {
+                        'memberOf': {'group': ['group-three']}}, 'path')},
+            'hostgroup': {
+                'hosts-one': tool.entities.FreeIPAHostGroup(
+                    'hosts-one', {
+                        'memberOf': {'hostgroup': ['hosts-two']}}, 'path'),
+                'hosts-two': tool.entities.FreeIPAHostGroup(
+                    'hosts-two', {
+                        'memberOf': {'hostgroup': ['hosts-one']}}, 'path')}}
+
     def _sample_entities_cycle_three_nodes(self):
         return {
             'group': {
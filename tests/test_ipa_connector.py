@@ -3,11 +3,14 @@
 # SPDX-License-Identifier: BSD-3-Clause
 # Copyright © 2017-2019, GoodData Corporation. All rights reserved.
 
+import json
 import logging
 import mock
 import os
 import pytest
 import sys
+import threading
+import time
 import yaml
 from testfixtures import log_capture, LogCapture
 
@@ -39,7 +42,7 @@ class TestIpaConnectorBase(object):
         self.uploader = tool.IpaUploader(
             settings=self.settings,
             parsed=args.get('parsed', {}),
-            threshold=args.get('threshold', 0),
+            threshold=args.get('threshold', 100),
             force=args.get('force', False),
             enable_deletion=args.get('enable_deletion', False))
         self.uploader.commands = dict()
@@ -169,6 +172,168 @@ class TestIpaConnector(TestIpaConnectorBase):
         assert exc.value[0] == (
             'Error loading hbacrule entities from API: Some error happened')
 
+    def test_load_ipa_entities_serial(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        # mock call counts are not updated atomically from several threads
+        calls = []
+        rpcclient = tool.api.Backend.rpcclient
+        rpcclient.connect.side_effect = lambda: calls.append('connect')
+        rpcclient.disconnect.side_effect = lambda: calls.append('disconnect')
+        try:
+            self.uploader.api_workers = 4
+            self.uploader.load_ipa_entities()
+            concurrent = self.uploader.ipa_entities
+            self.uploader.api_workers = 1
+            self.uploader.load_ipa_entities()
+        finally:
+            rpcclient.connect.side_effect = None
+            rpcclient.disconnect.side_effect = None
+        assert self.uploader.ipa_entities == concurrent
+        assert self.uploader.ipa_entity_count == 11
+        assert calls.count('connect') == calls.count('disconnect') == 4
+
+    @log_capture('IpaUploader', level=logging.DEBUG)
+    def test_load_ipa_entities_concurrent(self, captured_log):
+        parsed = threading.Event()
+        original_parse = self.uploader._parse_entities
+
+        def _parse_entities(entity_class, data):
+            original_parse(entity_class, data)
+            if entity_class == entities.FreeIPAUserGroup:
+                parsed.set()
+
+        def _api_user_find(**kwargs):
+            # block until groups (fetched after users) are parsed
+            assert parsed.wait(10)
+            return self._api_user_find()
+
+        def _api_call(command):
+            if command == 'user_find':
+                return _api_user_find
+            return self._api_call(command)
+
+        tool.api.Command.__getitem__.side_effect = _api_call
+        self.uploader.api_workers = 2
+        with mock.patch.object(
+                self.uploader, '_parse_entities', _parse_entities):
+            self.uploader.load_ipa_entities()
+        assert self.uploader.ipa_entities['user'] == {
+            'user.one': entities.FreeIPAUser(
+                'user.one', {'uid': ('user.one',)})}
+        msgs = [(r.levelname, r.msg % r.args) for r in captured_log.records]
+        assert ('DEBUG', 'Fetching entities using 2 API workers') in msgs
+        assert ('INFO', 'Parsed 11 entities from FreeIPA API') in msgs
+
+    def test_load_ipa_entities_errors_one_type(self):
+        def _api_call(command):
+            if command == 'user_find':
+                return self._api_exc
+            return self._api_call(command)
+
+        tool.api.Command.__getitem__.side_effect = _api_call
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.load_ipa_entities()
+        assert exc.value[0] == (
+            'Error loading user entities from API: Some error happened')
+
+    def test_load_ipa_entities_errors_connect(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        tool.api.Backend.rpcclient.connect.side_effect = Exception(
+            'Connection refused')
+        self.uploader.api_workers = 4
+        try:
+            with pytest.raises(tool.ManagerError) as exc:
+                self.uploader.load_ipa_entities()
+        finally:
+            tool.api.Backend.rpcclient.connect.side_effect = None
+        assert exc.value[0] == (
+            'Cannot connect to FreeIPA API: Connection refused')
+
+    def test_load_ipa_entities_worker_unexpected_error(self):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        self.uploader.api_workers = 4
+        with mock.patch.object(self.uploader, '_find_entities',
+                               side_effect=TypeError('unexpected')):
+            with pytest.raises(tool.ManagerError) as exc:
+                self.uploader.load_ipa_entities()
+        assert exc.value[0] == (
+            'Error loading hbacrule entities from API: unexpected')
+
+    @log_capture('IpaUploader', level=logging.WARNING)
+    def test_load_ipa_entities_disconnect_error(self, captured_log):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        tool.api.Backend.rpcclient.disconnect.side_effect = Exception(
+            'Connection reset')
+        self.uploader.api_workers = 2
+        try:
+            self.uploader.load_ipa_entities()
+        finally:
+            tool.api.Backend.rpcclient.disconnect.side_effect = None
+        assert self.uploader.ipa_entity_count == 11
+        captured_log.check(*[
+            ('IpaUploader', 'WARNING',
+             'Cannot disconnect from FreeIPA API: Connection reset')] * 2)
+
+    def test_load_ipa_entities_truncated(self):
+        def _api_call(command):
+            if command == 'group_find':
+                return lambda **kwargs: {'result': [], 'truncated': True}
+            return self._api_call(command)
+
+        tool.api.Command.__getitem__.side_effect = _api_call
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.load_ipa_entities()
+        assert exc.value[0] == (
+            'Error loading group entities from API: search result truncated')
+
+    def test_load_ipa_entities_pruned(self):
+        def _api_user_find(**kwargs):
+            return {'result': [{
+                'uid': ('user.one',), 'givenname': ('User',),
+                'memberof_group': ('group-one',),
+                'usercertificate': ('certificate',),
+                'krbprincipalkey': ('key',)}]}
+
+        def _api_call(command):
+            if command == 'user_find':
+                return _api_user_find
+            return self._api_call(command)
+
+        tool.api.Command.__getitem__.side_effect = _api_call
+        self.uploader.load_ipa_entities()
+        assert self.uploader.ipa_entities['user']['user.one'].data_ipa == {
+            'uid': ('user.one',), 'givenname': ('User',),
+            'memberof_group': ('group-one',)}
+
+    def test_needs_all_attributes(self):
+        with mock.patch('%s.api.Object' % modulename) as mock_object:
+            mock_object.__getitem__.return_value.default_attributes = [
+                'cn', 'description', 'member', 'memberOf']
+            assert not self.uploader._needs_all_attributes(
+                entities.FreeIPAHostGroup)
+            # objectclass not returned by default
+            assert self.uploader._needs_all_attributes(
+                entities.FreeIPAUserGroup)
+            # rule membership attributes not returned by default
+            assert self.uploader._needs_all_attributes(
+                entities.FreeIPAHBACRule)
+            mock_object.__getitem__.side_effect = KeyError('hostgroup')
+            assert self.uploader._needs_all_attributes(
+                entities.FreeIPAHostGroup)
+
+    @log_capture('IpaUploader', level=logging.DEBUG)
+    def test_load_ipa_entities_default_attributes(self, captured_log):
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        self.uploader.api_workers = 1
+        with mock.patch('%s.api.Object' % modulename) as mock_object:
+            mock_object.__getitem__.return_value.default_attributes = [
+                'cn', 'description', 'member', 'memberOf']
+            self.uploader.load_ipa_entities()
+        msgs = [(r.levelname, r.msg % r.args) for r in captured_log.records]
+        assert ('DEBUG', 'Running API command hostgroup_find (all=False)'
+                ) in msgs
+        assert ('DEBUG', 'Running API command user_find (all=True)') in msgs
+
     def test_load_ipa_entities_unknown_command(self):
         with mock.patch(
                 'ipamanager.entities.FreeIPAUser.entity_name', 'users'):
@@ -369,6 +534,64 @@ class TestIpaUploader(TestIpaConnectorBase):
             'group_remove_member group-one (user=test.user)')
         assert cmd.payload == {'cn': u'group-one', 'user': u'test.user'}
 
+    def test_parse_entity_diff_memberof_multiple(self):
+        self.uploader.repo_entities = {
+            'user': {'test.user': entities.FreeIPAUser(
+                'test.user', {'firstName': 'Test', 'lastName': 'User',
+                              'memberOf': {'group': ['group-one',
+                                                     'group-three']}},
+                'path')},
+            'group': dict(
+                (name, entities.FreeIPAUserGroup(name, {}, 'path'))
+                for name in ('group-one', 'group-two', 'group-three'))}
+        self.uploader.ipa_entities = {
+            'user': {'test.user': entities.FreeIPAUser('test.user', {
+                'uid': ('test.user',),
+                'givenname': (u'Test',), 'sn': (u'User',)})},
+            'group': dict(
+                (name, entities.FreeIPAUserGroup(name, {
+                    'cn': (name,), 'member_user': members}))
+                for name, members in [
+                    ('group-one', ('other.user', 'test.user')),
+                    ('group-two', ('test.user',)),
+                    ('group-four', ('other.user',))]),
+            'role': {'role-one': entities.FreeIPARole('role-one', {
+                'cn': ('role-one',), 'member_user': ('test.user',)})},
+            'hostgroup': {'test.user': entities.FreeIPAHostGroup(
+                'test.user', {'cn': ('test.user',),
+                              'member_user': ('test.user',)})}}
+        self.uploader.commands = []
+        self.uploader._parse_entity_diff(
+            self.uploader.repo_entities['user']['test.user'])
+        assert sorted(i.description for i in self.uploader.commands) == [
+            'group_add_member group-three (user=test.user)',
+            'group_remove_member group-two (user=test.user)',
+            'role_remove_member role-one (user=test.user)']
+
+    def test_get_memberships(self):
+        self.uploader.ipa_entities = {
+            'group': {'group-one': entities.FreeIPAUserGroup('group-one', {
+                'cn': ('group-one',), 'member_user': ('user.one',),
+                'member_group': ('group-two',),
+                'memberindirect_user': ('user.two',)})},
+            'role': {'role-one': entities.FreeIPARole('role-one', {
+                'cn': ('role-one',), 'member_user': ('user.one',),
+                'member_group': ('group-one',)})}}
+        assert self.uploader._get_memberships('user', 'user.one') == {
+            'group': set(['group-one']), 'role': set(['role-one'])}
+        assert self.uploader._get_memberships('group', 'group-two') == {
+            'group': set(['group-one'])}
+        assert self.uploader._get_memberships('user', 'user.two') == {}
+        assert sorted(self.uploader.ipa_memberships) == [
+            ('group', 'group-one'), ('group', 'group-two'),
+            ('user', 'user.one')]
+
+    def test_get_memberships_reset_on_load(self):
+        self.uploader.ipa_memberships = {('user', 'user.one'): {}}
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        self.uploader.load_ipa_entities()
+        assert self.uploader.ipa_memberships is None
+
     def test_prepare_push_same(self):
         self.uploader.repo_entities = {
             'user': {
@@ -526,6 +749,64 @@ class TestIpaUploader(TestIpaConnectorBase):
         self.uploader._filter_deletion_commands()
         assert self.uploader.commands == old_cmds[1:]
 
+    def _remote_users(self, count):
+        self.uploader.repo_entities = {'group': {
+            'group-one': entities.FreeIPAUserGroup('group-one', {}, 'path')}}
+        self.uploader.ipa_entities = {
+            'group': {'group-one': entities.FreeIPAUserGroup(
+                'group-one', {'cn': ('group-one',),
+                              'objectclass': ('posixgroup',)})},
+            'user': dict(('user%02d' % i, entities.FreeIPAUser(
+                'user%02d' % i, {'uid': ('user%02d' % i,)}))
+                for i in range(count))}
+        self.uploader.ipa_entity_count = count + 1
+
+    def test_prepare_push_threshold_exceeded(self):
+        self._create_uploader(threshold=10, force=True, enable_deletion=True)
+        self._remote_users(29)
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            with pytest.raises(tool.ManagerError) as exc:
+                self.uploader._prepare_push()
+        assert exc.value[0] == (
+            'Threshold exceeded (at least 13.33 % > 10 %), aborting')
+        assert len(self.uploader.commands) == 4
+        assert self.uploader.planned == {'user_del': 4}
+        log.check(
+            ('IpaUploader', 'WARNING',
+             'Preparation of commands aborted after 4 commands:'),
+            ('IpaUploader', 'WARNING', '- user_del: 4'))
+
+    def test_prepare_push_threshold_deletion_disabled(self):
+        self._create_uploader(threshold=10, force=True)
+        self._remote_users(29)
+        self.uploader._prepare_push()
+        assert self.uploader.commands == []
+        assert self.uploader.planned == {}
+
+    def test_prepare_push_threshold_exceeded_dry_run(self):
+        self._create_uploader(threshold=50)
+        self.uploader.deletion_patterns = ['.+_del$']
+        self._remote_users(1)
+        self.uploader.repo_entities['user'] = {
+            'test.user': entities.FreeIPAUser(
+                'test.user', {'firstName': 'Test', 'lastName': 'User',
+                              'memberOf': {'group': ['group-one']}}, 'path')}
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            with pytest.raises(tool.ManagerError) as exc:
+                self.uploader._prepare_push()
+        assert exc.value[0] == (
+            'Threshold exceeded (at least 100.00 % > 50 %), aborting')
+        log.check(
+            ('IpaUploader', 'WARNING',
+             'Preparation of commands aborted after 2 commands:'),
+            ('IpaUploader', 'WARNING', '- group_add_member: 1'),
+            ('IpaUploader', 'WARNING', '- user_add: 1'),
+            ('IpaUploader', 'INFO', 'Would execute commands (incomplete):'),
+            ('IpaUploader', 'INFO',
+             u'- user_add test.user (givenname=Test; sn=User)'),
+            ('IpaUploader', 'INFO',
+             u'- group_add_member group-one (user=test.user)'))
+
     def test_add_command(self):
         cmd = tool.Command(
             'test_cmd', {'description': ('Test',)}, 'group1', 'cn')
@@ -585,6 +866,74 @@ class TestIpaUploader(TestIpaConnectorBase):
             self.uploader._check_threshold()
         assert exc.value[0] == 'Threshold exceeded (11.00 % > 10 %), aborting'
 
+    def test_check_threshold_merged(self):
+        self._create_uploader(threshold=10)
+        self.uploader.commands = tool.Command.coalesce([
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group1', 'cn') for i in range(1, 12)], 100)
+        self.uploader.ipa_entity_count = 100
+        assert len(self.uploader.commands) == 1
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader._check_threshold()
+        assert exc.value[0] == 'Threshold exceeded (11.00 % > 10 %), aborting'
+
+    @log_capture('IpaUploader', level=logging.INFO)
+    def test_coalesce_commands(self, captured_log):
+        self._create_uploader()
+        self.uploader.chunk_size = 2
+        self.uploader.commands = self._large_commands() + [
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group3', 'cn') for i in range(1, 6)]
+        self.uploader._coalesce_commands()
+        assert [i.description for i in sorted(self.uploader.commands)][7:] == [
+            "group_add_member group1 (user=user1)",
+            "group_add_member group1-users (user=user2)",
+            "group_add_member group2 (group=group1)",
+            "group_add_member group3 (user=(u'user1', u'user2'))",
+            "group_add_member group3 (user=(u'user3', u'user4'))",
+            "group_add_member group3 (user=user5)",
+            "hbacrule_add_host rule1 (hostgroup=group1)",
+            "hbacrule_add_user rule1 (group=group2)",
+            "sudorule_add_host rule1 (hostgroup=group1)",
+            "sudorule_add_user rule1 (group=group2)"]
+        captured_log.check(
+            ('IpaUploader', 'INFO', 'Merged 19 commands into 17 commands'))
+
+    def test_push_merged_errors(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.chunk_size = 3
+
+        calls = []
+
+        def _api_add_member(**kwargs):
+            # the first of the added users does not exist
+            users = kwargs['user']
+            calls.append(users)
+            if isinstance(users, tuple):
+                return {u'failed': {u'member': {
+                    u'user': ((users[0], u'no such entry'),),
+                    u'group': ()}}}
+            return {u'failed': {u'member': {u'user': (), u'group': ()}}}
+
+        tool.api.Command.__getitem__.side_effect = (
+            lambda command: _api_add_member)
+        self.uploader.commands = [
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group1', 'cn') for i in range(1, 8)]
+        self.uploader.ipa_entity_count = 100
+        with mock.patch('%s.load_ipa_entities' % up_class):
+            with mock.patch('%s._prepare_push' % up_class):
+                with pytest.raises(tool.ManagerError) as exc:
+                    self.uploader.push()
+        assert exc.value[0] == 'There were 2 errors executing update'
+        assert calls == [(u'user1', u'user2', u'user3'),
+                         (u'user4', u'user5', u'user6'), u'user7']
+        assert self.uploader.errs == [
+            u"Error executing group_add_member group1 (user=user1): Error "
+            "executing group_add_member: [u'- user1: no such entry']",
+            u"Error executing group_add_member group1 (user=user4): Error "
+            "executing group_add_member: [u'- user4: no such entry']"]
+
     @log_capture('IpaUploader', level=logging.INFO)
     def test_push_dry_run_no_todo(self, captured_log):
         with mock.patch('%s.load_ipa_entities' % up_class):
@@ -760,6 +1109,570 @@ class TestIpaUploader(TestIpaConnectorBase):
             u'Error executing group_add_member group2 (group=group1):'
             ' Error executing group_add_member: Some error happened']
 
+    def test_push_batched(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.batch_size = 4
+        tool.api.Command.__getitem__.side_effect = self._api_batch_call(
+            self._api_call)
+        self.uploader.commands = self._large_commands()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                with LogCapture('Command', level=logging.INFO) as log:
+                    self.uploader.push()
+        assert self.uploader.errs == []
+        assert self.batches == [
+            ['group_add group1', 'group_add group2',
+             'hbacrule_add rule1', 'hostgroup_add group1'],
+            ['sudorule_add rule1', 'user_add user1', 'user_add user2'],
+            ['group_add_member group1', 'group_add_member group1-users',
+             'group_add_member group2', 'hbacrule_add_host rule1'],
+            ['hbacrule_add_user rule1', 'sudorule_add_host rule1',
+             'sudorule_add_user rule1']]
+        msgs = [r.msg % r.args for r in log.records]
+        assert u'Added user "user2"' in msgs
+        assert u'sudorule_add_user rule1 (group=group2) successful' in msgs
+
+    def test_push_metrics(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.batch_size = 4
+        tool.api.Command.__getitem__.side_effect = self._api_batch_call(
+            self._api_call)
+        self.uploader.commands = self._large_commands()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                self.uploader.push()
+        metrics = self.uploader.metrics
+        assert metrics.phases.keys() == ['remote-load', 'plan', 'execute']
+        assert metrics.counters['rpc_calls'] == len(tool.ENTITY_CLASSES) + 4
+        assert metrics.counters['commands'] == {
+            'group_add': 2, 'group_add_member': 3, 'hbacrule_add': 1,
+            'hbacrule_add_host': 1, 'hbacrule_add_user': 1,
+            'hostgroup_add': 1, 'sudorule_add': 1, 'sudorule_add_host': 1,
+            'sudorule_add_user': 1, 'user_add': 2}
+        durations = metrics.tracer.durations
+        assert len(durations.pop('batch')) == 4
+        assert sorted(durations) == sorted(
+            '%s_find' % i.entity_name for i in tool.ENTITY_CLASSES)
+
+    @log_capture('Command', level=logging.ERROR)
+    def test_push_batched_errors(self, captured_log):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.batch_size = 100
+        tool.api.Command.__getitem__.side_effect = self._api_batch_call(
+            self._api_call_unreliable)
+        self.uploader.commands = self._large_commands()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                with pytest.raises(tool.ManagerError) as exc:
+                    self.uploader.push()
+        assert exc.value[0] == 'There were 5 errors executing update'
+        assert len(self.batches) == 2
+        assert self.uploader.errs == [
+            u"Error executing group_add_member group1 (user=user1):"
+            " Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing group_add_member group1-users (user=user2):"
+            " Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing group_add_member group2 (group=group1):"
+            " Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing hbacrule_add_user rule1 (group=group2):"
+            " Error executing hbacrule_add_user: [u'- test: no such attr2']",
+            u"Error executing sudorule_add_user rule1 (group=group2):"
+            " Error executing sudorule_add_user: [u'- test: no such attr2']"]
+
+    def test_push_batched_exceptions(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.batch_size = 100
+        tool.api.Command.__getitem__.side_effect = self._api_batch_call(
+            self._api_call_execute_fail)
+        self.uploader.commands = self._large_commands()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                with pytest.raises(tool.ManagerError) as exc:
+                    self.uploader.push()
+        assert exc.value[0] == 'There were 3 errors executing update'
+        assert self.uploader.errs == [
+            u'Error executing group_add_member group1 (user=user1):'
+            ' Error executing group_add_member: Some error happened',
+            u'Error executing group_add_member group1-users (user=user2):'
+            ' Error executing group_add_member: Some error happened',
+            u'Error executing group_add_member group2 (group=group1):'
+            ' Error executing group_add_member: Some error happened']
+
+    def _api_batch_call(self, api_call):
+        """
+        Simulate the `batch` API command executing commands by `api_call`.
+        Executed batches are recorded in the `batches` attribute.
+        """
+        self.batches = []
+
+        def _batch(*methods):
+            self.batches.append([])
+            results = []
+            for method in methods:
+                params = method['params'][1]
+                self.batches[-1].append('%s %s' % (
+                    method['method'], params.get('uid', params.get('cn'))))
+                try:
+                    results.append(api_call(method['method'])(**params))
+                except Exception as e:
+                    results.append({'error': unicode(e)})
+            return {'count': len(results), 'results': results}
+
+        def _call(command):
+            if command == 'batch':
+                return _batch
+            return api_call(command)
+        return _call
+
+    def test_dependencies(self):
+        commands = sorted(self._large_commands() + [
+            tool.Command('user_mod', {'sn': 'User'}, 'user1', 'uid'),
+            tool.Command('group_remove_member', {'user': 'user3'},
+                         'group2', 'cn'),
+            tool.Command('user_del', {}, 'user3', 'uid'),
+            tool.Command('group_del', {}, 'group3', 'cn')])
+        dependencies = self.uploader._dependencies(commands)
+        assert dict(
+            (commands[i].description,
+             sorted(commands[j].description for j in required))
+            for i, required in enumerate(dependencies)) == {
+            'group_add group1 ()': [],
+            'group_add group2 ()': [],
+            'hbacrule_add rule1 ()': [],
+            'hostgroup_add group1 ()': [],
+            'sudorule_add rule1 ()': [],
+            'user_add user1 ()': [],
+            'user_add user2 ()': [],
+            'group_add_member group1 (user=user1)': [
+                'group_add group1 ()', 'user_add user1 ()'],
+            'group_add_member group1-users (user=user2)': [
+                'user_add user2 ()'],
+            'group_add_member group2 (group=group1)': [
+                'group_add group1 ()', 'group_add group2 ()'],
+            'hbacrule_add_host rule1 (hostgroup=group1)': [
+                'hbacrule_add rule1 ()', 'hostgroup_add group1 ()'],
+            'hbacrule_add_user rule1 (group=group2)': [
+                'group_add group2 ()', 'hbacrule_add rule1 ()'],
+            'sudorule_add_host rule1 (hostgroup=group1)': [
+                'hostgroup_add group1 ()', 'sudorule_add rule1 ()'],
+            'sudorule_add_user rule1 (group=group2)': [
+                'group_add group2 ()', 'sudorule_add rule1 ()'],
+            'user_mod user1 (sn=User)': [
+                'group_add_member group1 (user=user1)'],
+            'group_remove_member group2 (user=user3)': [
+                'group_add_member group2 (group=group1)',
+                'hbacrule_add_user rule1 (group=group2)',
+                'sudorule_add_user rule1 (group=group2)'],
+            'user_del user3 ()': ['group_remove_member group2 (user=user3)'],
+            'group_del group3 ()': []}
+
+    def test_dependencies_references(self):
+        commands = sorted([
+            tool.Command('user_add', {'sn': 'User'}, 'user1', 'uid'),
+            tool.Command('user_add', {'sn': 'User', 'manager': 'user1'},
+                         'user2', 'uid'),
+            tool.Command('user_mod', {'manager': 'user4'}, 'user3', 'uid'),
+            tool.Command('user_add', {'sn': 'User'}, 'user4', 'uid'),
+            tool.Command('group_add_member', {'user': 'user4'},
+                         'group1', 'cn'),
+            tool.Command('user_del', {}, 'user1', 'uid')])
+        dependencies = self.uploader._dependencies(commands)
+        assert dict(
+            (commands[i].description,
+             sorted(commands[j].description for j in required))
+            for i, required in enumerate(dependencies)) == {
+            'user_add user1 (sn=User)': [],
+            'user_add user2 (manager=user1; sn=User)': [
+                'user_add user1 (sn=User)'],
+            'user_add user4 (sn=User)': [],
+            'group_add_member group1 (user=user4)': [
+                'user_add user4 (sn=User)'],
+            'user_mod user3 (manager=user4)': [
+                'group_add_member group1 (user=user4)'],
+            'user_del user1 ()': [
+                'user_add user1 (sn=User)',
+                'user_add user2 (manager=user1; sn=User)']}
+
+    def test_push_concurrent_references(self):
+        self._create_uploader(force=True, threshold=100)
+        self.uploader.push_workers = 4
+        executed = []
+        lock = threading.Lock()
+
+        def _api_call(command):
+            def _call(**kwargs):
+                if command == 'user_add':
+                    time.sleep(0.02)
+                with lock:
+                    executed.append((command, kwargs['uid']))
+                return {'summary': u'%s %s' % (command, kwargs['uid'])}
+            return _call
+
+        tool.api.Command.__getitem__.side_effect = _api_call
+        self.uploader.ipa_entity_count = 100
+        self.uploader.commands = [
+            tool.Command('user_add', {'sn': 'User'}, 'user2', 'uid'),
+            tool.Command('user_mod', {'manager': 'user2'}, 'user1', 'uid'),
+            tool.Command('user_add', {'sn': 'User', 'manager': 'user2'},
+                         'user3', 'uid')]
+        with mock.patch('%s.load_ipa_entities' % up_class):
+            with mock.patch('%s._prepare_push' % up_class):
+                self.uploader.push()
+        assert executed[0] == ('user_add', 'user2')
+        assert sorted(executed[1:]) == [
+            ('user_add', 'user3'), ('user_mod', 'user1')]
+
+    def test_push_concurrent(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.push_workers = 3
+        commands = self._large_commands()
+        dependencies = self.uploader._dependencies(sorted(commands))
+        lock = threading.Lock()
+        finished = []
+        running = [0, 0]  # current, maximum
+
+        def _api_call(command):
+            def _call(**kwargs):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+                    finished.append(command)
+                return self._api_call(command)(**kwargs)
+            return _call
+
+        tool.api.Command.__getitem__.side_effect = _api_call
+        tool.api.Backend.rpcclient.reset_mock()
+        self.uploader.ipa_entity_count = 100
+        self.uploader.commands = commands
+        with mock.patch('%s.load_ipa_entities' % up_class):
+            with mock.patch('%s._prepare_push' % up_class):
+                with LogCapture('Command', level=logging.INFO) as log:
+                    self.uploader.push()
+        assert self.uploader.errs == []
+        assert len(finished) == 14
+        assert running[1] == 3
+        assert tool.api.Backend.rpcclient.connect.call_count == 3
+        assert tool.api.Backend.rpcclient.disconnect.call_count == 3
+        # every command was executed after all commands it depends on
+        executed = [r.args[0] for r in log.records
+                    if r.msg == 'Executing %s']
+        succeeded = [r.msg % r.args for r in log.records
+                     if r.msg != 'Executing %s']
+        assert len(executed) == 14
+        order = sorted(commands)
+        for i, required in enumerate(dependencies):
+            for j in required:
+                assert executed.index(order[j].description) < (
+                    executed.index(order[i].description))
+        assert len(succeeded) == 14
+
+    def test_push_concurrent_errors(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.push_workers = 4
+        tool.api.Command.__getitem__.side_effect = (
+            self._api_call_unreliable)
+        self.uploader.commands = self._large_commands()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                with pytest.raises(tool.ManagerError) as exc:
+                    self.uploader.push()
+        assert exc.value[0] == 'There were 5 errors executing update'
+        assert sorted(self.uploader.errs) == [
+            u"Error executing group_add_member group1 (user=user1):"
+            " Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing group_add_member group1-users (user=user2):"
+            " Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing group_add_member group2 (group=group1):"
+            " Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing hbacrule_add_user rule1 (group=group2):"
+            " Error executing hbacrule_add_user: [u'- test: no such attr2']",
+            u"Error executing sudorule_add_user rule1 (group=group2):"
+            " Error executing sudorule_add_user: [u'- test: no such attr2']"]
+
+    def test_push_concurrent_batched(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.push_workers = 2
+        self.uploader.batch_size = 100
+        tool.api.Command.__getitem__.side_effect = self._api_batch_call(
+            self._api_call)
+        self.uploader.commands = self._large_commands()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                self.uploader.push()
+        assert self.uploader.errs == []
+        assert self.batches == [
+            ['group_add group1', 'group_add group2', 'hbacrule_add rule1',
+             'hostgroup_add group1', 'sudorule_add rule1', 'user_add user1',
+             'user_add user2'],
+            ['group_add_member group1', 'group_add_member group1-users',
+             'group_add_member group2', 'hbacrule_add_host rule1',
+             'hbacrule_add_user rule1', 'sudorule_add_host rule1',
+             'sudorule_add_user rule1']]
+
+    def test_push_concurrent_connect_error(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.push_workers = 2
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        tool.api.Backend.rpcclient.connect.side_effect = Exception(
+            'Connection refused')
+        self.uploader.commands = self._large_commands()
+        try:
+            with mock.patch('%s._prepare_push' % up_class):
+                with mock.patch('%s._check_threshold' % up_class):
+                    with pytest.raises(tool.ManagerError) as exc:
+                        self.uploader.push()
+        finally:
+            tool.api.Backend.rpcclient.connect.side_effect = None
+        assert exc.value[0] == (
+            'Cannot connect to FreeIPA API: Connection refused')
+
+    def test_push_concurrent_worker_unexpected_error(self):
+        self._create_uploader(force=True, threshold=15)
+        self.uploader.push_workers = 2
+        self.uploader.commands = self._large_commands()
+        tool.api.Backend.rpcclient.disconnect.reset_mock()
+        with mock.patch('%s._prepare_push' % up_class):
+            with mock.patch('%s._check_threshold' % up_class):
+                with mock.patch('%s._run' % up_class) as run:
+                    run.side_effect = TypeError('unexpected')
+                    with pytest.raises(tool.ManagerError) as exc:
+                        self.uploader.push()
+        assert exc.value[0] == 'Error executing commands: unexpected'
+        assert tool.api.Backend.rpcclient.disconnect.called
+
+    def test_save_plan(self, tmpdir):
+        self._create_uploader(threshold=10)
+        self._plan_remote_entities(user=['user1', 'user2'])
+        self.uploader.commands = self._large_commands() + [
+            tool.Command('user_mod', {'mail': ()}, 'user1', 'uid')]
+        path = tmpdir.join('plan.json').strpath
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self.uploader._save_plan(path)
+        log.check(('IpaUploader', 'INFO',
+                   'Saved plan of 15 commands to %s' % path))
+        with open(path) as src:
+            plan = json.load(src)
+        assert plan['format'] == 1
+        assert plan['ipa-entity-count'] == 2
+        assert sorted(plan['fingerprint']) == sorted(
+            cls.entity_name for cls in tool.ENTITY_CLASSES)
+        assert plan['commands'][0] == {
+            'command': 'group_add', 'entity': 'group1', 'id': 'cn',
+            'payload': {}}
+        assert plan['commands'][7] == {
+            'command': 'group_add_member', 'entity': 'group1', 'id': 'cn',
+            'payload': {'user': 'user1'}}
+        assert plan['commands'][-1] == {
+            'command': 'user_mod', 'entity': 'user1', 'id': 'uid',
+            'payload': {'mail': []}}
+
+    def test_apply_plan(self, tmpdir):
+        self._create_uploader(threshold=50)
+        self._plan_remote_entities(user=['user1', 'user2', 'user3'],
+                                   group=['group1-users', 'group2'])
+        self.uploader.commands = self._large_commands()
+        path = tmpdir.join('plan.json').strpath
+        self.uploader._save_plan(path)
+        saved = [i.description for i in sorted(self.uploader.commands)]
+
+        self._create_uploader(force=True, threshold=100)
+        self.uploader.chunk_size = 1
+        tool.api.Command.__getitem__.side_effect = self._api_call_plan(
+            user=['user1', 'user2', 'user3', 'admin'],
+            group=['group1-users', 'group2', 'ipausers'])
+        with LogCapture('Command', level=logging.INFO) as log:
+            self.uploader.apply_plan(path)
+        assert self.uploader.errs == []
+        assert self.uploader.ipa_entity_count == 5
+        assert [r.args[0] for r in log.records
+                if r.msg == 'Executing %s'] == saved
+
+    def test_apply_plan_deletion_disabled(self, tmpdir):
+        self._create_uploader(threshold=50)
+        self._plan_remote_entities(user=['user1'])
+        self.uploader.commands = [
+            tool.Command('user_del', {}, 'user1', 'uid'),
+            tool.Command('user_add', {}, 'user2', 'uid')]
+        path = tmpdir.join('plan.json').strpath
+        self.uploader._save_plan(path)
+        self._create_uploader(threshold=100)
+        tool.api.Command.__getitem__.side_effect = self._api_call_plan(
+            user=['user1'])
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self.uploader.apply_plan(path)
+        log.check(
+            ('IpaUploader', 'INFO', 'Loading push plan from %s' % path),
+            ('IpaUploader', 'INFO', '1 commands to execute'),
+            ('IpaUploader', 'INFO', 'Would execute commands:'),
+            ('IpaUploader', 'INFO', '- user_add user2 ()'))
+
+    def test_apply_plan_outdated(self, tmpdir):
+        self._create_uploader(threshold=50)
+        self._plan_remote_entities(user=['user1'], group=['group1'])
+        self.uploader.commands = self._large_commands()
+        path = tmpdir.join('plan.json').strpath
+        self.uploader._save_plan(path)
+        tool.api.Command.__getitem__.side_effect = self._api_call_plan(
+            user=['user1', 'user2'], group=[], hostgroup=['group1'])
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.apply_plan(path)
+        assert exc.value[0] == (
+            'Remote entities changed since the plan was saved '
+            '(group, hostgroup, user)')
+
+    def test_apply_plan_missing(self, tmpdir):
+        path = tmpdir.join('plan.json').strpath
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.apply_plan(path)
+        assert exc.value[0] == (
+            "Cannot load push plan: [Errno 2] No such file or directory: "
+            "'%s'" % path)
+
+    def test_apply_plan_invalid(self, tmpdir):
+        path = tmpdir.join('plan.json')
+        path.write('{"format": 1, "commands": [{"command": "user_add"}]}')
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.apply_plan(path.strpath)
+        assert exc.value[0] == "Cannot load push plan: 'payload'"
+        path.write('{"format": 42}')
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.apply_plan(path.strpath)
+        assert exc.value[0] == (
+            'Cannot load push plan: unsupported format 42')
+
+    def test_apply_plan_resume(self, tmpdir):
+        self._create_uploader(threshold=100)
+        self._plan_remote_entities(user=['user1'])
+        self.uploader.commands = self._large_commands()
+        plan = tmpdir.join('plan.json').strpath
+        journal = tmpdir.join('journal.json')
+        self.uploader._save_plan(plan)
+        executed = []
+
+        def _api_call(command):
+            def _call(**kwargs):
+                if command == 'hbacrule_add_host':  # e.g., IPA restart
+                    raise KeyboardInterrupt()
+                executed.append(command)
+                return self._api_call_unreliable(command)(**kwargs)
+            if command.endswith('_find'):
+                return self._api_call_plan(user=['user1'])(command)
+            return _call
+
+        # interrupted push
+        self._create_uploader(threshold=100, force=True)
+        tool.api.Command.__getitem__.side_effect = _api_call
+        with pytest.raises(KeyboardInterrupt):
+            self.uploader.apply_plan(plan, journal.strpath)
+        assert len(executed) == 10
+        assert self.uploader.errs == [
+            u"Error executing group_add_member group1 (user=user1): "
+            "Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing group_add_member group1-users (user=user2): "
+            "Error executing group_add_member: [u'- test: no such attr2']",
+            u"Error executing group_add_member group2 (group=group1): "
+            "Error executing group_add_member: [u'- test: no such attr2']"]
+        assert len(journal.readlines()) == 11
+
+        # resumed push, the remote state is not checked
+        self._create_uploader(threshold=100, force=True)
+        tool.api.Command.__getitem__.side_effect = self._api_call
+        with LogCapture('Command', level=logging.INFO) as log:
+            self.uploader.apply_plan(plan, journal.strpath, resume=True)
+        assert [r.args[0] for r in log.records
+                if r.msg == 'Executing %s'] == [
+            'group_add_member group1 (user=user1)',
+            'group_add_member group1-users (user=user2)',
+            'group_add_member group2 (group=group1)',
+            'hbacrule_add_host rule1 (hostgroup=group1)',
+            'hbacrule_add_user rule1 (group=group2)',
+            'sudorule_add_host rule1 (hostgroup=group1)',
+            'sudorule_add_user rule1 (group=group2)']
+        assert self.uploader.errs == []
+        assert len(journal.readlines()) == 18
+
+        # nothing left to do
+        self._create_uploader(threshold=100, force=True)
+        with LogCapture('IpaUploader', level=logging.INFO) as log:
+            self.uploader.apply_plan(plan, journal.strpath, resume=True)
+        log.check(
+            ('IpaUploader', 'INFO', 'Loading push plan from %s' % plan),
+            ('IpaUploader', 'INFO', '14 commands to execute'),
+            ('IpaUploader', 'INFO',
+             'Resuming push, 14 of 14 commands already executed'),
+            ('IpaUploader', 'INFO',
+             'FreeIPA consistent with local config, nothing to do'))
+
+    def test_apply_plan_resume_other_plan(self, tmpdir):
+        self._create_uploader(threshold=100)
+        self._plan_remote_entities(user=['user1'])
+        self.uploader.commands = self._large_commands()
+        plan = tmpdir.join('plan.json').strpath
+        journal = tmpdir.join('journal.json')
+        self.uploader._save_plan(plan)
+        journal.write('{"format": 1, "plan": "abc"}\n')
+        with pytest.raises(tool.ManagerError) as exc:
+            self.uploader.apply_plan(plan, journal.strpath, resume=True)
+        assert exc.value[0] == (
+            'Push journal %s does not belong to the plan' % journal.strpath)
+
+    def test_push_journal_merged(self, tmpdir):
+        self._create_uploader(threshold=100, force=True)
+        self.uploader.chunk_size = 100
+        self.uploader.ipa_entity_count = 10
+        self.uploader.commands = [
+            tool.Command('group_add_member', {'user': 'user%d' % i},
+                         'group1', 'cn') for i in range(1, 4)]
+        tool.api.Command.__getitem__.side_effect = lambda command: (
+            lambda **kwargs: {u'failed': {u'member': {
+                u'user': ((u'user2', u'no such entry'),)}}})
+        journal = tmpdir.join('journal.json')
+        with mock.patch('%s.load_ipa_entities' % up_class):
+            with mock.patch('%s._prepare_push' % up_class):
+                with pytest.raises(tool.ManagerError):
+                    self.uploader.push(journal_path=journal.strpath)
+        assert [json.loads(i) for i in journal.readlines()[1:]] == [
+            {'command': 'group_add_member group1 (user=user1)',
+             'error': None},
+            {'command': 'group_add_member group1 (user=user2)',
+             'error': "Error executing group_add_member: "
+                      "[u'- user2: no such entry']"},
+            {'command': 'group_add_member group1 (user=user3)',
+             'error': None}]
+
+    def _plan_remote_entities(self, **names):
+        self.uploader.ipa_entities = dict(
+            (cls.entity_name, dict(
+                (name, cls(name, {})) for name in names.get(
+                    cls.entity_name, [])))
+            for cls in tool.ENTITY_CLASSES)
+        self.uploader.ipa_entity_count = sum(len(i) for i in names.values())
+
+    def _api_call_plan(self, **names):
+        """
+        Simulate find commands returning names of the given entities
+        (other commands are executed by `_api_call`).
+        """
+        def _find(cls):
+            def _func(**kwargs):
+                assert kwargs == {'pkey_only': True, 'sizelimit': 0}
+                return {'result': [
+                    {cls.entity_id_type: (name,)}
+                    for name in names.get(cls.entity_name, [])]}
+            return _func
+
+        finds = dict(('%s_find' % cls.entity_name, _find(cls))
+                     for cls in tool.ENTITY_CLASSES)
+
+        def _call(command):
+            if command in finds:
+                return finds[command]
+            return self._api_call(command)
+        return _call
+
     def test_push_invalid_command(self):
         self._create_uploader(force=True, threshold=15)
         tool.api.Command.__getitem__.side_effect = self._api_call
@@ -910,6 +1823,20 @@ class TestIpaDownloader(TestIpaConnectorBase):
         group2 = self.downloader.ipa_entities['group']['group-two']
         assert self.downloader._dump_membership(group2) is None
 
+    def test_dump_membership_multiple(self):
+        self.downloader.ipa_entities['group']['group-three'] = (
+            entities.FreeIPAUserGroup('group-three', {
+                'cn': ('group-three',), 'member_user': ('test.user',)}))
+        self.downloader.ipa_entities['role']['role-one'].data_ipa[
+            'member_user'] = ('user.three', 'test.user')
+        user = self.downloader.ipa_entities['user']['test.user']
+        assert self.downloader._dump_membership(user) == {
+            'memberOf': {'group': ['group-three', 'group-two'],
+                         'role': ['role-one']}}
+        role = self.downloader.ipa_entities['role']['role-one']
+        assert self.downloader._dump_membership(role) == {
+            'memberOf': {'privilege': ['privilege-one']}}
+
     def test_dump_membership_rule(self):
         rule1 = entities.FreeIPAHBACRule('rule-one', {'description': 'test'})
         assert self.downloader._dump_membership(rule1) is None
@@ -950,6 +1877,34 @@ class TestIpaDownloader(TestIpaConnectorBase):
             self.downloader._generate_filename(user2)
         assert exc.value[0] == 'users/test_user.yaml filename already used'
 
+    def test_generate_filename_used_new(self):
+        self._create_downloader(repo_path='entities')
+        self.downloader.repo_entities['user'] = {}
+        user = entities.FreeIPAUser(
+            'test.user', {'firstName': 'Test', 'lastName': 'User'}, 'path')
+        user.path = None
+        self.downloader._generate_filename(user)
+        assert user.path == 'entities/users/test_user.yaml'
+        user2 = entities.FreeIPAUser(
+            'test-user', {'firstName': 'Test', 'lastName': 'User'}, 'path')
+        user2.path = None
+        with pytest.raises(tool.ConfigError) as exc:
+            self.downloader._generate_filename(user2)
+        assert exc.value[0] == 'users/test_user.yaml filename already used'
+        assert self.downloader.used_filenames == {
+            'user': set(['users/test_user.yaml'])}
+
+    def test_prepare_pull_filename_collision(self):
+        self._create_downloader(repo_path='entities')
+        self.downloader.repo_entities = {'user': {}}
+        self.downloader.ipa_entities = {'user': dict(
+            (name, entities.FreeIPAUser(name, {
+                'uid': (name,), 'givenname': (u'Test',), 'sn': (u'User',)}))
+            for name in ('test.user', 'test-user'))}
+        with pytest.raises(tool.ConfigError) as exc:
+            self.downloader._prepare_pull()
+        assert exc.value[0] == 'users/test_user.yaml filename already used'
+
     def test_pull_dry_run(self):
         self._create_downloader(dry_run=True, add_only=True)
         self.downloader.ipa_entities, self.downloader.repo_entities = (
@@ -1008,6 +1963,10 @@ class TestIpaDownloader(TestIpaConnectorBase):
                           '    group:\n'
                           '      - group-one\n')}
         mock_delete.assert_called_with('user_two.yaml')
+        metrics = self.downloader.metrics
+        assert metrics.phases.keys() == ['remote-load', 'plan', 'write']
+        assert metrics.counters['files_written'] == 1
+        assert metrics.counters['files_deleted'] == 1
 
     def _pull_entities(self):
         remote = {
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import json
+import logging
+import pytest
+from testfixtures import LogCapture
+
+from _utils import _import
+tool = _import('ipamanager', 'journal')
+command = _import('ipamanager', 'command')
+
+
+class TestPushJournal(object):
+    def setup_method(self, method):
+        self.commands = [
+            command.Command('user_add', {'sn': 'User'}, 'user1', 'uid'),
+            command.Command('group_add_member', {'user': 'user1'},
+                            'group1', 'cn')]
+
+    def test_plan_hash(self):
+        plan = [{'command': 'user_add', 'entity': 'user1', 'id': 'uid',
+                 'payload': {'sn': 'User'}}]
+        assert tool.plan_hash(plan) == tool.plan_hash(
+            [{'payload': {'sn': 'User'}, 'id': 'uid', 'entity': 'user1',
+              'command': 'user_add'}])
+        assert tool.plan_hash(plan) != tool.plan_hash(plan * 2)
+
+    def test_record(self, tmpdir):
+        path = tmpdir.join('journal.json')
+        journal = tool.PushJournal(path.strpath, 'abc')
+        journal.start()
+        journal.record(self.commands[0])
+        journal.record(self.commands[1], 'no such entry')
+        journal.close()
+        assert [json.loads(i) for i in path.readlines()] == [
+            {'format': 1, 'plan': 'abc'},
+            {'command': 'user_add user1 (sn=User)', 'error': None},
+            {'command': 'group_add_member group1 (user=user1)',
+             'error': 'no such entry'}]
+
+    def test_record_resume(self, tmpdir):
+        path = tmpdir.join('journal.json')
+        journal = tool.PushJournal(path.strpath, 'abc')
+        journal.start()
+        journal.record(self.commands[1], 'no such entry')
+        journal.close()
+        journal = tool.PushJournal(path.strpath, 'abc')
+        assert journal.completed() == set()
+        journal.start(resume=True)
+        journal.record(self.commands[1])
+        journal.close()
+        assert tool.PushJournal(path.strpath, 'abc').completed() == set(
+            ['group_add_member group1 (user=user1)'])
+        assert len(path.readlines()) == 3
+
+    def test_completed_interrupted(self, tmpdir):
+        path = tmpdir.join('journal.json')
+        path.write(
+            '{"format": 1, "plan": "abc"}\n'
+            '{"command": "user_add user1 (sn=User)", "error": null}\n'
+            '{"command": "group_add_member group1 (user=user1)", "err')
+        with LogCapture('PushJournal', level=logging.WARNING) as log:
+            assert tool.PushJournal(path.strpath, 'abc').completed() == set(
+                ['user_add user1 (sn=User)'])
+        log.check(
+            ('PushJournal', 'WARNING', 'Ignoring invalid journal line 3'))
+
+    def test_completed_other_plan(self, tmpdir):
+        path = tmpdir.join('journal.json')
+        path.write('{"format": 1, "plan": "abc"}\n')
+        with pytest.raises(tool.ManagerError) as exc:
+            tool.PushJournal(path.strpath, 'def').completed()
+        assert exc.value[0] == (
+            'Push journal %s does not belong to the plan' % path.strpath)
+
+    def test_completed_invalid(self, tmpdir):
+        path = tmpdir.join('journal.json')
+        path.write('')
+        with pytest.raises(tool.ManagerError) as exc:
+            tool.PushJournal(path.strpath, 'abc').completed()
+        assert exc.value[0] == 'Invalid push journal %s' % path.strpath
+
+    def test_completed_missing(self, tmpdir):
+        path = tmpdir.join('journal.json').strpath
+        with pytest.raises(tool.ManagerError) as exc:
+            tool.PushJournal(path, 'abc').completed()
+        assert exc.value[0] == (
+            "Cannot read push journal: [Errno 2] No such file or directory: "
+            "'%s'" % path)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import glob
+import mock
+import os.path
+import pytest
+
+from _utils import _import
+tool = _import('ipamanager', 'linter')
+utils = _import('ipamanager', 'utils')
+testpath = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_DIR = os.path.join(testpath, 'freeipa-manager-config')
+CORRECT_FILES = sorted(glob.glob('%s/correct/*/*.yaml' % CONFIG_DIR))
+CORRECT_FILES += sorted(glob.glob('%s/settings*.yaml' % CONFIG_DIR))
+ALL_FILES = CORRECT_FILES + sorted(
+    glob.glob('%s/invalid/*/*.yaml' % CONFIG_DIR))
+
+# canonical snippets (accepted by the built-in linter)
+CANONICAL = [
+    '---\ngroup:\n  description: A group\n',
+    '---\ngroup:\n  description: \'quoted: value\'\n',
+    '---\ngroup:\n  description: "quoted value"\n',
+    '---\ngroup:\n  description: http://example.com/a:b\n',
+    '---\ngroup:\n  description: O\'Brien  spaced\n',
+    '---\ngroup:\n  memberOf:\n    group: [one, two, \'three\']\n',
+    '---\ngroup:\n  memberOf:\n    group: []\n',
+    '---\ngroup:\n  memberOf:\n    group:\n      - one\n      - two\n',
+    '---\ngroup:\n  posix: false\n  other: true\n',
+    '---\ngroup:\n  description: x\n\n\nother:\n  description: y\n',
+    '---\n\ngroup:\n  description: x\n',
+    '---\n- one\n- two\n',
+    '---\nuser:\n  firstName: Jiří\n  lastName: Müller\n',
+    '---\nuser:\n  number: 42\n  nothing: ~\n',
+]
+
+# snippets not accepted by the built-in linter (checked by yamllint)
+NOT_CANONICAL = [
+    '',
+    '---\n',
+    'group:\n  description: A group\n',
+    '--- \ngroup:\n  description: A group\n',
+    '---\ngroup:\n  description: A group',
+    '---\ngroup:\n  description: A group\n\n',
+    '---\ngroup:\n  description: A group \n',
+    '---\ngroup:\n  description:  A group\n',
+    '---\ngroup:\n  description : A group\n',
+    '---\ngroup:\n   description: A group\n',
+    '---\ngroup:\n    description: A group\n',
+    '---\ngroup:\n\tdescription: A group\n',
+    '---\r\ngroup:\r\n  description: A group\r\n',
+    '---\ngroup:\n  description: A group  # comment\n',
+    '---\ngroup:\n  description: "quoted # value"\n',
+    '---\n# comment\ngroup:\n  description: A group\n',
+    '---\ngroup:\n  description: x\n\n\n\nother:\n  description: y\n',
+    '---\ngroup:\n  description: x\n  description: y\n',
+    '---\ngroup:\n  posix: yes\n',
+    '---\ngroup:\n  posix: True\n',
+    '---\ngroup:\n  posix: [on, off]\n',
+    '---\non:\n  description: x\n',
+    '---\ngroup:\n  memberOf:\n    group: [ one]\n',
+    '---\ngroup:\n  memberOf:\n    group: [one,two]\n',
+    '---\ngroup:\n  memberOf:\n    group: [one , two]\n',
+    '---\ngroup:\n  memberOf:\n    group: [one,  two]\n',
+    '---\ngroup:\n  memberOf:\n    group: [ ]\n',
+    '---\ngroup:\n  memberOf:\n    group: {a: b}\n',
+    '---\ngroup:\n  memberOf:\n    group:\n    - one\n',
+    '---\ngroup:\n  memberOf:\n    group:\n      -  one\n',
+    '---\ngroup:\n  memberOf:\n    group:\n      - one\n     - two\n',
+    '---\ngroup:\n  memberOf:\n    group:\n      - - one\n',
+    '---\ngroup:\n  memberOf:\n    group:\n      - a: b\n',
+    '---\ngroup:\n  description: >\n    folded\n',
+    '---\ngroup:\n  description: multi\n    line\n',
+    '---\ngroup:\n  description: &anchor x\n  other: *anchor\n',
+    '---\ngroup:\n  description: !!str x\n',
+    '---\ngroup:\n  description:\n',
+    '---\ngroup:\n  description: x:\n',
+    '---\ngroup:\n  description: -x\n',
+    '---\n"group":\n  description: x\n',
+    '---\ngroup:\n  description: x\n...\n',
+    '---\ngroup:\n  description: x\n---\nother:\n  description: y\n',
+    '---\ngroup:\n  description: a\xe2\x80\xa8b\n',
+    '\xef\xbb\xbf---\ngroup:\n  description: x\n',
+]
+
+
+def _lint(data):
+    return list(utils.yamllint_check(data, utils._yamllint_config()))
+
+
+def _load(data, linter):
+    try:
+        return 'ok', utils.load_yaml(data, linter)
+    except (utils.ConfigError, utils.yaml.YAMLError) as e:
+        return 'error', str(e)
+
+
+def _mutations(data):
+    """
+    Generate variants of a file with typical style problems
+    (and some variants that are still correct).
+    """
+    lines = data.split('\n')
+    yield data[4:]
+    yield data.rstrip('\n')
+    yield data + '\n'
+    yield data + '# comment\n'
+    yield data.replace(', ', ',')
+    yield data.replace(', ', ' , ')
+    yield data.replace('[', '[ ')
+    yield data.replace(': ', ':  ')
+    yield data.replace('- ', '-  ')
+    yield data.replace('  ', '   ')
+    yield data.replace('  ', '\t')
+    for i, line in enumerate(lines[1:-1], 1):
+        def replaced(new_lines):
+            return '\n'.join(lines[:i] + new_lines + lines[i + 1:])
+        yield replaced([line + ' '])
+        yield replaced([' ' + line])
+        yield replaced(['  ' + line])
+        yield replaced([line[2:]])
+        yield replaced([line, line])
+        yield replaced(['', line])
+        yield replaced(['', '', line])
+        yield replaced(['', '', '', line])
+        yield replaced(['# comment', line])
+        yield replaced([line + '  # comment'])
+        yield replaced([line.replace(':', ' :', 1)])
+        yield replaced([line.split(':')[0] + ':'])
+        yield replaced([line.split(':')[0] + ': yes'])
+        yield replaced([line.split(':')[0] + ': True'])
+        yield replaced([line.split(':')[0] + ': [on]'])
+        yield replaced([line.split(':')[0] + ': x:'])
+        yield replaced([line.split(':')[0] + ': a: b'])
+
+
+class TestLinter(object):
+    @pytest.mark.parametrize('data', CANONICAL)
+    def test_canonical(self, data):
+        assert tool.is_canonical(data)
+        assert _lint(data) == []
+
+    @pytest.mark.parametrize('data', NOT_CANONICAL)
+    def test_not_canonical(self, data):
+        assert not tool.is_canonical(data)
+
+    @pytest.mark.parametrize('path', CORRECT_FILES)
+    def test_config_files_canonical(self, path):
+        with open(path) as src:
+            assert tool.is_canonical(src.read())
+
+    @pytest.mark.parametrize('path', ALL_FILES)
+    def test_differential(self, path):
+        with open(path) as src:
+            original = src.read()
+        variants = set(_mutations(original)).union([original])
+        for data in sorted(variants):
+            if tool.is_canonical(data):
+                assert _lint(data) == [], data
+
+    @pytest.mark.parametrize('data', NOT_CANONICAL)
+    def test_differential_snippets(self, data):
+        assert _load(data, 'builtin') == _load(data, 'yamllint')
+
+    def test_load_yaml_builtin_skips_yamllint(self):
+        with mock.patch('ipamanager.utils.run_yamllint_check') as mock_lint:
+            assert utils.load_yaml(CANONICAL[0], 'builtin') == {
+                'group': {'description': 'A group'}}
+        mock_lint.assert_not_called()
+
+    def test_load_yaml_builtin_delegates(self):
+        data = NOT_CANONICAL[7]
+        with pytest.raises(utils.ConfigError) as exc:
+            utils.load_yaml(data, 'builtin')
+        assert exc.value[0] == (
+            'yamllint errors: [3:16: too many spaces after colon (colons)]')
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import json
+import mock
+import pytest
+
+from _utils import _import
+tool = _import('ipamanager', 'metrics')
+modulename = 'ipamanager.metrics'
+
+
+class TestMetrics(object):
+    def setup_method(self, method):
+        with mock.patch('%s.time.time' % modulename, return_value=100.0):
+            self.metrics = tool.Metrics('push')
+
+    def _phase(self, name, wall, cpu, rss):
+        with mock.patch('%s.time.time' % modulename,
+                        side_effect=[0.0, wall]):
+            with mock.patch('%s._cpu_time' % modulename,
+                            side_effect=[1.0, 1.0 + cpu]):
+                with mock.patch('%s._peak_rss' % modulename,
+                                return_value=rss):
+                    with self.metrics.phase(name):
+                        pass
+
+    def test_phase(self):
+        self._phase('load', 2.0, 1.5, 1024)
+        self._phase('check', 0.5, 0.5, 2048)
+        self._phase('load', 1.0, 0.5, 4096)
+        assert self.metrics.phases.items() == [
+            ('load', {'wall': 3.0, 'cpu': 2.0, 'peak_rss': 4096}),
+            ('check', {'wall': 0.5, 'cpu': 0.5, 'peak_rss': 2048})]
+
+    def test_phase_error(self):
+        with pytest.raises(tool.ManagerError):
+            with self.metrics.phase('load'):
+                raise tool.ManagerError('Error loading config')
+        assert self.metrics.phases.keys() == ['load']
+
+    def test_count(self):
+        self.metrics.count('rpc_calls')
+        self.metrics.count('rpc_calls', 2)
+        self.metrics.count('entities', 5, 'user')
+        self.metrics.count('entities', 2, 'group')
+        self.metrics.count('entities', 1, 'user')
+        assert self.metrics.counters == {
+            'rpc_calls': 3, 'entities': {'user': 6, 'group': 2}}
+
+    def test_to_dict(self):
+        self._phase('load', 2.0, 1.5, 1024)
+        self.metrics.count('files_parsed', 10)
+        with mock.patch('%s.time.time' % modulename, return_value=103.0):
+            self.metrics.finish(True)
+        assert self.metrics.to_dict() == {
+            'format': 1, 'action': 'push', 'success': True,
+            'started': 100.0, 'finished': 103.0, 'duration': 3.0,
+            'phases': {'load': {'wall': 2.0, 'cpu': 1.5, 'peak_rss': 1024}},
+            'counters': {'files_parsed': 10}}
+
+    def test_to_prometheus(self):
+        self._phase('load', 2.0, 1.5, 1024)
+        self.metrics.count('rpc_calls', 12)
+        self.metrics.count('commands', 3, 'group_add_member')
+        self.metrics.count('commands', 1, 'user_add')
+        with mock.patch('%s.time.time' % modulename, return_value=103.0):
+            self.metrics.finish(False)
+        assert self.metrics.to_prometheus().splitlines() == [
+            '# HELP ipamanager_phase_wall_seconds '
+            'Wall time spent in the phase of the run.',
+            '# TYPE ipamanager_phase_wall_seconds gauge',
+            'ipamanager_phase_wall_seconds{action="push",phase="load"} 2.0',
+            '# HELP ipamanager_phase_cpu_seconds CPU time (including child '
+            'processes) spent in the phase of the run.',
+            '# TYPE ipamanager_phase_cpu_seconds gauge',
+            'ipamanager_phase_cpu_seconds{action="push",phase="load"} 1.5',
+            '# HELP ipamanager_phase_peak_rss_bytes Peak resident set size '
+            'of the process at the end of the phase of the run.',
+            '# TYPE ipamanager_phase_peak_rss_bytes gauge',
+            'ipamanager_phase_peak_rss_bytes{action="push",phase="load"} '
+            '1024',
+            '# HELP ipamanager_rpc_calls Number of rpc calls in the run.',
+            '# TYPE ipamanager_rpc_calls gauge',
+            'ipamanager_rpc_calls{action="push"} 12',
+            '# HELP ipamanager_commands Number of commands in the run.',
+            '# TYPE ipamanager_commands gauge',
+            'ipamanager_commands{action="push",command="group_add_member"} 3',
+            'ipamanager_commands{action="push",command="user_add"} 1',
+            '# HELP ipamanager_run_duration_seconds '
+            'Wall time of the whole run.',
+            '# TYPE ipamanager_run_duration_seconds gauge',
+            'ipamanager_run_duration_seconds{action="push"} 3.0',
+            '# HELP ipamanager_run_success '
+            'Whether the run finished successfully.',
+            '# TYPE ipamanager_run_success gauge',
+            'ipamanager_run_success{action="push"} 0',
+            '# HELP ipamanager_run_timestamp_seconds '
+            'Time the run finished at.',
+            '# TYPE ipamanager_run_timestamp_seconds gauge',
+            'ipamanager_run_timestamp_seconds{action="push"} 103.0']
+
+    def test_to_prometheus_escape(self):
+        self.metrics.count('entities', 1, 'a"b\\c')
+        assert ('ipamanager_entities{action="push",type="a\\"b\\\\c"} 1'
+                in self.metrics.to_prometheus().splitlines())
+
+    def test_write_json(self, tmpdir):
+        path = tmpdir.join('stats.json')
+        self.metrics.count('rpc_calls', 3)
+        self.metrics.write_json(path.strpath)
+        assert json.loads(path.read())['counters'] == {'rpc_calls': 3}
+        assert tmpdir.listdir() == [path]
+
+    def test_write_prometheus(self, tmpdir):
+        path = tmpdir.join('ipamanager.prom')
+        path.write('old')
+        self.metrics.write_prometheus(path.strpath)
+        assert 'ipamanager_run_success{action="push"} 0\n' in path.read()
+        assert oct(path.stat().mode & 0o777) == '0644'
+        assert tmpdir.listdir() == [path]
+
+    def test_write_error(self, tmpdir):
+        path = tmpdir.join('missing', 'stats.json').strpath
+        with pytest.raises(tool.ManagerError) as exc:
+            self.metrics.write_json(path)
+        assert exc.value[0].startswith('Cannot write metrics to %s: ' % path)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import mock
+import pstats
+import pytest
+
+from _utils import _import
+tool = _import('ipamanager', 'profiling')
+metrics = _import('ipamanager', 'metrics')
+modulename = 'ipamanager.profiling'
+
+
+def _allocate(count):
+    return [Allocated() for _ in range(count)]
+
+
+class Allocated(object):
+    pass
+
+
+class TestPhaseProfiler(object):
+    def setup_method(self, method):
+        self.metrics = metrics.Metrics('check')
+
+    def test_init_creates_directory(self, tmpdir):
+        directory = tmpdir.join('profiles', 'check')
+        tool.PhaseProfiler(directory.strpath)
+        assert directory.check(dir=True)
+
+    def test_init_error(self, tmpdir):
+        tmpdir.join('file').write('')
+        path = tmpdir.join('file', 'profiles').strpath
+        with pytest.raises(tool.ManagerError) as exc:
+            tool.PhaseProfiler(path)
+        assert exc.value[0].startswith(
+            'Cannot create profile directory %s: ' % path)
+
+    def test_phases(self, tmpdir):
+        self.metrics.profiler = tool.PhaseProfiler(tmpdir.strpath)
+        with self.metrics.phase('load'):
+            kept = _allocate(1000)
+        with self.metrics.phase('check'):
+            _allocate(10)
+        with self.metrics.phase('load'):
+            kept.extend(_allocate(500))
+        self.metrics.profiler.write()
+        assert sorted(i.basename for i in tmpdir.listdir()) == [
+            'check.memory.txt', 'check.pstats',
+            'load.memory.txt', 'load.pstats']
+        stats = pstats.Stats(tmpdir.join('load.pstats').strpath)
+        calls = dict((func[2], stat[0])
+                     for func, stat in stats.stats.iteritems())
+        assert calls['_allocate'] == 2
+        report = tmpdir.join('load.memory.txt').read().split('\n\n')
+        assert len(report) == 2
+        assert report[0].startswith('Peak RSS: ')
+        if tool.tracemalloc is None:
+            assert 'Allocated: +1000 (' in report[0]
+            assert 'Allocated: +500 (' in report[1]
+
+    def test_nested_phase(self, tmpdir):
+        profiler = tool.PhaseProfiler(tmpdir.strpath)
+        self.metrics.profiler = profiler
+        with self.metrics.phase('push'):
+            with self.metrics.phase('plan'):
+                pass
+            assert profiler.active == 'push'
+        assert profiler.active is None
+        assert profiler.profiles.keys() == ['push']
+
+    def test_write_error(self, tmpdir):
+        profiler = tool.PhaseProfiler(tmpdir.strpath)
+        self.metrics.profiler = profiler
+        with self.metrics.phase('load'):
+            pass
+        tmpdir.remove()
+        with pytest.raises(tool.ManagerError) as exc:
+            profiler.write()
+        assert exc.value[0].startswith('Cannot write profile of phase load: ')
+
+    def test_no_tracemalloc(self, tmpdir):
+        with mock.patch('%s.tracemalloc' % modulename, None):
+            profiler = tool.PhaseProfiler(tmpdir.strpath)
+            profiler.start('load')
+            kept = _allocate(100)
+            profiler.stop('load')
+        assert 'Allocated: +100 (' in profiler.reports['load'][0]
+        assert len(kept) == 100
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import logging
+import os
+import pytest
+
+from _utils import _import
+generator = _import('benchmarks', 'generator')
+tool = _import('benchmarks', 'scaling')
+config_loader = _import('ipamanager', 'config_loader')
+integrity_checker = _import('ipamanager', 'integrity_checker')
+utils = _import('ipamanager', 'utils')
+
+
+class TestGenerator(object):
+    def teardown_method(self, method):
+        logging.disable(logging.NOTSET)
+
+    @pytest.mark.parametrize('depth', [1, 2, 4])
+    def test_generate_repo(self, tmpdir, depth):
+        counts = generator.generate_repo(
+            tmpdir.strpath, users=30, groups=12, depth=depth)
+        assert counts == {'user': 30, 'group': 12, 'hostgroup': 6,
+                          'hbacrule': 2, 'sudorule': 2}
+        assert len(tmpdir.join('users').listdir()) == 30
+        settings = utils.load_settings(
+            tmpdir.join('settings_common.yaml').strpath)
+        entities = config_loader.ConfigLoader(
+            tmpdir.strpath, settings).load()
+        assert dict((k, len(v)) for k, v in entities.iteritems() if v) == (
+            counts)
+        integrity_checker.IntegrityChecker(entities, settings).check()
+        levels = set(name.split('-')[0] if name.startswith('team') else
+                     name.split('-')[1] for name in entities['group'])
+        assert len(levels) == max(2, depth)
+
+    def test_generate_repo_deterministic(self, tmpdir):
+        generator.generate_repo(tmpdir.join('a').strpath, 20, 10)
+        generator.generate_repo(tmpdir.join('b').strpath, 20, 10)
+        path = os.path.join('users', 'user.00003.yaml')
+        assert tmpdir.join('a', path).read() == tmpdir.join('b', path).read()
+
+
+class TestScaling(object):
+    def teardown_method(self, method):
+        logging.disable(logging.NOTSET)
+
+    def test_measure(self):
+        result = tool.measure(20, 6, 3, 2)
+        assert result['entities'] == 20 + 6 + 3 + 1 + 1
+        assert result['phases'].keys() == tool.PHASES
+        for phase in result['phases'].itervalues():
+            assert phase['time'] >= 0
+            assert phase['peak_rss_mib'] > 0
+
+    def test_exponent(self):
+        assert tool.exponent([10, 100], [1.0, 10.0]) == pytest.approx(1)
+        assert tool.exponent([10, 100, 1000], [1, 100, 10000]) == (
+            pytest.approx(2))
+        assert tool.exponent([10], [1.0]) is None
+
+    def _results(self, times):
+        return {'format': 1, 'sizes': [{'users': 100}, {'users': 400}],
+                'phases': dict((phase, {'time': times})
+                               for phase in tool.PHASES)}
+
+    def test_compare(self):
+        rows, regressions = tool.compare(
+            self._results([0.01, 2.0]), self._results([0.005, 1.0]), 0.25)
+        assert len(rows) == 10
+        assert ('load', 100, 0.01, 0.005, 2.0) in rows
+        # the slowdown of the smaller size is too small to be reported
+        assert regressions == [
+            (phase, 400, 2.0, 1.0, 2.0) for phase in tool.PHASES]
+
+    def test_compare_other_sizes(self):
+        baseline = self._results([1.0, 1.0])
+        baseline['sizes'] = [{'users': 400}, {'users': 1600}]
+        rows, regressions = tool.compare(
+            self._results([1.0, 1.1]), baseline, 0.25)
+        assert [row[1] for row in rows] == [400] * 5
+        assert not regressions
+
+    def test_compare_format(self):
+        with pytest.raises(ValueError) as exc:
+            tool.compare(self._results([1, 1]), {'format': 0}, 0.25)
+        assert exc.value[0] == 'Unsupported baseline format 0'
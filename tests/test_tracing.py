@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright © 2017-2019, GoodData Corporation. All rights reserved.
+
+import json
+import logging
+import mock
+import pytest
+from testfixtures import log_capture
+
+from _utils import _import
+tool = _import('ipamanager', 'tracing')
+modulename = 'ipamanager.tracing'
+
+
+class TestTracer(object):
+    def _call(self, tracer, duration, result=None, error=None,
+              command='group_add_member'):
+        function = mock.Mock(return_value=result, side_effect=error)
+        with mock.patch('%s.time' % modulename) as mock_time:
+            mock_time.time.side_effect = [100.0, 100.0 + duration]
+            return tracer.call(function, command, 'group1',
+                               cn=u'group1', user=(u'user1', u'user2'))
+
+    def test_call(self, tmpdir):
+        path = tmpdir.join('trace.jsonl')
+        tracer = tool.Tracer(path.strpath)
+        assert self._call(tracer, 0.5, {'completed': 2}) == {'completed': 2}
+        with pytest.raises(ValueError):
+            self._call(tracer, 0.25, error=ValueError('timeout'))
+        tracer.close()
+        spans = [json.loads(line) for line in path.readlines()]
+        assert spans == [
+            {'command': 'group_add_member', 'target': 'group1',
+             'start': 100.0, 'duration': 0.5, 'payload_bytes': 44,
+             'response_bytes': 16, 'outcome': 'ok'},
+            {'command': 'group_add_member', 'target': 'group1',
+             'start': 100.0, 'duration': 0.25, 'payload_bytes': 44,
+             'response_bytes': 0, 'outcome': 'error', 'error': 'timeout'}]
+        assert tracer.durations == {'group_add_member': [0.5, 0.25]}
+
+    def test_call_no_trace_file(self):
+        tracer = tool.Tracer()
+        with mock.patch('%s._size' % modulename) as mock_size:
+            self._call(tracer, 0.5)
+        mock_size.assert_not_called()
+        assert tracer.durations == {'group_add_member': [0.5]}
+
+    def test_trace_file_error(self, tmpdir):
+        path = tmpdir.join('missing', 'trace.jsonl').strpath
+        with pytest.raises(tool.ManagerError) as exc:
+            tool.Tracer(path)
+        assert exc.value[0].startswith('Cannot open trace file %s: ' % path)
+
+    @log_capture('Tracer', level=logging.WARNING)
+    def test_slow_call(self, captured_log):
+        tracer = tool.Tracer(threshold=1)
+        self._call(tracer, 0.5)
+        self._call(tracer, 2.5)
+        self._call(tool.Tracer(threshold=None), 2.5)
+        self._call(tracer, 2.5, command='group_find')
+        captured_log.check(('Tracer', 'WARNING',
+                            'Slow API call group_add_member group1 '
+                            'took 2.500 s'))
+
+    def test_histogram(self):
+        assert tool.Tracer.histogram(
+            [0.001, 0.01, 0.05, 0.5, 0.9, 1, 5, 10, 60]) == [1, 2, 2, 2, 2]
+
+    @log_capture('Tracer', level=logging.INFO)
+    def test_close(self, captured_log):
+        tracer = tool.Tracer()
+        tracer.close()
+        for duration in (0.005, 0.5, 12):
+            self._call(tracer, duration)
+        tracer.close()
+        captured_log.check(
+            ('Tracer', 'WARNING',
+             'Slow API call group_add_member group1 took 12.000 s'),
+            ('Tracer', 'INFO', 'API call latency (calls per bucket: '
+                               '<10ms <100ms <1s <10s >=10s):'),
+            ('Tracer', 'INFO', '- group_add_member: 3 calls, 12.505 s total, '
+                               '12.000 s max | 1 0 1 0 1'))
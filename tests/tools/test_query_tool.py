@@ -47,6 +47,19 @@ class TestQueryTool(object):
         mock_load_settings.assert_called_with(os.path.join(
             testdir, '../freeipa-manager-config/correct/settings_common.yaml'))
 
+    def test_init_profile(self, tmpdir):
+        querytool = tool.QueryTool(CONFIG_CORRECT, SETTINGS,
+                                   profile=tmpdir.strpath)
+        with LogCapture():
+            querytool.load()
+            querytool.run(argparse.Namespace(
+                action='member', members=[('user', 'firstname.lastname')],
+                entities=[('group', 'group-one-users')]))
+            querytool.metrics.profiler.write()
+        assert sorted(i.basename for i in tmpdir.listdir()) == [
+            'check.memory.txt', 'check.pstats', 'load.memory.txt',
+            'load.pstats', 'query.memory.txt', 'query.pstats']
+
     def test_run_member(self):
         self.querytool._query_membership = mock.Mock()
         args = argparse.Namespace(action='member', members=[], entities=[])
@@ -59,13 +72,15 @@ class TestQueryTool(object):
         self.querytool.run(args)
         self.querytool._query_labels.assert_called_with(args)
 
-    @log_capture()
+    @log_capture('QueryTool')
     @mock.patch('%s.IntegrityChecker' % modulename)
     @mock.patch('%s.ConfigLoader' % modulename)
     def test_load(self, mock_loader, mock_checker, log):
         self.querytool.load()
         mock_loader.assert_called_with(
-            self.querytool.config, self.querytool.settings)
+            self.querytool.config, self.querytool.settings, workers=1,
+            cache_dir=None, since=None, state_path=None, revision=None,
+            metrics=self.querytool.metrics)
         mock_load = mock_loader.return_value.load
         mock_load.assert_called_with()
         assert self.querytool.entities == mock_load.return_value
@@ -493,7 +508,25 @@ class TestQueryToolTopLevel(object):
             action='member', config='config', loglevel=logging.INFO,
             members=[('group', 'group1'), ('user', 'user1')],
             pull_types=['user'], settings='settings.yam',
-            entities=[('group', 'group2')])
+            entities=[('group', 'group2')], workers=1, no_cache=False,
+            since=None, state=None, revision=None, profile=None)
+
+    def test_parse_args_since_with_revision(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            tool._parse_args(['member', 'config', '-m', 'group:group1',
+                              '-e', 'group:group2', '--since', 'HEAD',
+                              '--state', 'state', '--revision', 'HEAD~1'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert 'error: argument --revision: not allowed with --since' in err
+
+    def test_parse_args_since_without_state(self, capsys):
+        with pytest.raises(SystemExit) as exc:
+            tool._parse_args(['member', 'config', '-m', 'group:group1',
+                              '-e', 'group:group2', '--since', 'HEAD'])
+        assert exc.value[0] == 2
+        _, err = capsys.readouterr()
+        assert 'error: argument --since: requires --state' in err
 
     @mock.patch('%s.QueryTool' % modulename)
     @mock.patch('%s._parse_args' % modulename)
@@ -502,9 +535,14 @@ class TestQueryToolTopLevel(object):
             action='member', config='config', loglevel=20,
             members=[('group', 'group1'), ('user', 'user1')],
             pull_types=['user'], settings='settings.yam',
-            entities=[('group', 'group2')])
+            entities=[('group', 'group2')], workers=4, no_cache=False,
+            since=None, state=None, revision='HEAD~1', profile='profiles')
         tool.main()
-        mock_querytool.assert_called_with('config', 'settings.yam', 20)
+        mock_querytool.assert_called_with(
+            'config', 'settings.yam', 20, 4, True, None, None, 'HEAD~1',
+            'profiles')
         mock_querytool.return_value.load.assert_called_with()
         mock_querytool.return_value.run.assert_called_with(
             mock_parse_args.return_value)
+        profiler = mock_querytool.return_value.metrics.profiler
+        profiler.write.assert_called_with()